@@ -0,0 +1,177 @@
+import hashlib
+import json
+import logging
+import os
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Set
+
+from fastapi import Request, Response
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cache import BytesCache, SingleFlight
+from commit_hooks import CommitHook
+from database import async_session
+from models import catalog_version_seq
+from notifications import notify
+
+logger = logging.getLogger(__name__)
+
+CATALOG_CHANNEL = "catalog"
+CATALOG_CACHE_TTL = float(os.getenv("CATALOG_CACHE_TTL", "300"))
+CATALOG_CACHE_SIZE = int(os.getenv("CATALOG_CACHE_SIZE", "10000"))
+CATALOG_CACHE_MAX_BYTES = int(os.getenv("CATALOG_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+# Lets browsers and shared caches reuse public catalog responses, then revalidate with If-None-Match
+CATALOG_CACHE_CONTROL = os.getenv("CATALOG_CACHE_CONTROL", "public, max-age=60, stale-while-revalidate=300")
+
+CATEGORIES_KEY = "categories"
+
+
+def product_key(product_id: int) -> str:
+    return f"product:{product_id}"
+
+
+def if_none_match(request: Request) -> set:
+    # If-None-Match uses the weak comparison, so W/ prefixes are ignored
+    header = request.headers.get("if-none-match", "")
+    return {tag.strip().removeprefix("W/") for tag in header.split(",") if tag.strip()}
+
+
+def body_etag(body: bytes) -> str:
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+class CatalogCache:
+    """Encoded public catalog responses, dropped per key on writes in every worker
+
+    Writers call invalidate() inside their transaction. It takes the next catalog
+    version and queues a NOTIFY that Postgres delivers to every worker on commit;
+    the keys are dropped here once the session commits. A load that started before
+    an invalidation does not store its result, so a read racing a write cannot leave
+    a stale body behind.
+
+    Cached bodies are tagged with a hash of their content, so a product's tag only
+    changes when that product does. Listings are not cached; their tag comes from
+    the last catalog change this worker applied, so it is known, and a conditional
+    request answered, before any SQL runs.
+
+    Each change takes a number from catalog_version_seq. Postgres delivers NOTIFYs
+    in commit order to every listener, so "the state right after change N" is the
+    same in every worker and N is a strong listing tag. Any other state (after a
+    start, a resync, or a local commit whose NOTIFY has not come back yet) gets a
+    random tag that no other state ever had, which costs a 200 and never a stale 304.
+    """
+
+    def __init__(self):
+        self._cache = BytesCache(max_bytes=CATALOG_CACHE_MAX_BYTES, maxsize=CATALOG_CACHE_SIZE, ttl=CATALOG_CACHE_TTL)
+        self._loads = SingleFlight()
+        self._generation = 0
+        self.version = 0
+        self.invalidations = 0
+        self.not_modified = 0
+        self.resyncs = 0
+        self._listing_state = uuid.uuid4().hex
+        # Versions committed here whose NOTIFY has not been delivered back yet
+        self._unconfirmed: Set[int] = set()
+        self._committed = CommitHook(self._drop_committed)
+
+    async def start(self) -> None:
+        self.version = await self._current_version()
+        self._listing_state = uuid.uuid4().hex
+
+    async def resync(self) -> None:
+        """Drop every cached body, as changes may have been missed while not listening"""
+        self._generation += 1
+        self._cache.clear()
+        self._unconfirmed.clear()
+        self._listing_state = uuid.uuid4().hex
+        self.version = await self._current_version()
+        self.resyncs += 1
+        logger.info(f"Catalog cache cleared after resync at version {self.version}")
+
+    async def _current_version(self) -> int:
+        async with async_session() as db:
+            if db.bind.dialect.name != "postgresql":
+                return self.version
+            result = await db.execute(text("SELECT last_value, is_called FROM catalog_version_seq"))
+            last_value, is_called = result.one()
+            return last_value if is_called else 0
+
+    def listing_etag(self, request: Request) -> str:
+        """Tag for a listing URL at the catalog state this worker has applied"""
+        query = hashlib.blake2b(request.url.query.encode(), digest_size=8).hexdigest()
+        return f'"{self._listing_state}-{query}"'
+
+    def check(self, request: Request, etag: str) -> Optional[Response]:
+        """A 304 when the client already holds `etag`, else None"""
+        tags = if_none_match(request)
+        if etag not in tags and "*" not in tags:
+            return None
+        self.not_modified += 1
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": CATALOG_CACHE_CONTROL})
+
+    def respond(self, request: Request, body: bytes, etag: Optional[str] = None) -> Response:
+        """`body` with its ETag (a hash of it unless given), or a 304 when the client already holds it"""
+        etag = etag or body_etag(body)
+        not_modified = self.check(request, etag)
+        if not_modified is not None:
+            return not_modified
+        headers = {"ETag": etag, "Cache-Control": CATALOG_CACHE_CONTROL}
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    async def get_or_load(self, key: str, load: Callable[[], Awaitable[bytes]]) -> bytes:
+        body = self._cache.get(key)
+        if body is None:
+            body = await self._loads.do(key, lambda: self._load(key, load))
+        return body
+
+    async def _load(self, key: str, load: Callable[[], Awaitable[bytes]]) -> bytes:
+        generation = self._generation
+        body = await load()
+        if generation == self._generation:
+            self._cache.set(key, body)
+        return body
+
+    async def invalidate(self, db: AsyncSession, *keys: str) -> None:
+        """Stage a catalog change, dropping `keys`, in the session's transaction"""
+        version = None
+        if db.bind.dialect.name == "postgresql":
+            # nextval is not transactional, so a rolled back write just leaves a gap
+            version = await db.scalar(select(catalog_version_seq.next_value()))
+            await notify(db, CATALOG_CHANNEL, json.dumps({"version": version, "keys": keys}))
+        self._committed.stage(db, (keys, version))
+
+    def drop(self, keys: Iterable[str], version: Optional[int] = None) -> None:
+        self._generation += 1
+        for key in keys:
+            self._cache.pop(key)
+        if version is not None:
+            self.version = max(self.version, version)
+        self.invalidations += 1
+
+    def handle_notification(self, payload: str) -> None:
+        change = json.loads(payload)
+        self.drop(change["keys"], change["version"])
+        self._unconfirmed.discard(change["version"])
+        # With a local commit still to come back, this state includes a change the others have not seen
+        self._listing_state = f"v{change['version']}" if not self._unconfirmed else uuid.uuid4().hex
+
+    def _drop_committed(self, changes) -> None:
+        keys = {key for change_keys, _ in changes for key in change_keys}
+        versions = [version for _, version in changes if version is not None]
+        self.drop(keys, max(versions) if versions else None)
+        self._unconfirmed.update(versions)
+        self._listing_state = uuid.uuid4().hex
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._cache.stats(),
+            "version": self.version,
+            "invalidations": self.invalidations,
+            "not_modified": self.not_modified,
+            "resyncs": self.resyncs,
+            "shared_loads": self._loads.shared,
+        }
+
+
+catalog_cache = CatalogCache()
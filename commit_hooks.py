@@ -0,0 +1,54 @@
+from typing import Any, Callable, List, Optional
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, SessionTransaction
+
+CommitHandler = Callable[[List[Any]], None]
+
+
+class CommitHook:
+    """Items staged on a session, handed to the handlers once its outermost transaction commits
+
+    SQLAlchemy fires after_commit and after_rollback for SAVEPOINTs too, so state kept in
+    session.info would be published when a savepoint is released and wiped when any
+    savepoint rolls back. Here items belong to the innermost transaction they were staged
+    in: a released savepoint passes them to its parent, and one that rolls back discards
+    only its own.
+    """
+
+    def __init__(self, handler: Optional[CommitHandler] = None):
+        self._handlers: List[CommitHandler] = [handler] if handler else []
+        self._staged: "WeakKeyDictionary[SessionTransaction, List[Any]]" = WeakKeyDictionary()
+        event.listen(Session, "after_commit", self._after_commit)
+        event.listen(Session, "after_transaction_end", self._after_transaction_end)
+
+    def subscribe(self, handler: CommitHandler) -> None:
+        self._handlers.append(handler)
+
+    def stage(self, session, *items: Any) -> None:
+        """Stage items in `session` (sync or async) until its transaction commits"""
+        session = getattr(session, "sync_session", session)
+        transaction = session.get_nested_transaction() or session.get_transaction() or session.begin()
+        self._staged.setdefault(transaction, []).extend(items)
+
+    def staged(self, session) -> List[Any]:
+        """Items staged in the session's innermost transaction so far"""
+        session = getattr(session, "sync_session", session)
+        transaction = session.get_nested_transaction() or session.get_transaction()
+        return self._staged.get(transaction, []) if transaction is not None else []
+
+    def _after_commit(self, session: Session) -> None:
+        transaction = session.get_nested_transaction() or session.get_transaction()
+        items = self._staged.pop(transaction, None)
+        if not items:
+            return
+        if transaction.nested:
+            self._staged.setdefault(transaction.parent, []).extend(items)
+            return
+        for handler in self._handlers:
+            handler(items)
+
+    def _after_transaction_end(self, session: Session, transaction: SessionTransaction) -> None:
+        # Anything still staged here was rolled back or closed without a commit
+        self._staged.pop(transaction, None)
@@ -0,0 +1,121 @@
+import logging
+import os
+from collections import defaultdict
+from typing import Any, Dict, Hashable, Optional, Sequence, Tuple
+
+from sqlalchemy import Select, event, func, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import ORMExecuteState, Session
+
+from cache import TTLCache
+from commit_hooks import CommitHook
+
+logger = logging.getLogger(__name__)
+
+COUNTS_CHANNEL = "counts"
+# Bounds how stale a total can get if a write bypasses the ORM session
+COUNT_CACHE_TTL = float(os.getenv("COUNT_CACHE_TTL", "30"))
+COUNT_CACHE_SIZE = int(os.getenv("COUNT_CACHE_SIZE", "10000"))
+# Unfiltered listings of tables estimated above this size report pg_class.reltuples
+COUNT_ESTIMATE_THRESHOLD = int(os.getenv("COUNT_ESTIMATE_THRESHOLD", "100000"))
+
+_ESTIMATE_SQL = text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:table)")
+
+
+class CountProvider:
+    """Totals for paginated listings without a count scan per request
+
+    Exact counts are cached per filter key together with the write versions of the
+    tables they read. Any insert, update or delete on one of those tables committed
+    through a session bumps its version, so the next request counts again. On
+    Postgres each written table is also queued as a NOTIFY in the writing
+    transaction, so every other worker bumps its version on commit too.
+    """
+
+    def __init__(self, ttl: float = COUNT_CACHE_TTL, estimate_threshold: int = COUNT_ESTIMATE_THRESHOLD):
+        self.estimate_threshold = estimate_threshold
+        self._cache = TTLCache(maxsize=COUNT_CACHE_SIZE, ttl=ttl)
+        self._versions: Dict[str, int] = defaultdict(int)
+        self.counted = 0
+        self.estimated = 0
+        self.invalidations = 0
+        self._committed = CommitHook(lambda tables: self.invalidate(*set(tables)))
+
+    async def count(
+        self,
+        db: AsyncSession,
+        query: Select,
+        key: Hashable,
+        tables: Sequence[str],
+        estimate_table: Optional[str] = None,
+    ) -> Tuple[int, bool]:
+        """Return (total, exact); pass estimate_table only for unfiltered listings"""
+        if estimate_table and db.bind.dialect.name == "postgresql":
+            estimate = await self._estimate(db, estimate_table)
+            if estimate >= self.estimate_threshold:
+                self.estimated += 1
+                return estimate, False
+        cache_key = (key, tuple(self._versions[table] for table in tables))
+        total = self._cache.get(cache_key)
+        if total is None:
+            result = await db.execute(query)
+            total = result.scalar()
+            self._cache.set(cache_key, total)
+            self.counted += 1
+        return total, True
+
+    async def _estimate(self, db: AsyncSession, table: str) -> int:
+        # Planner statistics; -1 until the table was first analyzed
+        estimate = self._cache.get(("reltuples", table))
+        if estimate is None:
+            result = await db.execute(_ESTIMATE_SQL, {"table": table})
+            estimate = result.scalar() or -1
+            self._cache.set(("reltuples", table), estimate)
+        return estimate
+
+    def invalidate(self, *tables: str) -> None:
+        for table in tables:
+            self._versions[table] += 1
+        self.invalidations += 1
+
+    def handle_notification(self, payload: str) -> None:
+        self.invalidate(payload)
+
+    async def resync(self) -> None:
+        # Writes from other workers may have been missed while not listening
+        self._cache.clear()
+        self.invalidations += 1
+
+    def track_statement(self, state: ORMExecuteState) -> None:
+        if state.is_insert or state.is_update or state.is_delete:
+            self._track(state.session, {state.statement.table.name})
+
+    def track_flush(self, session: Session, flush_context: Any) -> None:
+        changed = {instance.__tablename__ for instance in [*session.new, *session.dirty, *session.deleted]}
+        if changed:
+            self._track(session, changed)
+
+    def _track(self, session: Session, tables: set) -> None:
+        # Tables already staged in this (sub)transaction have their NOTIFY queued
+        tables = tables - set(self._committed.staged(session))
+        if not tables:
+            return
+        if session.bind.dialect.name == "postgresql":
+            # Queued in the transaction, so a rolled back write or savepoint notifies no one
+            connection = session.connection()
+            for table in tables:
+                connection.execute(select(func.pg_notify(COUNTS_CHANNEL, table)))
+        self._committed.stage(session, *tables)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "counted": self.counted,
+            "estimated": self.estimated,
+            "invalidations": self.invalidations,
+            "cache": self._cache.stats(),
+        }
+
+
+count_provider = CountProvider()
+event.listen(Session, "do_orm_execute", count_provider.track_statement)
+event.listen(Session, "after_flush", count_provider.track_flush)
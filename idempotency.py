@@ -0,0 +1,170 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.exc import IntegrityError
+
+from cache import SingleFlight, TTLCache
+from database import async_session
+from models import IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+IDEMPOTENCY_CACHE_TTL = float(os.getenv("IDEMPOTENCY_CACHE_TTL", "3600"))
+# How long a duplicate waits for the first request before giving up with a 409
+IDEMPOTENCY_WAIT_TIMEOUT = float(os.getenv("IDEMPOTENCY_WAIT_TIMEOUT", "30"))
+IDEMPOTENCY_POLL_INTERVAL = float(os.getenv("IDEMPOTENCY_POLL_INTERVAL", "0.2"))
+# A claim older than this is assumed to belong to a crashed worker
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv("IDEMPOTENCY_LOCK_TIMEOUT", "120"))
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+Scope = Tuple[int, str, str]
+
+
+def request_fingerprint(payload: Any) -> str:
+    body = json.dumps(jsonable_encoder(payload), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(body.encode()).hexdigest()
+
+
+class IdempotencyStore:
+    """Replays stored responses for repeated Idempotency-Key requests
+
+    An LRU answers recent replays without SQL; the idempotency_keys table, unique
+    on (user_id, endpoint, key), is the source of truth across workers.
+    """
+
+    def __init__(self):
+        self._cache = TTLCache(maxsize=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_CACHE_TTL)
+        self._in_flight = SingleFlight()
+        self.executed = 0
+        self.replayed = 0
+
+    async def run(
+        self,
+        key: Optional[str],
+        user_id: int,
+        endpoint: str,
+        payload: Any,
+        handler: Callable[[], Awaitable[Any]],
+    ) -> Any:
+        if not key:
+            return await handler()
+        if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            raise HTTPException(status_code=400, detail="Idempotency-Key is too long")
+
+        scope = (user_id, endpoint, key)
+        request_hash = request_fingerprint(payload)
+        cached = self._cache.get(scope)
+        if cached is not None:
+            return self._replay(cached, request_hash)
+        # Concurrent duplicates in this worker wait on the first request and get its
+        # response replayed, so they are held to its request hash too
+        leader = not self._in_flight.in_flight(scope)
+        stored = await self._in_flight.do(scope, lambda: self._execute(scope, request_hash, handler))
+        if leader and not stored["replayed"]:
+            return stored["body"]
+        return self._replay(stored, request_hash)
+
+    def cached(self, key: Optional[str], user_id: int, endpoint: str, payload: Any) -> Optional[Any]:
+        """The response of a completed request still held in memory, else None; runs no SQL"""
+        stored = self._cache.get((user_id, endpoint, key)) if key else None
+        return self._replay(stored, request_fingerprint(payload)) if stored is not None else None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._cache.stats(),
+            "executed": self.executed,
+            "replayed": self.replayed,
+            "shared_in_flight": self._in_flight.shared,
+        }
+
+    def _replay(self, stored: Dict[str, Any], request_hash: str) -> Any:
+        if stored["request_hash"] != request_hash:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+        self.replayed += 1
+        return stored["body"]
+
+    async def _execute(self, scope: Scope, request_hash: str, handler: Callable[[], Awaitable[Any]]) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + IDEMPOTENCY_WAIT_TIMEOUT
+        while True:
+            stored = await self._claim(scope, request_hash)
+            if stored is None:
+                break
+            if stored["body"] is not None:
+                self._cache.set(scope, stored)
+                return {**stored, "replayed": True}
+            if loop.time() >= deadline:
+                raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+            await asyncio.sleep(IDEMPOTENCY_POLL_INTERVAL)
+
+        try:
+            body = jsonable_encoder(await handler())
+        except Exception:
+            # Release the claim so the client can retry a request that failed
+            await self._release(scope)
+            raise
+        await self._complete(scope, body)
+        self.executed += 1
+        stored = {"request_hash": request_hash, "body": body}
+        self._cache.set(scope, stored)
+        return {**stored, "replayed": False}
+
+    async def _claim(self, scope: Scope, request_hash: str) -> Optional[Dict[str, Any]]:
+        """Insert the claim row; returns None when claimed, else what another request stored"""
+        user_id, endpoint, key = scope
+        async with async_session() as db:
+            try:
+                db.add(IdempotencyKey(key=key, user_id=user_id, endpoint=endpoint, request_hash=request_hash))
+                await db.commit()
+                return None
+            except IntegrityError:
+                await db.rollback()
+
+            result = await db.execute(
+                select(IdempotencyKey.request_hash, IdempotencyKey.response_body, IdempotencyKey.created_at)
+                .where(IdempotencyKey.user_id == user_id, IdempotencyKey.endpoint == endpoint, IdempotencyKey.key == key)
+            )
+            row = result.first()
+            if row is None:
+                return {"request_hash": request_hash, "body": None}
+            if row.response_body is None and row.created_at < datetime.utcnow() - timedelta(seconds=IDEMPOTENCY_LOCK_TIMEOUT):
+                logger.warning(f"Taking over stale idempotency claim for {endpoint} key {key}")
+                await self._release(scope)
+            body = json.loads(row.response_body) if row.response_body is not None else None
+            return {"request_hash": row.request_hash, "body": body}
+
+    async def _complete(self, scope: Scope, body: Any) -> None:
+        user_id, endpoint, key = scope
+        async with async_session() as db:
+            await db.execute(
+                update(IdempotencyKey)
+                .where(IdempotencyKey.user_id == user_id, IdempotencyKey.endpoint == endpoint, IdempotencyKey.key == key)
+                .values(response_body=json.dumps(body), completed_at=func.now())
+            )
+            await db.commit()
+
+    async def _release(self, scope: Scope) -> None:
+        user_id, endpoint, key = scope
+        async with async_session() as db:
+            await db.execute(
+                delete(IdempotencyKey)
+                .where(
+                    IdempotencyKey.user_id == user_id,
+                    IdempotencyKey.endpoint == endpoint,
+                    IdempotencyKey.key == key,
+                    IdempotencyKey.response_body.is_(None),
+                )
+            )
+            await db.commit()
+
+
+idempotency_store = IdempotencyStore()
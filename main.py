@@ -1,4 +1,4 @@
-from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File, Query, Request
+from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File, Query, Request, Header
 from pydantic_model import (
     ProductsBase, CartPayload, CartItem, UpdateProduct, CategoryBase, CategoryResponse,
     ProductResponse, OrderResponse, OrderDetailResponse, Role, PaginatedProductResponse,
@@ -10,7 +10,7 @@ import models
 from database import engine, db_dependency, Base
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy import select, func, update, or_
+from sqlalchemy import select, func, update, or_, text
 from sqlalchemy.orm import joinedload
 import auth
 from auth import get_active_user
@@ -25,6 +25,34 @@ import uuid
 from pathlib import Path
 from fastapi.staticfiles import StaticFiles
 from repositories.lnmo_repository import LNMORepository
+from repositories.shortcode_profiles import shortcode_registry
+from repositories.http_client import start_http_client, close_http_client
+from repositories.circuit_breaker import DarajaUnavailable
+from repositories.rate_limiter import TokenBucketLimiter
+from workers.callback_inbox import MPESA_CALLBACK_MODE, callback_inbox_worker, enqueue_callback
+from workers.orphan_callbacks import ORPHAN_CALLBACK_CHANNEL, ORPHAN_CALLBACK_REPLAY_ENABLED, orphan_callbacks
+from workers.reconciler import MPESA_RECONCILE_ENABLED, pending_reconciler
+from workers.payout_dispatcher import MPESA_B2C_ENABLED, payout_dispatcher
+from repositories.b2c_repository import B2CRepository
+from routers import c2b, payouts, webhooks
+from workers.c2b_ingest import c2b_writer
+from workers.webhook_dispatcher import WEBHOOKS_ENABLED, webhook_dispatcher
+from workers.expiry_sweeper import EXPIRY_SWEEPER_ENABLED, expiry_sweeper
+from outbox import OUTBOX_CHANNEL, ORDER_STATUS_CHANGED, add_outbox_events
+from cache import TTLCache, SingleFlight
+from notifications import pg_notifier
+from payment_events import PAYMENT_EVENTS_CHANNEL, payment_events, event_keys
+from fastapi.responses import Response, StreamingResponse
+import metrics
+from idempotency import idempotency_store
+from search import create_search_indexes, product_search_filter, product_search_order
+from pagination import keyset_page, next_page
+from counts import COUNTS_CHANNEL, count_provider
+from catalog_cache import CATALOG_CHANNEL, CATEGORIES_KEY, catalog_cache, product_key
+from pydantic import TypeAdapter
+import asyncio
+import json
+from database import async_session
 
 from contextlib import asynccontextmanager
 
@@ -36,11 +64,59 @@ logger = logging.getLogger(__name__)
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await init_db()
+    await catalog_cache.start()
+    await start_http_client()
+    # One payment client for the app's lifetime, warmed up before traffic arrives
+    try:
+        app.state.lnmo_repo = LNMORepository()
+    except ValueError as e:
+        # The shop still serves the catalog and orders; payment endpoints answer 503
+        logger.error(f"M-Pesa is not configured, payments are disabled: {str(e)}")
+        app.state.lnmo_repo = None
+    if LNMORepository.MPESA_WARM_UP:
+        repositories = [repo for repo in [app.state.lnmo_repo, *shortcode_registry.repositories()] if repo is not None]
+        await asyncio.gather(*[repo.warm_up() for repo in repositories])
+    pg_notifier.subscribe(PAYMENT_EVENTS_CHANNEL, payment_events.handle_notification)
+    pg_notifier.subscribe(OUTBOX_CHANNEL, webhook_dispatcher.notify)
+    pg_notifier.subscribe(ORPHAN_CALLBACK_CHANNEL, orphan_callbacks.handle_notification)
+    pg_notifier.subscribe(CATALOG_CHANNEL, catalog_cache.handle_notification)
+    pg_notifier.subscribe(COUNTS_CHANNEL, count_provider.handle_notification)
+    pg_notifier.on_resync(catalog_cache.resync)
+    pg_notifier.on_resync(count_provider.resync)
+    pg_notifier.on_resync(resync_payment_status)
+    await pg_notifier.start(engine)
+    app.state.b2c_repo = B2CRepository() if MPESA_B2C_ENABLED else None
+    # B2C results always go through the inbox so they can be applied in batches
+    if MPESA_CALLBACK_MODE == "inbox" or MPESA_B2C_ENABLED:
+        callback_inbox_worker.start(app.state.lnmo_repo, app.state.b2c_repo)
+    if ORPHAN_CALLBACK_REPLAY_ENABLED and app.state.lnmo_repo is not None:
+        orphan_callbacks.start(app.state.lnmo_repo)
+    if MPESA_RECONCILE_ENABLED and app.state.lnmo_repo is not None:
+        pending_reconciler.start(app.state.lnmo_repo)
+    if MPESA_B2C_ENABLED:
+        payout_dispatcher.start(app.state.b2c_repo)
+    if WEBHOOKS_ENABLED:
+        webhook_dispatcher.start()
+    if EXPIRY_SWEEPER_ENABLED:
+        expiry_sweeper.start()
     yield
-    # Optional: Add shutdown logic if needed
+    await expiry_sweeper.stop()
+    await webhook_dispatcher.stop()
+    await payout_dispatcher.stop()
+    await c2b_writer.stop()
+    await pending_reconciler.stop()
+    await callback_inbox_worker.stop()
+    await orphan_callbacks.stop()
+    await pg_notifier.stop()
+    await shortcode_registry.close()
+    await close_http_client()
+    metrics.mark_process_dead()
 
 app = FastAPI(lifespan=lifespan)
 app.include_router(auth.router)
+app.include_router(payouts.router)
+app.include_router(c2b.router)
+app.include_router(webhooks.router)
 
 app.add_middleware(
     CORSMiddleware,
@@ -56,14 +132,113 @@ app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
 
 user_dependency = Annotated[dict, Depends(get_active_user)]
 
+def get_lnmo_repo(request: Request) -> LNMORepository:
+    if request.app.state.lnmo_repo is None:
+        raise HTTPException(status_code=503, detail="Payment service is not configured")
+    return request.app.state.lnmo_repo
+
+lnmo_dependency = Annotated[LNMORepository, Depends(get_lnmo_repo)]
+
+PAYMENT_STATUS_CACHE_TTL = float(os.getenv("PAYMENT_STATUS_CACHE_TTL", "15"))
+PAYMENT_STATUS_QUERY_MIN_AGE = int(os.getenv("PAYMENT_STATUS_QUERY_MIN_AGE", "30"))
+PAYMENT_EVENTS_TIMEOUT = float(os.getenv("PAYMENT_EVENTS_TIMEOUT", "120"))
+PAYMENT_EVENTS_KEEPALIVE = float(os.getenv("PAYMENT_EVENTS_KEEPALIVE", "15"))
+PAYMENT_PHONE_BURST = float(os.getenv("PAYMENT_PHONE_BURST", "3"))
+PAYMENT_PHONE_PER_MINUTE = float(os.getenv("PAYMENT_PHONE_PER_MINUTE", "2"))
+PAYMENT_USER_BURST = float(os.getenv("PAYMENT_USER_BURST", "5"))
+PAYMENT_USER_PER_MINUTE = float(os.getenv("PAYMENT_USER_PER_MINUTE", "5"))
+# Also enforce the limits across workers through rate_limit_buckets (Postgres only)
+PAYMENT_THROTTLE_SHARED = os.getenv("PAYMENT_THROTTLE_SHARED", "false").lower() == "true"
+TERMINAL_TRANSACTION_STATUSES = {
+    models.TransactionStatus.ACCEPTED,
+    models.TransactionStatus.REJECTED,
+    models.TransactionStatus.CANCELED,
+    # A late callback can still resolve it, which drops the cached status again
+    models.TransactionStatus.EXPIRED,
+}
+
+# (user_id, terminal payment status) keyed by order_id, dropped on every payment event for the order
+payment_status_cache = TTLCache(maxsize=50000, ttl=PAYMENT_STATUS_CACHE_TTL)
+# One upstream STK query per CheckoutRequestID at a time
+payment_status_queries = SingleFlight()
+# Repeated STK pushes get the short code throttled by Safaricom for everyone
+user_payment_limiter = TokenBucketLimiter("user", PAYMENT_USER_BURST, PAYMENT_USER_PER_MINUTE / 60, PAYMENT_THROTTLE_SHARED)
+phone_payment_limiter = TokenBucketLimiter("phone", PAYMENT_PHONE_BURST, PAYMENT_PHONE_PER_MINUTE / 60, PAYMENT_THROTTLE_SHARED)
+
+
+def drop_payment_status(keys: List[str]) -> None:
+    for key in keys:
+        if key.startswith("order:"):
+            payment_status_cache.pop(int(key.removeprefix("order:")))
+
+
+async def resync_payment_status() -> None:
+    # Payment events from other workers may have been missed while not listening
+    payment_status_cache.clear()
+
+
+payment_events.on_change(drop_payment_status)
+
 def require_admin(user: user_dependency):
     if user.get("role") != Role.ADMIN:
         raise HTTPException(status_code=403, detail="Admin access required")
     return user
 
+PAGINATION_TIMESTAMPS = [("products", "created_at"), ("orders", "datetime")]
+
+async def column_nullable(conn, table: str, column: str) -> bool:
+    if conn.dialect.name == "postgresql":
+        return await conn.scalar(text(
+            "SELECT is_nullable = 'YES' FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND table_name = :table AND column_name = :column"
+        ), {"table": table, "column": column})
+    result = await conn.execute(text(f"PRAGMA table_info({table})"))
+    return any(row.name == column and not row.notnull for row in result)
+
+async def require_pagination_timestamps(conn):
+    """Backfill and require the keyset pagination timestamps on tables from before they were required
+
+    Only columns still nullable are touched, so the table scan and the ACCESS EXCLUSIVE
+    lock of SET NOT NULL happen once rather than on every start. SQLite cannot add the
+    constraint, so an old SQLite table only gets the indexed backfill on each start.
+    """
+    for table, column in PAGINATION_TIMESTAMPS:
+        if not await column_nullable(conn, table, column):
+            continue
+        # Rows without a timestamp get the oldest one in their table, so they sort after everything else
+        await conn.execute(text(
+            f"UPDATE {table} SET {column} = COALESCE((SELECT MIN({column}) FROM {table}), CURRENT_TIMESTAMP) "
+            f"WHERE {column} IS NULL"
+        ))
+        if conn.dialect.name == "postgresql":
+            await conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL"))
+        logger.info(f"Backfilled {table}.{column} for keyset pagination")
+
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await require_pagination_timestamps(conn)
+        if conn.dialect.name == "postgresql":
+            # create_all does not add values to an existing enum type
+            for value in [s.value for s in models.TransactionStatus]:
+                await conn.execute(text(f"ALTER TYPE transactionstatus ADD VALUE IF NOT EXISTS '{value}'"))
+            # Nor columns to an existing table
+            await conn.execute(text(
+                "ALTER TABLE transactions ADD COLUMN IF NOT EXISTS payout_batch_id INTEGER REFERENCES payout_batches(id)"
+            ))
+            await conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_transactions_payout_batch_id ON transactions (payout_batch_id)"
+            ))
+            # Nor indexes to an existing table
+            for name, table, columns in [
+                ("ix_products_created_at_id", "products", "created_at, id"),
+                ("ix_products_user_id_created_at_id", "products", "user_id, created_at, id"),
+                ("ix_orders_datetime_order_id", "orders", "datetime, order_id"),
+                ("ix_orders_user_id_datetime_order_id", "orders", "user_id, datetime, order_id"),
+                ("ix_transactions_status_created_at", "transactions", "_status, created_at"),
+            ]:
+                await conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})"))
+            await create_search_indexes(conn)
     logger.info("Database tables created successfully")
 
 @app.post("/upload-image", response_model=ImageResponse, status_code=status.HTTP_201_CREATED)
@@ -91,54 +266,86 @@ async def upload_image(user: user_dependency, file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail="Error uploading image")
 
 @app.get("/public/products", response_model=PaginatedProductResponse, status_code=status.HTTP_200_OK)
-async def browse_products(db: db_dependency, search: str = None, page: int = 1, limit: int = 10):
+async def browse_products(
+    request: Request, db: db_dependency,
+    search: str = None, page: int = 1, limit: int = 10, cursor: Optional[str] = None
+):
+    # Taken before the queries, so the page is at least as new as its tag
+    etag = catalog_cache.listing_etag(request)
+    not_modified = catalog_cache.check(request, etag)
+    if not_modified is not None:
+        return not_modified
     try:
         skip = (page - 1) * limit
         query = select(models.Products).options(joinedload(models.Products.category))
         if search:
-            query = query.filter(models.Products.name.ilike(f"%{search}%"))
+            query = query.filter(product_search_filter(search))
             logger.info(f"Product search query: {search}")
         count_query = select(func.count()).select_from(models.Products)
         if search:
-            count_query = count_query.filter(models.Products.name.ilike(f"%{search}%"))
-        count_result = await db.execute(count_query)
-        total = count_result.scalar()
-        query = query.offset(skip).limit(limit)
+            count_query = count_query.filter(product_search_filter(search))
+        total, total_exact = await count_provider.count(
+            db, count_query, ("public_products", search), ["products"], estimate_table=None if search else "products"
+        )
+        ranking = product_search_order(search) if search else []
+        if ranking:
+            # Relevance has no stable key to resume from, so ranked searches page by offset only
+            query = query.order_by(*ranking).offset(skip).limit(limit)
+        else:
+            query = keyset_page(query, models.Products.created_at, models.Products.id, cursor, limit)
+            if not cursor:
+                query = query.offset(skip)
         result = await db.execute(query)
-        products = result.scalars().all()
+        products, next_cursor = next_page(result.scalars().all(), limit, "created_at", "id")
         total_pages = ceil(total / limit)
-        return {
+        page_response = PaginatedProductResponse.model_validate({
             "items": products,
             "total": total,
             "page": page,
             "limit": limit,
-            "pages": total_pages
-        }
+            "pages": total_pages,
+            "next_cursor": next_cursor,
+            "total_exact": total_exact
+        }, from_attributes=True)
+        return catalog_cache.respond(request, page_response.model_dump_json().encode(), etag)
     except SQLAlchemyError as e:
         logger.error(f"Error fetching products: {str(e)}")
         raise HTTPException(status_code=500, detail="Error fetching products")
 
 @app.get("/public/products/{product_id}", response_model=ProductResponse, status_code=status.HTTP_200_OK)
-async def get_product_by_id(product_id: int, db: db_dependency):
+async def get_product_by_id(product_id: int, request: Request):
+    async def load() -> bytes:
+        # Its own session: concurrent requests share this load, which may outlive the first of them
+        async with async_session() as db:
+            result = await db.execute(
+                select(models.Products).filter(models.Products.id == product_id).options(joinedload(models.Products.category))
+            )
+            product = result.scalars().first()
+            if not product:
+                logger.info(f"Product not found: ID {product_id}")
+                raise HTTPException(status_code=404, detail="Product not found")
+            return ProductResponse.model_validate(product, from_attributes=True).model_dump_json().encode()
+
     try:
-        result = await db.execute(
-            select(models.Products).filter(models.Products.id == product_id).options(joinedload(models.Products.category))
-        )
-        product = result.scalars().first()
-        if not product:
-            logger.info(f"Product not found: ID {product_id}")
-            raise HTTPException(status_code=404, detail="Product not found")
-        return product
+        body = await catalog_cache.get_or_load(product_key(product_id), load)
+        return catalog_cache.respond(request, body)
     except SQLAlchemyError as e:
         logger.error(f"Error fetching product by ID {product_id}: {str(e)}")
         raise HTTPException(status_code=500, detail="Error fetching product")
 
+category_list_adapter = TypeAdapter(List[CategoryResponse])
+
 @app.get("/public/categories", response_model=List[CategoryResponse], status_code=status.HTTP_200_OK)
-async def browse_categories(db: db_dependency):
+async def browse_categories(request: Request):
+    async def load() -> bytes:
+        async with async_session() as db:
+            result = await db.execute(select(models.Categories))
+            categories = category_list_adapter.validate_python(result.scalars().all(), from_attributes=True)
+            return category_list_adapter.dump_json(categories)
+
     try:
-        result = await db.execute(select(models.Categories))
-        categories = result.scalars().all()
-        return categories
+        body = await catalog_cache.get_or_load(CATEGORIES_KEY, load)
+        return catalog_cache.respond(request, body)
     except SQLAlchemyError as e:
         logger.error(f"Error fetching categories: {str(e)}")
         raise HTTPException(status_code=500, detail="Error fetching categories")
@@ -149,6 +356,7 @@ async def create_category(user: user_dependency, db: db_dependency, category: Ca
     try:
         db_category = models.Categories(**category.dict())
         db.add(db_category)
+        await catalog_cache.invalidate(db, CATEGORIES_KEY)
         await db.commit()
         await db.refresh(db_category)
         return db_category
@@ -163,6 +371,8 @@ async def add_product(user: user_dependency, db: db_dependency, create_product:
     try:
         add_product = models.Products(**create_product.dict(), user_id=user.get("id"))
         db.add(add_product)
+        # A new product changes the listings, whose tags follow the catalog version
+        await catalog_cache.invalidate(db)
         await db.commit()
         await db.refresh(add_product)
         return {"message": "Product added successfully"}
@@ -172,29 +382,39 @@ async def add_product(user: user_dependency, db: db_dependency, create_product:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/products", response_model=PaginatedProductResponse, status_code=status.HTTP_200_OK)
-async def fetch_products(user: user_dependency, db: db_dependency, search: str = None, page: int = 1, limit: int = 10):
+async def fetch_products(user: user_dependency, db: db_dependency, search: str = None, page: int = 1, limit: int = 10, cursor: Optional[str] = None):
     require_admin(user)
     try:
         skip = (page - 1) * limit
         query = select(models.Products).filter(models.Products.user_id == user.get("id")).options(joinedload(models.Products.category))
         if search:
-            query = query.filter(models.Products.name.ilike(f"%{search}%"))
+            query = query.filter(product_search_filter(search))
             logger.info(f"Admin product search query: {search}")
         count_query = select(func.count()).select_from(models.Products).filter(models.Products.user_id == user.get("id"))
         if search:
-            count_query = count_query.filter(models.Products.name.ilike(f"%{search}%"))
-        count_result = await db.execute(count_query)
-        total = count_result.scalar()
-        query = query.offset(skip).limit(limit)
+            count_query = count_query.filter(product_search_filter(search))
+        total, total_exact = await count_provider.count(
+            db, count_query, ("seller_products", user.get("id"), search), ["products"]
+        )
+        ranking = product_search_order(search) if search else []
+        if ranking:
+            # Relevance has no stable key to resume from, so ranked searches page by offset only
+            query = query.order_by(*ranking).offset(skip).limit(limit)
+        else:
+            query = keyset_page(query, models.Products.created_at, models.Products.id, cursor, limit)
+            if not cursor:
+                query = query.offset(skip)
         result = await db.execute(query)
-        products = result.scalars().all()
+        products, next_cursor = next_page(result.scalars().all(), limit, "created_at", "id")
         total_pages = ceil(total / limit)
         return {
             "items": products,
             "total": total,
             "page": page,
             "limit": limit,
-            "pages": total_pages
+            "pages": total_pages,
+            "next_cursor": next_cursor,
+            "total_exact": total_exact
         }
     except SQLAlchemyError as e:
         logger.error(f"Error fetching products: {str(e)}")
@@ -216,6 +436,7 @@ async def update_product(product_id: int, updated_data: UpdateProduct, user: use
         update_dict = updated_data.dict(exclude_unset=True)
         for key, value in update_dict.items():
             setattr(product, key, value)
+        await catalog_cache.invalidate(db, product_key(product_id))
         await db.commit()
         await db.refresh(product)
         return {"message": "Product updated successfully"}
@@ -244,6 +465,7 @@ async def delete_product(product_id: int, db: db_dependency, user: user_dependen
         if order_details:
             raise HTTPException(status_code=400, detail="Cannot delete product with existing orders")
         await db.delete(product)
+        await catalog_cache.invalidate(db, product_key(product_id))
         await db.commit()
         return {"message": "Product deleted successfully"}
     except SQLAlchemyError as e:
@@ -253,7 +475,18 @@ async def delete_product(product_id: int, db: db_dependency, user: user_dependen
 
 # FIXED: Single create_order endpoint with proper transaction handling
 @app.post("/create_order", status_code=status.HTTP_201_CREATED)
-async def create_order(db: db_dependency, user: user_dependency, order_payload: CartPayload):
+async def create_order(
+    db: db_dependency,
+    user: user_dependency,
+    order_payload: CartPayload,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    return await idempotency_store.run(
+        idempotency_key, user.get("id"), "create_order", order_payload,
+        lambda: place_order(db, user, order_payload)
+    )
+
+async def place_order(db: AsyncSession, user: dict, order_payload: CartPayload):
     logger.info(f"Starting order creation for user {user.get('id')}")
     
     try:
@@ -336,6 +569,9 @@ async def create_order(db: db_dependency, user: user_dependency, order_payload:
         new_order.total = total_cost + new_order.delivery_fee
         logger.info(f"Order total: {new_order.total}")
 
+        # Stock levels changed
+        await catalog_cache.invalidate(db, *[product_key(product_id) for product_id in products])
+
         # Commit the transaction
         await db.commit()
         logger.info(f"Order {new_order.order_id} created successfully for user {user.get('id')}")
@@ -368,7 +604,8 @@ async def fetch_orders(
     db: db_dependency,
     skip: int = Query(0, ge=0),
     limit: int = Query(10, ge=1, le=100),
-    status: Optional[OrderStatus] = None
+    status: Optional[OrderStatus] = None,
+    cursor: Optional[str] = None
 ):
     try:
         query = select(models.Orders).filter(models.Orders.user_id == user.get("id"))
@@ -378,17 +615,19 @@ async def fetch_orders(
         count_query = select(func.count()).select_from(models.Orders).filter(models.Orders.user_id == user.get("id"))
         if status:
             count_query = count_query.filter(models.Orders.status == status)
-        count_result = await db.execute(count_query)
-        total = count_result.scalar()
+        total, total_exact = await count_provider.count(db, count_query, ("customer_orders", user.get("id"), status), ["orders"])
 
         query = query.options(
             joinedload(models.Orders.user),
             joinedload(models.Orders.order_details).joinedload(models.OrderDetails.product).joinedload(models.Products.category),
             joinedload(models.Orders.address)
-        ).offset(skip).limit(limit)
+        )
+        query = keyset_page(query, models.Orders.datetime, models.Orders.order_id, cursor, limit)
+        if not cursor:
+            query = query.offset(skip)
 
         result = await db.execute(query)
-        orders = result.unique().scalars().all()
+        orders, next_cursor = next_page(result.unique().scalars().all(), limit, "datetime", "order_id")
 
         page = (skip // limit) + 1
         pages = ceil(total / limit) if limit > 0 else 0
@@ -397,7 +636,9 @@ async def fetch_orders(
             "total": total,
             "page": page,
             "limit": limit,
-            "pages": pages
+            "pages": pages,
+            "next_cursor": next_cursor,
+            "total_exact": total_exact
         }
     except SQLAlchemyError as e:
         await db.rollback()
@@ -557,7 +798,8 @@ async def fetch_all_orders(
     skip: int = Query(0, ge=0),
     limit: int = Query(10, ge=1, le=100),
     status: Optional[OrderStatus] = None,
-    search: Optional[str] = None
+    search: Optional[str] = None,
+    cursor: Optional[str] = None
 ):
     require_admin(user)
     try:
@@ -584,13 +826,18 @@ async def fetch_all_orders(
                     models.Address.last_name.ilike(f"%{search}%")
                 )
             )
-        count_result = await db.execute(count_query)
-        total = count_result.scalar()
+        total, total_exact = await count_provider.count(
+            db, count_query, ("admin_orders", status, search), ["orders", "users", "addresses"],
+            estimate_table=None if status or search else "orders"
+        )
 
-        query = query.options(joinedload(models.Orders.address), joinedload(models.Orders.user)).offset(skip).limit(limit)
+        query = query.options(joinedload(models.Orders.address), joinedload(models.Orders.user))
+        query = keyset_page(query, models.Orders.datetime, models.Orders.order_id, cursor, limit)
+        if not cursor:
+            query = query.offset(skip)
 
         result = await db.execute(query)
-        orders = result.unique().scalars().all()
+        orders, next_cursor = next_page(result.unique().scalars().all(), limit, "datetime", "order_id")
 
         page = (skip // limit) + 1
         pages = ceil(total / limit) if limit > 0 else 0
@@ -601,7 +848,9 @@ async def fetch_all_orders(
             "total": total,
             "page": page,
             "limit": limit,
-            "pages": pages
+            "pages": pages,
+            "next_cursor": next_cursor,
+            "total_exact": total_exact
         }
     except SQLAlchemyError as e:
         logger.error(f"Error fetching all orders: {str(e)}")
@@ -640,6 +889,8 @@ async def update_order_status(
         elif order.completed_at and request.status.value != "delivered":
             order.completed_at = None
 
+        # Committed together with the status so downstream systems never miss a change
+        await add_outbox_events(db, [(ORDER_STATUS_CHANGED, order_id, {"order_id": order_id, "status": order.status.value})])
         await db.commit()
         await db.refresh(order)
 
@@ -664,9 +915,57 @@ async def update_order_status(
 async def initiate_payment(
     request: InitiatePaymentRequest,
     user: user_dependency,
-    db: db_dependency
+    db: db_dependency,
+    lnmo_repo: lnmo_dependency,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
+    # A retry of a request that already went through is replayed whatever the limits say
+    replayed = idempotency_store.cached(idempotency_key, user.get("id"), "initiate_payment", request)
+    if replayed is not None:
+        return replayed
+    # Checked before the idempotency claim, so a throttled request costs no DB work
+    await throttle_payment(user.get("id"), request.phone_number)
+    started = False
+
+    async def handler():
+        nonlocal started
+        started = True
+        return await start_payment(db, user, request, lnmo_repo)
+
+    try:
+        return await idempotency_store.run(idempotency_key, user.get("id"), "initiate_payment", request, handler)
+    finally:
+        if not started:
+            # A replay or a joined duplicate pushed no prompt, so it gives its tokens back
+            await refund_payment_tokens(user.get("id"), request.phone_number)
+
+def normalize_phone(phone_number: str) -> str:
+    digits = "".join(ch for ch in phone_number if ch.isdigit())
+    return f"254{digits[1:]}" if digits.startswith("0") else digits
+
+async def throttle_payment(user_id: int, phone_number: str) -> None:
+    """Reject repeated STK pushes before any DB or Daraja work"""
+    wait = await user_payment_limiter.acquire(str(user_id))
+    if not wait:
+        wait = await phone_payment_limiter.acquire(normalize_phone(phone_number))
+        if wait:
+            # The user's attempt never happened, so it must not count against them
+            await user_payment_limiter.refund(str(user_id))
+    if wait:
+        logger.warning(f"Payment attempt throttled for user {user_id}, retry in {wait:.0f}s")
+        raise HTTPException(
+            status_code=429,
+            detail="Too many payment attempts, please wait before trying again",
+            headers={"Retry-After": str(max(ceil(wait), 1))}
+        )
+
+async def refund_payment_tokens(user_id: int, phone_number: str) -> None:
+    await user_payment_limiter.refund(str(user_id))
+    await phone_payment_limiter.refund(normalize_phone(phone_number))
+
+async def start_payment(db: AsyncSession, user: dict, request: InitiatePaymentRequest, lnmo_repo: LNMORepository):
     try:
+        LNMORepository.ensure_available()
         # Validate that the order exists and belongs to the user
         result = await db.execute(
             select(models.Orders).filter(
@@ -708,8 +1007,11 @@ async def initiate_payment(
                 detail=f"Payment already initiated for this order. Transaction ID: {existing_transaction.transaction_id}"
             )
         
-        # Initialize LNMO repository
-        lnmo_repo = LNMORepository()
+        # Orders of a seller with its own paybill are paid to that short code
+        lnmo_repo = await shortcode_registry.for_order(db, order.order_id) or lnmo_repo
+        
+        # End the read transaction so no pooled connection is held during the Daraja call
+        await db.commit()
         
         # Prepare data for transact with unique _pid
         unique_pid = f"ORDER-{request.order_id}-{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
@@ -724,6 +1026,8 @@ async def initiate_payment(
         
         # Initiate payment with M-Pesa
         payment_response = await lnmo_repo.transact(transact_data, db)
+        # A new attempt supersedes any status cached for the order, in every worker
+        await payment_events.notify(db, event_keys(request.order_id), None)
         
         # Update order with payment reference
         order.payment_reference = payment_response.get('CheckoutRequestID')
@@ -737,6 +1041,14 @@ async def initiate_payment(
         
     except HTTPException as e:
         raise
+    except DarajaUnavailable as e:
+        await db.rollback()
+        logger.warning(f"Payment for order {request.order_id} rejected: {str(e)}")
+        raise HTTPException(
+            status_code=503,
+            detail="Payment service temporarily unavailable",
+            headers={"Retry-After": str(e.retry_after)}
+        )
     except Exception as e:
         await db.rollback()
         logger.error(f"Error initiating payment: {str(e)}")
@@ -788,14 +1100,24 @@ async def payment_callback(request: Request, db: db_dependency):
 
 
 @app.post("/ipn/daraja/lnmo/callback", status_code=status.HTTP_200_OK)
-async def payment_callback(request: Request, db: db_dependency):
+async def payment_callback(request: Request, db: db_dependency, lnmo_repo: lnmo_dependency):
+    if MPESA_CALLBACK_MODE == "inbox":
+        # Store the raw body and ack at once; the inbox worker applies it
+        lnmo_repo.ensure_trusted_source(request)
+        try:
+            await enqueue_callback(db, await request.body())
+            return {"message": "Callback received"}
+        except Exception as e:
+            await db.rollback()
+            logger.error(f"Error storing payment callback: {str(e)}")
+            raise HTTPException(status_code=500, detail="Error storing callback")
+
     try:
         # Parse the callback data
         callback_data = await request.json()
         logger.info(f"Payment callback received: {callback_data}")
         
         # Process callback with LNMORepository
-        lnmo_repo = LNMORepository()
         response = await lnmo_repo.callback(callback_data, request, db)
         
         return {"message": "Callback processed successfully"}
@@ -805,45 +1127,56 @@ async def payment_callback(request: Request, db: db_dependency):
         return {"message": "Error processing callback"}
 
 @app.get("/check_payment_status/{order_id}", response_model=PaymentStatusResponse, status_code=status.HTTP_200_OK)
-async def check_payment_status(order_id: int, user: user_dependency, db: db_dependency):
+async def check_payment_status(order_id: int, user: user_dependency, db: db_dependency, lnmo_repo: lnmo_dependency):
+    cached = payment_status_cache.get(order_id)
+    if cached and cached[0] == user.get("id"):
+        return {"status": cached[1]}
     try:
-        # Validate order exists and belongs to the user
+        # Latest transaction for the order, scoped to the user, in one query
         result = await db.execute(
-            select(models.Orders).filter(
-                models.Orders.order_id == order_id,
-                models.Orders.user_id == user.get("id")
+            select(
+                models.Transaction.transaction_id,
+                models.Transaction._status,
+                models.Transaction.created_at,
+                models.Transaction.party_b,
             )
+            .join(models.Orders, models.Orders.order_id == models.Transaction.order_id)
+            .where(models.Transaction.order_id == order_id, models.Orders.user_id == user.get("id"))
+            .order_by(models.Transaction.created_at.desc())
+            .limit(1)
         )
-        order = result.scalars().first()
-        
-        if not order:
-            logger.info(f"Order not found: ID {order_id} for user {user.get('id')}")
-            raise HTTPException(status_code=404, detail="Order not found")
-        
-        # Find the transaction associated with the order
-        result = await db.execute(
-            select(models.Transaction).where(models.Transaction.order_id == order_id)
-        )
-        transaction = result.scalars().first()
+        transaction = result.first()
         
         if not transaction:
+            result = await db.execute(
+                select(models.Orders.order_id).filter(
+                    models.Orders.order_id == order_id,
+                    models.Orders.user_id == user.get("id")
+                )
+            )
+            if result.first() is None:
+                logger.info(f"Order not found: ID {order_id} for user {user.get('id')}")
+                raise HTTPException(status_code=404, detail="Order not found")
             logger.info(f"No transaction found for order {order_id}")
             raise HTTPException(status_code=404, detail="Transaction not found")
         
-        # Query transaction status using LNMORepository
-        lnmo_repo = LNMORepository()
-        response_data = await lnmo_repo.query(transaction.transaction_id, db)
-        result_code = response_data.get("ResultCode")
-        
-        # Map M-Pesa result codes to frontend-expected statuses
-        if result_code == "0":
-            status = "ACCEPTED"
-        elif result_code == "1032":
-            status = "CANCELED"
-        else:
-            status = "REJECTED"
+        transaction_status = transaction._status
+        age = (datetime.utcnow() - transaction.created_at).total_seconds()
+        if transaction_status == models.TransactionStatus.PENDING and age >= PAYMENT_STATUS_QUERY_MIN_AGE:
+            # Release the connection while Daraja is queried
+            await db.rollback()
+            # Queried with the credentials of the short code it was paid to
+            lnmo_repo = shortcode_registry.for_short_code(transaction.party_b) or lnmo_repo
+            try:
+                transaction_status = await payment_status_queries.do(
+                    transaction.transaction_id, lambda: sync_payment_status(lnmo_repo, transaction.transaction_id)
+                )
+            except Exception as e:
+                logger.error(f"Error querying payment status for order {order_id}: {str(e)}")
         
-        return {"status": status}
+        if transaction_status in TERMINAL_TRANSACTION_STATUSES:
+            payment_status_cache.set(order_id, (user.get("id"), transaction_status.value))
+        return {"status": transaction_status.value}
         
     except HTTPException as e:
         raise
@@ -852,6 +1185,73 @@ async def check_payment_status(order_id: int, user: user_dependency, db: db_depe
         raise HTTPException(status_code=500, detail="Error checking payment status")
     
 
+@app.get("/payment_events/{order_id}", status_code=status.HTTP_200_OK)
+async def payment_events_stream(order_id: int, request: Request, user: user_dependency, db: db_dependency):
+    """Server-Sent Events stream that pushes the order's payment status once it is final"""
+    keys = event_keys(order_id)
+    # Subscribe before reading so a callback landing in between is not missed
+    waiter = payment_events.subscribe(*keys)
+    try:
+        result = await db.execute(
+            select(models.Orders.order_id, models.Transaction._status)
+            .outerjoin(models.Transaction, models.Transaction.order_id == models.Orders.order_id)
+            .where(models.Orders.order_id == order_id, models.Orders.user_id == user.get("id"))
+            .order_by(models.Transaction.created_at.desc())
+            .limit(1)
+        )
+        order = result.first()
+        # Waiting must not hold a pooled connection
+        await db.close()
+    except SQLAlchemyError as e:
+        payment_events.unsubscribe(waiter, *keys)
+        logger.error(f"Error opening payment events for order {order_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error checking payment status")
+    if not order:
+        payment_events.unsubscribe(waiter, *keys)
+        raise HTTPException(status_code=404, detail="Order not found")
+
+    def status_event(payment_status: str) -> str:
+        return f"event: status\ndata: {json.dumps({'order_id': order_id, 'status': payment_status})}\n\n"
+
+    async def stream():
+        try:
+            current = order._status.value if order._status else models.TransactionStatus.PENDING.value
+            yield status_event(current)
+            if order._status in TERMINAL_TRANSACTION_STATUSES:
+                return
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + PAYMENT_EVENTS_TIMEOUT
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    yield "event: timeout\ndata: {}\n\n"
+                    return
+                try:
+                    payment_status = await asyncio.wait_for(
+                        asyncio.shield(waiter), timeout=min(PAYMENT_EVENTS_KEEPALIVE, remaining)
+                    )
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                yield status_event(payment_status)
+                return
+        finally:
+            payment_events.unsubscribe(waiter, *keys)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def sync_payment_status(lnmo_repo: LNMORepository, transaction_id: str) -> models.TransactionStatus:
+    async with async_session() as session:
+        return await lnmo_repo.sync_status(transaction_id, session)
+
+
 # Add payment status check endpoint
 @app.get("/payment_status/{order_id}", response_model=PaymentStatusResponse, status_code=status.HTTP_200_OK)
 async def check_payment_status(order_id: int, user: user_dependency, db: db_dependency):
@@ -879,6 +1279,36 @@ async def check_payment_status(order_id: int, user: user_dependency, db: db_depe
         raise HTTPException(status_code=500, detail="Error checking payment status")
 
 
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    """Prometheus scrape endpoint, aggregated over all workers when PROMETHEUS_MULTIPROC_DIR is set"""
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+
+@app.get("/admin/stats", status_code=status.HTTP_200_OK)
+async def payment_stats(user: user_dependency):
+    require_admin(user)
+    return {
+        "daraja_token": LNMORepository.token_stats(),
+        "callback_inbox": callback_inbox_worker.stats(),
+        "orphan_callbacks": orphan_callbacks.stats(),
+        "reconciler": pending_reconciler.stats(),
+        "payment_status_cache": {**payment_status_cache.stats(), "shared_queries": payment_status_queries.shared},
+        "payment_events": {**payment_events.stats(), "pg_listening": pg_notifier.listening, "pg_reconnects": pg_notifier.reconnects},
+        "idempotency": idempotency_store.stats(),
+        "daraja_upstream": LNMORepository.upstream_stats(),
+        "payouts": payout_dispatcher.stats(),
+        "c2b": c2b_writer.stats(),
+        "shortcodes": shortcode_registry.stats(),
+        "webhooks": webhook_dispatcher.stats(),
+        "expiry_sweeper": expiry_sweeper.stats(),
+        "counts": count_provider.stats(),
+        "catalog_cache": catalog_cache.stats(),
+        "payment_throttle": {"user": user_payment_limiter.stats(), "phone": phone_payment_limiter.stats()},
+    }
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,109 @@
+import functools
+import os
+import time
+from typing import Any, Tuple
+
+try:
+    from prometheus_client import (
+        CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess,
+    )
+    PROMETHEUS_AVAILABLE = True
+except ImportError:
+    PROMETHEUS_AVAILABLE = False
+
+# Set for every uvicorn/gunicorn worker (and wiped before start) to aggregate across processes
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# Daraja answers in tens of milliseconds to tens of seconds
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1, 1.5, 2.5, 5, 10, 20, 30, 60)
+
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs) -> "_NoopMetric":
+        return self
+
+    def inc(self, amount: float = 1) -> None:
+        pass
+
+    def dec(self, amount: float = 1) -> None:
+        pass
+
+    def observe(self, amount: float) -> None:
+        pass
+
+
+if PROMETHEUS_AVAILABLE:
+    operation_seconds = Histogram(
+        "mpesa_operation_duration_seconds",
+        "Time spent in an M-Pesa operation, our work included",
+        ["operation"],
+        buckets=LATENCY_BUCKETS,
+    )
+    operation_in_flight = Gauge(
+        "mpesa_operation_in_flight",
+        "M-Pesa operations currently running",
+        ["operation"],
+        multiprocess_mode="livesum",
+    )
+    operation_results = Counter(
+        "mpesa_operation_results_total",
+        "M-Pesa operations by Daraja result code or HTTP status",
+        ["operation", "result_code"],
+    )
+    operation_errors = Counter(
+        "mpesa_operation_errors_total",
+        "M-Pesa operations that raised, by exception class",
+        ["operation", "error"],
+    )
+    upstream_seconds = Histogram(
+        "daraja_http_request_duration_seconds",
+        "Time Daraja took to answer one HTTP request",
+        ["endpoint", "status"],
+        buckets=LATENCY_BUCKETS,
+    )
+else:
+    operation_seconds = operation_in_flight = operation_results = operation_errors = upstream_seconds = _NoopMetric()
+
+
+def timed(operation: str):
+    """Time an async operation and keep its in-flight gauge; exceptions are counted by class"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            operation_in_flight.labels(operation).inc()
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                operation_errors.labels(operation, type(e).__name__).inc()
+                raise
+            finally:
+                operation_seconds.labels(operation).observe(time.perf_counter() - started)
+                operation_in_flight.labels(operation).dec()
+        return wrapper
+    return decorator
+
+
+def count_result(operation: str, result_code: Any) -> None:
+    operation_results.labels(operation, str(result_code)).inc()
+
+
+def observe_upstream(endpoint: str, status: str, seconds: float) -> None:
+    upstream_seconds.labels(endpoint, status).observe(seconds)
+
+
+def render() -> Tuple[bytes, str]:
+    """The exposition body and content type for /metrics"""
+    if not PROMETHEUS_AVAILABLE:
+        return b"# prometheus_client is not installed\n", "text/plain; charset=utf-8"
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead() -> None:
+    """Drop this worker's live gauges from the shared directory on shutdown"""
+    if PROMETHEUS_AVAILABLE and PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(os.getpid())
@@ -1 +1 @@
-from .models import Users, Role, TransactionStatus, OrderStatus, Categories, Products, Orders, OrderDetails, Address, Transaction
\ No newline at end of file
+from .models import Users, Role, TransactionStatus, OrderStatus, Categories, Products, Orders, OrderDetails, Address, Transaction, PayoutBatch, CallbackInbox, IdempotencyKey, OutboxEvent, Webhook, WebhookDelivery, RateLimitBucket, OrphanCallback, catalog_version_seq
\ No newline at end of file
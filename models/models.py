@@ -1,5 +1,5 @@
 #models
-from sqlalchemy import Column, Integer, String, func, DateTime, Numeric, ForeignKey, Enum, Boolean, Text
+from sqlalchemy import Column, Integer, String, func, DateTime, Numeric, ForeignKey, Enum, Boolean, Text, Index, UniqueConstraint, Float, Sequence
 from database import Base
 from sqlalchemy.orm import relationship
 import enum
@@ -12,6 +12,9 @@ class TransactionStatus(enum.Enum):
   PROCESSED = "PROCESSED"
   REJECTED = "REJECTED"
   ACCEPTED = "ACCEPTED"
+  CANCELED = "CANCELED"
+  EXPIRED = "EXPIRED"
+  UNKNOWN = "UNKNOWN"
 
 class Role(enum.Enum):
     ADMIN = "admin"
@@ -57,7 +60,7 @@ class Products(Base):
     img_url = Column(String(200), nullable=True)
     stock_quantity = Column(Numeric(precision=14, scale=2), nullable=False)
     description = Column(String(200), nullable=True)  # New description field
-    created_at = Column(DateTime, default=func.now())
+    created_at = Column(DateTime, default=func.now(), nullable=False)
     barcode = Column(Numeric(precision=12), unique=True)
     user_id = Column(Integer, ForeignKey('users.id'))
     category_id = Column(Integer, ForeignKey('categories.id'))
@@ -66,11 +69,17 @@ class Products(Base):
     category = relationship("Categories", back_populates="products")
     order_details = relationship("OrderDetails", back_populates="product")
 
+    # Keyset pagination, newest first
+    __table_args__ = (
+        Index('ix_products_created_at_id', 'created_at', 'id'),
+        Index('ix_products_user_id_created_at_id', 'user_id', 'created_at', 'id'),
+    )
+
 class Orders(Base):
     __tablename__ = "orders"
     order_id = Column(Integer, primary_key=True, index=True)
     total = Column(Numeric(precision=14, scale=2))
-    datetime = Column(DateTime, default=func.now(), index=True)
+    datetime = Column(DateTime, default=func.now(), nullable=False, index=True)
     status = Column(Enum(OrderStatus), default=OrderStatus.PENDING, nullable=False)
     user_id = Column(Integer, ForeignKey('users.id'))
     address_id = Column(Integer, ForeignKey('addresses.id'), nullable=True)
@@ -81,6 +90,12 @@ class Orders(Base):
     address = relationship("Address")
     transactions = relationship("Transaction", back_populates="order")
 
+    # Keyset pagination, newest first
+    __table_args__ = (
+        Index('ix_orders_datetime_order_id', 'datetime', 'order_id'),
+        Index('ix_orders_user_id_datetime_order_id', 'user_id', 'datetime', 'order_id'),
+    )
+
 
 class OrderDetails(Base):
     __tablename__ = "order_details"
@@ -133,6 +148,155 @@ class Transaction(Base):
     updated_at = Column(DateTime, onupdate=func.now())
     user_id = Column(Integer, ForeignKey('users.id'))
     order_id = Column(Integer, ForeignKey('orders.order_id'), nullable=True)
+    payout_batch_id = Column(Integer, ForeignKey('payout_batches.id'), nullable=True, index=True)
     
     user = relationship("Users", back_populates="transactions")
-    order = relationship("Orders", back_populates="transactions")
\ No newline at end of file
+    order = relationship("Orders", back_populates="transactions")
+    payout_batch = relationship("PayoutBatch", back_populates="transactions")
+
+    __table_args__ = (
+        # Serves the reconciler's scan for old PENDING rows
+        Index('ix_transactions_status_created_at', '_status', 'created_at'),
+    )
+
+
+class PayoutBatch(Base):
+    __tablename__ = 'payout_batches'
+
+    id = Column(Integer, primary_key=True, index=True)
+    reference = Column(String(100), unique=True, nullable=False)
+    source = Column(String(20), nullable=False, default="api")
+    total_count = Column(Integer, nullable=False)
+    total_amount = Column(Numeric(14, 2), nullable=False)
+    created_by = Column(Integer, ForeignKey('users.id'), nullable=False)
+    created_at = Column(DateTime, default=func.now(), nullable=False)
+
+    transactions = relationship("Transaction", back_populates="payout_batch")
+
+
+class CallbackInbox(Base):
+    __tablename__ = 'callback_inbox'
+
+    id = Column(Integer, primary_key=True, index=True)
+    source = Column(String(50), nullable=False, default="lnmo")
+    payload = Column(Text, nullable=False)
+    received_at = Column(DateTime, default=func.now(), nullable=False)
+    processed_at = Column(DateTime, nullable=True)
+    attempts = Column(Integer, default=0, nullable=False)
+    last_error = Column(Text, nullable=True)
+
+    __table_args__ = (
+        Index(
+            'ix_callback_inbox_unprocessed', 'id',
+            postgresql_where=processed_at.is_(None),
+            sqlite_where=processed_at.is_(None),
+        ),
+    )
+
+
+class IdempotencyKey(Base):
+    __tablename__ = 'idempotency_keys'
+
+    id = Column(Integer, primary_key=True, index=True)
+    key = Column(String(255), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    endpoint = Column(String(100), nullable=False)
+    request_hash = Column(String(64), nullable=False)
+    response_body = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=func.now(), nullable=False)
+    completed_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint('user_id', 'endpoint', 'key', name='uq_idempotency_keys_scope'),
+    )
+
+
+class OutboxEvent(Base):
+    __tablename__ = 'outbox_events'
+
+    id = Column(Integer, primary_key=True, index=True)
+    event_type = Column(String(50), nullable=False)
+    aggregate_id = Column(String(100), nullable=False)
+    payload = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=func.now(), nullable=False)
+    # Set once a delivery row exists for every webhook subscribed to the event
+    dispatched_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index(
+            'ix_outbox_events_undispatched', 'id',
+            postgresql_where=dispatched_at.is_(None),
+            sqlite_where=dispatched_at.is_(None),
+        ),
+    )
+
+
+class Webhook(Base):
+    __tablename__ = 'webhooks'
+
+    id = Column(Integer, primary_key=True, index=True)
+    url = Column(String(500), nullable=False)
+    secret = Column(String(255), nullable=True)
+    # Comma separated event types, or * for all of them
+    event_types = Column(String(255), nullable=False, default="*")
+    max_concurrency = Column(Integer, nullable=False, default=4)
+    active = Column(Boolean, nullable=False, default=True)
+    created_by = Column(Integer, ForeignKey('users.id'), nullable=True)
+    created_at = Column(DateTime, default=func.now(), nullable=False)
+
+
+class WebhookDelivery(Base):
+    __tablename__ = 'webhook_deliveries'
+
+    id = Column(Integer, primary_key=True, index=True)
+    webhook_id = Column(Integer, ForeignKey('webhooks.id'), nullable=False)
+    event_id = Column(Integer, ForeignKey('outbox_events.id'), nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime, nullable=False)
+    delivered_at = Column(DateTime, nullable=True)
+    failed_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint('webhook_id', 'event_id', name='uq_webhook_deliveries_event'),
+        Index(
+            'ix_webhook_deliveries_due', 'next_attempt_at',
+            postgresql_where=(delivered_at.is_(None) & failed_at.is_(None)),
+            sqlite_where=(delivered_at.is_(None) & failed_at.is_(None)),
+        ),
+    )
+
+
+class RateLimitBucket(Base):
+    __tablename__ = 'rate_limit_buckets'
+
+    # Limiter name and key, e.g. "phone:254712345678"
+    key = Column(String(150), primary_key=True)
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(DateTime(timezone=True), nullable=False)
+
+
+class OrphanCallback(Base):
+    __tablename__ = 'orphan_callbacks'
+
+    id = Column(Integer, primary_key=True, index=True)
+    # A CheckoutRequestID with no transaction row yet; Daraja resends are dropped
+    checkout_request_id = Column(String(100), nullable=False, unique=True)
+    payload = Column(Text, nullable=False)
+    received_at = Column(DateTime, default=func.now(), nullable=False)
+    replayed_at = Column(DateTime, nullable=True)
+    attempts = Column(Integer, default=0, nullable=False)
+    last_error = Column(Text, nullable=True)
+
+    __table_args__ = (
+        Index(
+            'ix_orphan_callbacks_unreplayed', 'received_at',
+            postgresql_where=replayed_at.is_(None),
+            sqlite_where=replayed_at.is_(None),
+        ),
+    )
+
+
+# Bumped by every catalog write; ETags of public catalog responses are derived from it.
+# A sequence rather than a counter row so concurrent checkouts never queue on one lock.
+catalog_version_seq = Sequence('catalog_version_seq', metadata=Base.metadata)
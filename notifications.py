@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, AsyncSession
+
+logger = logging.getLogger(__name__)
+
+# How often the LISTEN connection is checked, and the longest wait between reconnect attempts
+PG_NOTIFY_CHECK_INTERVAL = float(os.getenv("PG_NOTIFY_CHECK_INTERVAL", "10"))
+PG_NOTIFY_MAX_BACKOFF = float(os.getenv("PG_NOTIFY_MAX_BACKOFF", "30"))
+
+NotificationHandler = Callable[[str], None]
+ResyncHandler = Callable[[], Awaitable[None]]
+
+
+class PgNotifier:
+    """Relays Postgres NOTIFY messages to in-process handlers over one LISTEN connection
+
+    The connection is checked every PG_NOTIFY_CHECK_INTERVAL seconds and replaced when
+    it is lost. Notifications sent meanwhile are gone for good, so once listening again
+    every resync handler runs to bring its local state back in line with the database.
+    """
+
+    def __init__(self, check_interval: float = PG_NOTIFY_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._handlers: Dict[str, List[NotificationHandler]] = defaultdict(list)
+        self._resync_handlers: List[ResyncHandler] = []
+        self._engine: Optional[AsyncEngine] = None
+        self._conn: Optional[AsyncConnection] = None
+        self._driver_conn = None
+        self._lost = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.received = 0
+        self.reconnects = 0
+
+    def subscribe(self, channel: str, handler: NotificationHandler) -> None:
+        self._handlers[channel].append(handler)
+
+    def on_resync(self, handler: ResyncHandler) -> None:
+        """Run `handler` after a reconnect, when notifications may have been missed"""
+        self._resync_handlers.append(handler)
+
+    @property
+    def listening(self) -> bool:
+        return self._driver_conn is not None
+
+    async def start(self, engine: AsyncEngine) -> None:
+        if engine.dialect.name != "postgresql" or self._task is not None:
+            return
+        self._engine = engine
+        await self._listen()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._close()
+
+    async def _listen(self) -> None:
+        self._lost.clear()
+        self._conn = await self._engine.connect()
+        raw = await self._conn.get_raw_connection()
+        self._driver_conn = raw.driver_connection
+        self._driver_conn.add_termination_listener(self._terminated)
+        for channel in self._handlers:
+            await self._driver_conn.add_listener(channel, self._dispatch)
+        logger.info(f"Listening for Postgres notifications on {', '.join(self._handlers)}")
+
+    async def _close(self, lost: bool = False) -> None:
+        if self._conn is None:
+            return
+        try:
+            if lost or self._driver_conn.is_closed():
+                # Keeps the dead connection out of the pool
+                await self._conn.invalidate()
+            else:
+                self._driver_conn.remove_termination_listener(self._terminated)
+                for channel in self._handlers:
+                    await self._driver_conn.remove_listener(channel, self._dispatch)
+            await self._conn.close()
+        except Exception as e:
+            logger.warning(f"Error closing notification connection: {str(e)}")
+        finally:
+            self._conn = None
+            self._driver_conn = None
+
+    def _terminated(self, connection) -> None:
+        self._lost.set()
+
+    async def _alive(self) -> bool:
+        try:
+            await asyncio.wait_for(self._driver_conn.execute("SELECT 1"), timeout=self.check_interval)
+            return True
+        except Exception as e:
+            logger.warning(f"Postgres notification connection lost: {str(e)}")
+            return False
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._lost.wait(), timeout=self.check_interval)
+            except asyncio.TimeoutError:
+                pass
+            if not self._lost.is_set() and await self._alive():
+                continue
+            await self._reconnect()
+
+    async def _reconnect(self) -> None:
+        await self._close(lost=True)
+        backoff = 1.0
+        while True:
+            try:
+                await self._listen()
+                break
+            except Exception as e:
+                logger.error(f"Error reconnecting for Postgres notifications, retrying in {backoff:.0f}s: {str(e)}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, PG_NOTIFY_MAX_BACKOFF)
+        self.reconnects += 1
+        for handler in self._resync_handlers:
+            try:
+                await handler()
+            except Exception as e:
+                logger.error(f"Error resyncing after notification reconnect: {str(e)}")
+
+    def _dispatch(self, connection, pid, channel, payload) -> None:
+        self.received += 1
+        for handler in self._handlers.get(channel, []):
+            try:
+                handler(payload)
+            except Exception as e:
+                logger.error(f"Error handling notification on {channel}: {str(e)}")
+
+
+async def notify(db: AsyncSession, channel: str, payload: str) -> None:
+    """Queue a NOTIFY in the session's transaction; Postgres delivers it on commit"""
+    if db.bind.dialect.name == "postgresql":
+        await db.execute(select(func.pg_notify(channel, payload)))
+
+
+pg_notifier = PgNotifier()
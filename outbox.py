@@ -0,0 +1,35 @@
+import json
+from typing import Any, Dict, List, Tuple
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from commit_hooks import CommitHook
+from models import OutboxEvent
+from notifications import notify
+
+OUTBOX_CHANNEL = "outbox"
+TRANSACTION_STATUS_CHANGED = "transaction.status_changed"
+ORDER_STATUS_CHANGED = "order.status_changed"
+
+OutboxRecord = Tuple[str, Any, Dict[str, Any]]
+
+# Fires once staged events are committed, so the local dispatcher can be woken
+outbox_committed = CommitHook()
+
+
+async def add_outbox_events(db: AsyncSession, events: List[OutboxRecord]) -> None:
+    """Stage (event_type, aggregate_id, payload) events in the session's transaction
+
+    They become visible to the webhook dispatcher only if the state change they
+    describe commits, and are discarded with it on rollback.
+    """
+    if not events:
+        return
+    await db.execute(insert(OutboxEvent), [
+        {"event_type": event_type, "aggregate_id": str(aggregate_id), "payload": json.dumps(payload)}
+        for event_type, aggregate_id, payload in events
+    ])
+    # Wakes dispatchers in other workers on commit; the local one is woken by outbox_committed
+    await notify(db, OUTBOX_CHANNEL, "")
+    outbox_committed.stage(db, len(events))
@@ -0,0 +1,48 @@
+import base64
+import json
+from datetime import datetime
+from typing import Any, List, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import Select, func, tuple_
+
+from database import engine
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    raw = json.dumps([created_at.isoformat(), row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, row_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def keyset_page(query: Select, created_column, id_column, cursor: Optional[str], limit: int) -> Select:
+    """Newest first, resuming after `cursor`; one extra row tells whether a next page exists
+
+    The row comparison is answered from the (created, id) index, so every page costs
+    the same however deep it is, and rows inserted meanwhile do not shift later pages.
+    """
+    query = query.order_by(created_column.desc(), id_column.desc())
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        if engine.dialect.name == "sqlite":
+            # DATETIME is text there, and CURRENT_TIMESTAMP lacks the fraction a bound value carries
+            created_column, created_at = func.julianday(created_column), func.julianday(created_at)
+        query = query.where(tuple_(created_column, id_column) < tuple_(created_at, row_id))
+    return query.limit(limit + 1)
+
+
+def next_page(rows: List[Any], limit: int, created_attr: str, id_attr: str) -> Tuple[List[Any], Optional[str]]:
+    """Trim the extra row fetched by keyset_page and return the cursor for the next page"""
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(getattr(last, created_attr), getattr(last, id_attr))
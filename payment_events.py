@@ -0,0 +1,98 @@
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from commit_hooks import CommitHook
+from notifications import notify
+
+logger = logging.getLogger(__name__)
+
+PAYMENT_EVENTS_CHANNEL = "payment_status"
+# Keeps each NOTIFY payload well under Postgres' 8000 byte limit
+NOTIFY_KEYS_PER_MESSAGE = 100
+
+
+def event_keys(order_id: Optional[int] = None, checkout_request_id: Optional[str] = None) -> List[str]:
+    keys = []
+    if order_id:
+        keys.append(f"order:{order_id}")
+    if checkout_request_id:
+        keys.append(f"checkout:{checkout_request_id}")
+    return keys
+
+
+class PaymentEventHub:
+    """In-process registry of waiters for payment status changes
+
+    Changes are published locally after commit and sent to other workers with
+    Postgres NOTIFY, so a waiter is just an unresolved future. A change without a
+    status only reaches the change handlers, which drop state cached for its keys.
+    """
+
+    def __init__(self):
+        self._waiters: Dict[str, Set[asyncio.Future]] = defaultdict(set)
+        self._change_handlers: List[Callable[[List[str]], None]] = []
+        self.published = 0
+        # Publishes locally without waiting for our own NOTIFY to come back
+        self._committed = CommitHook(self._publish_committed)
+
+    def subscribe(self, *keys: str) -> asyncio.Future:
+        waiter = asyncio.get_running_loop().create_future()
+        for key in keys:
+            self._waiters[key].add(waiter)
+        return waiter
+
+    def unsubscribe(self, waiter: asyncio.Future, *keys: str) -> None:
+        for key in keys:
+            waiters = self._waiters.get(key)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self._waiters[key]
+
+    def on_change(self, handler: Callable[[List[str]], None]) -> None:
+        """Call `handler` with the keys of every change, in whichever worker it was committed"""
+        self._change_handlers.append(handler)
+
+    def publish(self, keys: Iterable[str], status: Optional[str]) -> None:
+        keys = list(keys)
+        for handler in self._change_handlers:
+            handler(keys)
+        if status is None:
+            return
+        for key in keys:
+            for waiter in self._waiters.pop(key, ()):
+                if not waiter.done():
+                    waiter.set_result(status)
+                    self.published += 1
+
+    async def notify(self, db: AsyncSession, keys: List[str], status: Optional[str]) -> None:
+        """Announce a status change that becomes visible when `db` commits"""
+        if not keys:
+            return
+        for start in range(0, len(keys), NOTIFY_KEYS_PER_MESSAGE):
+            chunk = keys[start:start + NOTIFY_KEYS_PER_MESSAGE]
+            await notify(db, PAYMENT_EVENTS_CHANNEL, json.dumps({"keys": chunk, "status": status}))
+        self._committed.stage(db, (keys, status))
+
+    def handle_notification(self, payload: str) -> None:
+        data = json.loads(payload)
+        self.publish(data["keys"], data["status"])
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "keys": len(self._waiters),
+            "waiters": sum(len(waiters) for waiters in self._waiters.values()),
+            "published": self.published,
+        }
+
+    def _publish_committed(self, changes: List[Any]) -> None:
+        for keys, status in changes:
+            self.publish(keys, status)
+
+
+payment_events = PaymentEventHub()
@@ -19,6 +19,9 @@ class TransactionStatus(str, Enum):
     PROCESSED = "PROCESSED"
     REJECTED = "REJECTED"
     ACCEPTED = "ACCEPTED"
+    CANCELED = "CANCELED"
+    EXPIRED = "EXPIRED"
+    UNKNOWN = "UNKNOWN"
 
 class UpdateOrderStatusRequest(BaseModel):
     status: OrderStatus
@@ -110,6 +113,9 @@ class PaginatedProductResponse(BaseModel):
     page: int
     limit: int
     pages: int
+    next_cursor: Optional[str] = None
+    # False when total is the planner's row estimate for a very large table
+    total_exact: bool = True
 
 class ImageResponse(BaseModel):
     message: str
@@ -156,6 +162,8 @@ class PaginatedOrderResponse(BaseModel):
     page: int
     limit: int
     pages: int
+    next_cursor: Optional[str] = None
+    total_exact: bool = True
 
 class InitiatePaymentRequest(BaseModel):
     order_id: int
@@ -192,4 +200,51 @@ class PaginatedOrderWithUserResponse(BaseModel):
     total: int
     page: int
     limit: int
-    pages: int
\ No newline at end of file
+    pages: int
+    next_cursor: Optional[str] = None
+    total_exact: bool = True
+
+class PayoutItem(BaseModel):
+    phone_number: str
+    amount: float = Field(..., gt=0, description="Amount must be greater than 0")
+    remarks: Optional[str] = None
+    user_id: Optional[int] = None
+
+class PayoutBatchCreate(BaseModel):
+    reference: str = Field(..., min_length=1, max_length=100)
+    items: List[PayoutItem]
+
+class PayoutBatchResponse(BaseModel):
+    batch_id: int
+    reference: str
+    total_count: int
+    total_amount: float
+    created_at: datetime
+    status_counts: Dict[str, int]
+
+class PayoutReviewItem(BaseModel):
+    pid: str
+    batch_id: Optional[int] = None
+    phone_number: str
+    amount: float
+    updated_at: Optional[datetime] = None
+
+class PayoutResolution(BaseModel):
+    # PENDING sends the payout again, once M-Pesa shows it was never paid
+    status: TransactionStatus = Field(..., description="ACCEPTED, REJECTED or PENDING")
+    transaction_code: Optional[str] = Field(None, max_length=100)
+    note: Optional[str] = Field(None, max_length=500)
+
+class WebhookCreate(BaseModel):
+    url: str = Field(..., pattern=r"^https?://", max_length=500)
+    secret: Optional[str] = Field(None, max_length=255)
+    event_types: List[str] = ["*"]
+    max_concurrency: int = Field(4, ge=1, le=50)
+
+class WebhookResponse(BaseModel):
+    id: int
+    url: str
+    event_types: List[str]
+    max_concurrency: int
+    active: bool
+    created_at: datetime
@@ -0,0 +1,132 @@
+import base64
+import logging
+import os
+from typing import Any, Dict, List, Tuple
+
+import httpx
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import TransactionStatus
+from repositories.http_client import get_http_client, guarded_request, timeout
+from repositories.lnmo_repository import LNMORepository
+from repositories.token_cache import AccessTokenCache
+from repositories.transaction_state import resolve_pending
+
+logger = logging.getLogger(__name__)
+
+
+class B2CRepository:
+    MPESA_B2C_CONSUMER_KEY = os.getenv("MPESA_B2C_CONSUMER_KEY", LNMORepository.MPESA_LNMO_CONSUMER_KEY)
+    MPESA_B2C_CONSUMER_SECRET = os.getenv("MPESA_B2C_CONSUMER_SECRET", LNMORepository.MPESA_LNMO_CONSUMER_SECRET)
+    MPESA_B2C_SHORT_CODE = os.getenv("MPESA_B2C_SHORT_CODE")
+    MPESA_B2C_INITIATOR_NAME = os.getenv("MPESA_B2C_INITIATOR_NAME")
+    # The initiator password encrypted with the Daraja certificate
+    MPESA_B2C_SECURITY_CREDENTIAL = os.getenv("MPESA_B2C_SECURITY_CREDENTIAL")
+    MPESA_B2C_COMMAND_ID = os.getenv("MPESA_B2C_COMMAND_ID", "BusinessPayment")
+    MPESA_B2C_RESULT_URL = os.getenv("MPESA_B2C_RESULT_URL")
+    MPESA_B2C_TIMEOUT_URL = os.getenv("MPESA_B2C_TIMEOUT_URL", MPESA_B2C_RESULT_URL)
+    MPESA_B2C_REQUEST_TIMEOUT = float(os.getenv("MPESA_B2C_REQUEST_TIMEOUT", "30"))
+    MPESA_API_BASE_URL = LNMORepository.MPESA_API_BASE_URL
+
+    _token_cache = AccessTokenCache(refresh_margin=LNMORepository.MPESA_TOKEN_REFRESH_MARGIN)
+    # Same upstream as the STK endpoints, so B2C shares their breaker and bulkhead
+    _breaker = LNMORepository._breaker
+    _bulkhead = LNMORepository._bulkhead
+
+    def __init__(self):
+        required = [
+            ("MPESA_B2C_CONSUMER_KEY", self.MPESA_B2C_CONSUMER_KEY),
+            ("MPESA_B2C_CONSUMER_SECRET", self.MPESA_B2C_CONSUMER_SECRET),
+            ("MPESA_B2C_SHORT_CODE", self.MPESA_B2C_SHORT_CODE),
+            ("MPESA_B2C_INITIATOR_NAME", self.MPESA_B2C_INITIATOR_NAME),
+            ("MPESA_B2C_SECURITY_CREDENTIAL", self.MPESA_B2C_SECURITY_CREDENTIAL),
+            ("MPESA_B2C_RESULT_URL", self.MPESA_B2C_RESULT_URL),
+        ]
+        missing = [name for name, value in required if not value]
+        if missing:
+            raise ValueError(f"Missing required environment variables: {', '.join(missing)}")
+
+    async def pay(
+        self, originator_conversation_id: str, phone_number: str, amount: int, remarks: str
+    ) -> Tuple[int, Dict[str, Any]]:
+        """Send one B2C payment request; the outcome arrives later on the result URL"""
+        endpoint = f"{self.MPESA_API_BASE_URL}/mpesa/b2c/v3/paymentrequest"
+        headers = {
+            "Authorization": f"Bearer {await self.generate_access_token()}",
+            "Content-Type": "application/json",
+        }
+        payload = {
+            # Our _pid, so a result can be matched even if the ConversationID was never stored
+            "OriginatorConversationID": originator_conversation_id,
+            "InitiatorName": self.MPESA_B2C_INITIATOR_NAME,
+            "SecurityCredential": self.MPESA_B2C_SECURITY_CREDENTIAL,
+            "CommandID": self.MPESA_B2C_COMMAND_ID,
+            "Amount": amount,
+            "PartyA": self.MPESA_B2C_SHORT_CODE,
+            "PartyB": phone_number,
+            "Remarks": remarks[:100],
+            "QueueTimeOutURL": self.MPESA_B2C_TIMEOUT_URL,
+            "ResultURL": self.MPESA_B2C_RESULT_URL,
+            "Occasion": originator_conversation_id,
+        }
+        response = await self._send(
+            "POST", endpoint, json=payload, headers=headers, timeout=timeout(read=self.MPESA_B2C_REQUEST_TIMEOUT)
+        )
+        logger.info(f"B2C response for {originator_conversation_id}: status={response.status_code}")
+        if response.status_code == 401:
+            self._token_cache.invalidate()
+        try:
+            response_data = response.json()
+        except ValueError:
+            response_data = {"errorMessage": response.text}
+        return response.status_code, response_data
+
+    async def apply_results(self, results: List[Dict[str, Any]], db: AsyncSession) -> int:
+        """Apply a batch of B2C result callbacks without committing; returns how many payouts moved"""
+        resolutions = [self.resolution_for_result(data) for data in results]
+        moved = await resolve_pending(
+            db,
+            resolutions,
+            match_on="_pid",
+            # An UNKNOWN payout did reach Daraja after all once its result arrives
+            from_statuses=(TransactionStatus.PENDING, TransactionStatus.PROCESSING, TransactionStatus.UNKNOWN),
+        )
+        if len(moved) < len(resolutions):
+            logger.info(f"Ignored {len(resolutions) - len(moved)} B2C results for payouts already resolved")
+        return len(moved)
+
+    @staticmethod
+    def resolution_for_result(data: Dict[str, Any]) -> Dict[str, Any]:
+        result = data["Result"]
+        return {
+            "_pid": result["OriginatorConversationID"],
+            "status": TransactionStatus.ACCEPTED if int(result["ResultCode"]) == 0 else TransactionStatus.REJECTED,
+            "feedback": data,
+            "transaction_id": result.get("ConversationID"),
+            "transaction_code": result.get("TransactionID") if int(result["ResultCode"]) == 0 else None,
+        }
+
+    async def generate_access_token(self) -> str:
+        return await self._token_cache.get(self._fetch_access_token)
+
+    async def _fetch_access_token(self):
+        endpoint = f"{self.MPESA_API_BASE_URL}/oauth/v1/generate?grant_type=client_credentials"
+        credentials = f"{self.MPESA_B2C_CONSUMER_KEY}:{self.MPESA_B2C_CONSUMER_SECRET}"
+        headers = {"Authorization": f"Basic {base64.b64encode(credentials.encode()).decode()}"}
+        response = await self._send(
+            "GET", endpoint, headers=headers, timeout=timeout(read=LNMORepository.MPESA_TOKEN_TIMEOUT)
+        )
+        if response.status_code != 200:
+            raise Exception(f"HTTP {response.status_code}: {response.text}")
+        response_data = response.json()
+        access_token = response_data.get("access_token")
+        if not access_token:
+            raise Exception("Access token not found in response")
+        return access_token, response_data.get("expires_in", 3599)
+
+    @classmethod
+    def token_stats(cls) -> Dict[str, Any]:
+        return cls._token_cache.stats()
+
+    async def _send(self, method: str, endpoint: str, **kwargs) -> httpx.Response:
+        return await guarded_request(get_http_client(), self._breaker, self._bulkhead, method, endpoint, **kwargs)
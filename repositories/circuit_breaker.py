@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import time
+from typing import Any, Dict
+
+logger = logging.getLogger(__name__)
+
+
+class DarajaUnavailable(Exception):
+    """Raised instead of calling Daraja when the breaker is open or the bulkhead is full"""
+
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Stops calling an upstream after repeated failures and probes it again later"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30, half_open_max_calls: int = 1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._half_open_calls = 0
+        self._half_open_since = 0.0
+        self.failures = 0
+        self.rejections = 0
+        self.opened = 0
+
+    def retry_after(self) -> int:
+        return max(int(self._opened_at + self.reset_timeout - time.monotonic()), 1)
+
+    def is_open(self) -> bool:
+        """Cheap pre-check that does not take a half-open probe slot"""
+        return self.state == self.OPEN and time.monotonic() < self._opened_at + self.reset_timeout
+
+    def before_call(self) -> None:
+        if self.state == self.OPEN:
+            if time.monotonic() < self._opened_at + self.reset_timeout:
+                self.rejections += 1
+                raise DarajaUnavailable(f"{self.name} circuit is open", self.retry_after())
+            self.state = self.HALF_OPEN
+            self._half_open_calls = 0
+            self._half_open_since = time.monotonic()
+            logger.info(f"{self.name} circuit half-open, probing")
+        if self.state == self.HALF_OPEN:
+            # A probe that never reported back must not wedge the breaker
+            if time.monotonic() >= self._half_open_since + self.reset_timeout:
+                self._half_open_calls = 0
+                self._half_open_since = time.monotonic()
+            if self._half_open_calls >= self.half_open_max_calls:
+                self.rejections += 1
+                raise DarajaUnavailable(f"{self.name} circuit is half-open", 1)
+            self._half_open_calls += 1
+
+    def on_success(self) -> None:
+        if self.state == self.HALF_OPEN:
+            logger.info(f"{self.name} circuit closed")
+        self.state = self.CLOSED
+        self._consecutive_failures = 0
+
+    def on_failure(self) -> None:
+        self.failures += 1
+        self._consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.opened += 1
+                logger.warning(f"{self.name} circuit opened after {self._consecutive_failures} failures")
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.OPEN if self.is_open() else self.state,
+            "failures": self.failures,
+            "rejections": self.rejections,
+            "opened": self.opened,
+        }
+
+
+class Bulkhead:
+    """Caps concurrent upstream calls and rejects instead of queueing for long"""
+
+    def __init__(self, name: str, max_concurrent: int, max_wait: float = 0.0):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_wait = max_wait
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.in_flight = 0
+        self.rejections = 0
+
+    async def __aenter__(self) -> "Bulkhead":
+        if self._semaphore.locked() and self.max_wait <= 0:
+            self.rejections += 1
+            raise DarajaUnavailable(f"{self.name} bulkhead is full")
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.max_wait or None)
+        except asyncio.TimeoutError:
+            self.rejections += 1
+            raise DarajaUnavailable(f"{self.name} bulkhead is full")
+        self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrent": self.max_concurrent,
+            "in_flight": self.in_flight,
+            "rejections": self.rejections,
+        }
@@ -0,0 +1,97 @@
+import logging
+import os
+import time
+from typing import Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from metrics import observe_upstream
+from repositories.circuit_breaker import Bulkhead, CircuitBreaker
+
+logger = logging.getLogger(__name__)
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+DARAJA_CONNECT_TIMEOUT = float(os.getenv("DARAJA_CONNECT_TIMEOUT", "5"))
+DARAJA_READ_TIMEOUT = float(os.getenv("DARAJA_READ_TIMEOUT", "30"))
+DARAJA_MAX_CONNECTIONS = int(os.getenv("DARAJA_MAX_CONNECTIONS", "100"))
+DARAJA_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("DARAJA_MAX_KEEPALIVE_CONNECTIONS", "20"))
+DARAJA_KEEPALIVE_EXPIRY = float(os.getenv("DARAJA_KEEPALIVE_EXPIRY", "30"))
+# Gateway errors mean Daraja itself is struggling; its HTTP 500s are often business errors
+UPSTREAM_FAILURE_STATUSES = {502, 503, 504}
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def timeout(read: float = DARAJA_READ_TIMEOUT, connect: float = DARAJA_CONNECT_TIMEOUT) -> httpx.Timeout:
+    """Per-call timeout; pool waits are bounded by the connect timeout"""
+    return httpx.Timeout(connect=connect, read=read, write=connect, pool=connect)
+
+
+def create_http_client(
+    max_connections: int = DARAJA_MAX_CONNECTIONS,
+    max_keepalive_connections: int = DARAJA_MAX_KEEPALIVE_CONNECTIONS,
+) -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=min(max_keepalive_connections, max_connections),
+        keepalive_expiry=DARAJA_KEEPALIVE_EXPIRY,
+    )
+    return httpx.AsyncClient(http2=HTTP2_AVAILABLE, limits=limits, timeout=timeout())
+
+
+async def start_http_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = create_http_client()
+        logger.info(f"Daraja HTTP client started (http2={HTTP2_AVAILABLE})")
+    return _client
+
+
+async def close_http_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+        logger.info("Daraja HTTP client closed")
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        # Scripts and tests may run without the FastAPI lifespan
+        logger.warning("Daraja HTTP client used before startup, creating it lazily")
+        _client = create_http_client()
+    return _client
+
+
+async def guarded_request(
+    client: httpx.AsyncClient,
+    breaker: CircuitBreaker,
+    bulkhead: Bulkhead,
+    method: str,
+    url: str,
+    **kwargs,
+) -> httpx.Response:
+    """One Daraja request inside the bulkhead and circuit breaker, timed per endpoint"""
+    path = urlsplit(url).path
+    async with bulkhead:
+        breaker.before_call()
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            observe_upstream(path, type(e).__name__, time.perf_counter() - started)
+            breaker.on_failure()
+            raise
+        observe_upstream(path, str(response.status_code), time.perf_counter() - started)
+    if response.status_code in UPSTREAM_FAILURE_STATUSES:
+        breaker.on_failure()
+    else:
+        breaker.on_success()
+    return response
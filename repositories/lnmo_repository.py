@@ -1,15 +1,22 @@
 import base64
-import requests
 from datetime import datetime
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
-from models import Transaction
-from models.transaction import TransactionStatus, TransactionCategory, TransactionType, TransactionChannel, TransactionAggregator 
-from pydantic_model import OrderStatus
-from typing import Dict, Any
+from models import Transaction, TransactionStatus
+from models.transaction import TransactionCategory, TransactionType, TransactionChannel, TransactionAggregator 
+from typing import Dict, Any, Optional
 import os
 import logging
+import time
 from fastapi import Request, HTTPException
+from repositories.token_cache import AccessTokenCache
+from repositories.http_client import get_http_client, guarded_request, timeout
+from repositories.circuit_breaker import Bulkhead, CircuitBreaker, DarajaUnavailable
+from repositories.transaction_state import resolve_pending
+import httpx
+from payment_events import payment_events, event_keys
+from metrics import count_result, timed
+from workers.orphan_callbacks import orphan_callbacks
 
 logger = logging.getLogger(__name__)
 
@@ -21,8 +28,41 @@ class LNMORepository:
     MPESA_LNMO_SHORT_CODE = os.getenv("MPESA_LNMO_SHORT_CODE", "174379")
     MPESA_LNMO_CALLBACK_URL = os.getenv("MPESA_CALLBACK_URL","https://b458-102-213-49-27.ngrok-free.app/ipn/daraja/lnmo/callback")
     MPESA_IPS = ["196.201.214.0/24", "196.201.214.200"]  # Safaricom callback IPs
+    # Point at tools/daraja_simulator.py for local benchmarking
+    MPESA_API_BASE_URL = os.getenv("MPESA_API_BASE_URL", f"https://{MPESA_LNMO_ENVIRONMENT}.safaricom.co.ke").rstrip("/")
+    MPESA_WARM_UP = os.getenv("MPESA_WARM_UP", "true").lower() == "true"
+    MPESA_TOKEN_REFRESH_MARGIN = int(os.getenv("MPESA_TOKEN_REFRESH_MARGIN", "300"))
+    MPESA_TOKEN_TIMEOUT = float(os.getenv("MPESA_TOKEN_TIMEOUT", "10"))
+    MPESA_STK_PUSH_TIMEOUT = float(os.getenv("MPESA_STK_PUSH_TIMEOUT", "30"))
+    MPESA_STK_QUERY_TIMEOUT = float(os.getenv("MPESA_STK_QUERY_TIMEOUT", "15"))
+    MPESA_BREAKER_FAILURE_THRESHOLD = int(os.getenv("MPESA_BREAKER_FAILURE_THRESHOLD", "5"))
+    MPESA_BREAKER_RESET_TIMEOUT = float(os.getenv("MPESA_BREAKER_RESET_TIMEOUT", "30"))
+    MPESA_BULKHEAD_MAX_CONCURRENT = int(os.getenv("MPESA_BULKHEAD_MAX_CONCURRENT", "50"))
+    MPESA_BULKHEAD_MAX_WAIT = float(os.getenv("MPESA_BULKHEAD_MAX_WAIT", "0.5"))
 
-    def __init__(self):
+    # Shared by every instance so the token survives across requests
+    _token_cache = AccessTokenCache(refresh_margin=MPESA_TOKEN_REFRESH_MARGIN)
+    _breaker = CircuitBreaker(
+        "daraja",
+        failure_threshold=MPESA_BREAKER_FAILURE_THRESHOLD,
+        reset_timeout=MPESA_BREAKER_RESET_TIMEOUT,
+    )
+    _bulkhead = Bulkhead("daraja", MPESA_BULKHEAD_MAX_CONCURRENT, max_wait=MPESA_BULKHEAD_MAX_WAIT)
+
+    # Set for a repository bound to one of several short codes, see repositories/shortcode_profiles.py
+    profile = None
+
+    def __init__(self, profile=None):
+        if profile is not None:
+            self.profile = profile
+            self.MPESA_LNMO_CONSUMER_KEY = profile.consumer_key
+            self.MPESA_LNMO_CONSUMER_SECRET = profile.consumer_secret
+            self.MPESA_LNMO_PASS_KEY = profile.pass_key
+            self.MPESA_LNMO_SHORT_CODE = profile.short_code
+            self.MPESA_LNMO_CALLBACK_URL = profile.callback_url
+            # Token, concurrency limit and pool of its own so short codes cannot starve each other
+            self._token_cache = profile.token_cache
+            self._bulkhead = profile.bulkhead
         required_vars = [
             self.MPESA_LNMO_CONSUMER_KEY,
             self.MPESA_LNMO_CONSUMER_SECRET,
@@ -40,14 +80,15 @@ class LNMORepository:
             ]
             raise ValueError(f"Missing required environment variables: {', '.join(missing)}")
 
+    @timed("stk_push")
     async def transact(self, data: Dict[str, Any], db: AsyncSession) -> Dict[str, Any]:
         try:
             # Ensure amount is integer
             amount = int(float(data["Amount"]))  # Convert to int to remove decimals
             
-            endpoint = f"https://{self.MPESA_LNMO_ENVIRONMENT}.safaricom.co.ke/mpesa/stkpush/v1/processrequest"
+            endpoint = f"{self.MPESA_API_BASE_URL}/mpesa/stkpush/v1/processrequest"
             headers = {
-                "Authorization": f"Bearer {self.generate_access_token()}",
+                "Authorization": f"Bearer {await self.generate_access_token()}",
                 "Content-Type": "application/json",
             }
             timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
@@ -65,16 +106,24 @@ class LNMORepository:
                 "TransactionDesc": f"Payment for order {data['AccountReference']}",
             }
             
-            response = requests.post(endpoint, json=payload, headers=headers)
+            response = await self._send(
+                "POST", endpoint, json=payload, headers=headers, timeout=timeout(read=self.MPESA_STK_PUSH_TIMEOUT)
+            )
             logger.info(f"STK Push request: endpoint={endpoint}, payload={payload}")
             logger.info(f"STK Push response: status={response.status_code}, text={response.text}")
 
+            if response.status_code == 401:
+                self._token_cache.invalidate()
+
             if response.status_code != 200:
+                count_result("stk_push", f"HTTP {response.status_code}")
                 raise Exception(f"HTTP {response.status_code}: {response.text}")
             
             response_data = response.json()
             if "errorCode" in response_data:
+                count_result("stk_push", response_data["errorCode"])
                 raise Exception(f"M-Pesa API error: {response_data.get('errorMessage')}")
+            count_result("stk_push", response_data.get("ResponseCode"))
 
             # Create transaction record
             transaction = Transaction(
@@ -101,17 +150,19 @@ class LNMORepository:
             await db.commit()
             await db.refresh(transaction)
             logger.info(f"Transaction saved: ID={transaction.transaction_id}")
+            orphan_callbacks.transaction_stored(transaction.transaction_id)
             return response_data
             
         except Exception as e:
             logger.error(f"Error initiating M-Pesa transaction: {str(e)}")
             raise
 
+    @timed("stk_query")
     async def query(self, transaction_id: str, db: AsyncSession) -> Dict[str, Any]:
         try:
-            endpoint = f"https://{self.MPESA_LNMO_ENVIRONMENT}.safaricom.co.ke/mpesa/stkpushquery/v1/query"
+            endpoint = f"{self.MPESA_API_BASE_URL}/mpesa/stkpushquery/v1/query"
             headers = {
-                "Authorization": f"Bearer {self.generate_access_token()}",
+                "Authorization": f"Bearer {await self.generate_access_token()}",
                 "Content-Type": "application/json",
             }
             timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
@@ -121,83 +172,157 @@ class LNMORepository:
                 "Timestamp": timestamp,
                 "CheckoutRequestID": transaction_id,
             }
-            response = requests.post(endpoint, json=payload, headers=headers)
+            response = await self._send(
+                "POST", endpoint, json=payload, headers=headers, timeout=timeout(read=self.MPESA_STK_QUERY_TIMEOUT)
+            )
             logger.info(f"Query response: status={response.status_code}, text={response.text}")
+            if response.status_code == 401:
+                self._token_cache.invalidate()
             response_data = response.json()
+            count_result(
+                "stk_query",
+                response_data.get("ResultCode", response_data.get("errorCode", f"HTTP {response.status_code}")),
+            )
             return response_data
         except Exception as e:
             logger.error(f"Error querying M-Pesa transaction: {str(e)}")
             raise
 
+    async def sync_status(self, transaction_id: str, db: AsyncSession) -> TransactionStatus:
+        """Query Daraja for a PENDING transaction and store the result once it is terminal"""
+        response_data = await self.query(transaction_id, db)
+        # Daraja answers with an errorCode while the prompt is still open
+        if "ResultCode" not in response_data:
+            return TransactionStatus.PENDING
+        
+        status = self.status_for_result_code(response_data["ResultCode"])
+        moved = await resolve_pending(
+            db, [{"transaction_id": transaction_id, "status": status, "feedback": response_data}]
+        )
+        for row in moved:
+            await payment_events.notify(db, event_keys(row.order_id, transaction_id), status.value)
+        await db.commit()
+        return status
+
     async def callback(self, data: Dict[str, Any], request: Request, db: AsyncSession) -> Dict[str, Any]:
-        # Skip IP verification in development/sandbox mode
-        if self.MPESA_LNMO_ENVIRONMENT == "production" and not self.verify_callback(request):
-            logger.error(f"Invalid callback source: {request.client.host}")
-            raise HTTPException(status_code=403, detail="Invalid callback source")
+        self.ensure_trusted_source(request)
         
         try:
-            checkout_request_id = data["Body"]["stkCallback"]["CheckoutRequestID"]
-            result = await db.execute(
-                select(Transaction).where(Transaction.transaction_id == checkout_request_id)
-            )
-            transaction = result.scalars().first()
-            if not transaction:
-                logger.error(f"Transaction not found for CheckoutRequestID: {checkout_request_id}")
-                raise Exception("Transaction not found")
-            
-            transaction._feedback = data
-            result_code = data["Body"]["stkCallback"]["ResultCode"]
-            
-            if result_code == 0:
-                transaction._status = TransactionStatus.ACCEPTED
-                # Update order status if order exists
-                if hasattr(transaction, 'order') and transaction.order:
-                    transaction.order.status = OrderStatus.DELIVERED  # or PROCESSING based on your workflow
-                
-                # Extract M-Pesa receipt number
-                callback_metadata = data["Body"]["stkCallback"].get("CallbackMetadata")
-                if callback_metadata:
-                    items = callback_metadata.get("Item", [])
-                    for item in items:
-                        if item.get("Name") == "MpesaReceiptNumber" and "Value" in item:
-                            transaction.transaction_code = item["Value"]
-                            break
-            elif result_code == 1032:
-                transaction._status = TransactionStatus.CANCELED
-            else:
-                transaction._status = TransactionStatus.REJECTED
-            
+            status = await self.apply_callback(data, db)
             await db.commit()
-            await db.refresh(transaction)
-            logger.info(f"Callback processed for transaction {checkout_request_id}, status: {transaction._status}")
+            checkout_request_id = data["Body"]["stkCallback"]["CheckoutRequestID"]
+            logger.info(f"Callback processed for transaction {checkout_request_id}, status: {status}")
             return data
             
         except Exception as e:
             logger.error(f"Error processing M-Pesa callback: {str(e)}")
             raise
 
-    def verify_callback(self, request: Request) -> bool:
+    # Timed here rather than on callback, so callbacks applied by the inbox worker are measured too
+    @timed("callback")
+    async def apply_callback(self, data: Dict[str, Any], db: AsyncSession) -> Optional[TransactionStatus]:
+        """Apply an STK callback to its transaction without committing
+
+        Returns the new status, or None when the transaction had already left PENDING.
+        """
+        stk_callback = data["Body"]["stkCallback"]
+        checkout_request_id = stk_callback["CheckoutRequestID"]
+        status = self.status_for_result_code(stk_callback["ResultCode"])
+        count_result("callback", stk_callback["ResultCode"])
+        
+        # Extract M-Pesa receipt number
+        transaction_code = None
+        if status == TransactionStatus.ACCEPTED:
+            for item in stk_callback.get("CallbackMetadata", {}).get("Item", []):
+                if item.get("Name") == "MpesaReceiptNumber" and "Value" in item:
+                    transaction_code = str(item["Value"])
+                    break
+        
+        moved = await resolve_pending(
+            db,
+            [{
+                "transaction_id": checkout_request_id,
+                "status": status,
+                "feedback": data,
+                "transaction_code": transaction_code,
+            }],
+            # A payment completed after the sweeper gave up on it must still be recorded
+            from_statuses=(TransactionStatus.PENDING, TransactionStatus.EXPIRED),
+        )
+        if not moved:
+            # Tell a replay apart from a callback for a transaction we never stored
+            result = await db.execute(
+                select(Transaction._status).where(Transaction.transaction_id == checkout_request_id)
+            )
+            current = result.scalar_one_or_none()
+            if current is None:
+                # The callback beat the transaction insert in transact(); keep it until the row exists
+                logger.warning(f"Transaction not found for CheckoutRequestID: {checkout_request_id}, holding callback")
+                await orphan_callbacks.hold(db, checkout_request_id, data)
+                return None
+            logger.info(f"Ignoring callback for {checkout_request_id}, transaction is already {current.value}")
+            return None
+        
+        await payment_events.notify(db, event_keys(moved[0].order_id, checkout_request_id), status.value)
+        return status
+
+    @staticmethod
+    def status_for_result_code(result_code: Any) -> TransactionStatus:
+        """Map a Daraja ResultCode (int in callbacks, str in queries) to a transaction status"""
+        result_code = int(result_code)
+        if result_code == 0:
+            return TransactionStatus.ACCEPTED
+        if result_code == 1032:
+            return TransactionStatus.CANCELED
+        return TransactionStatus.REJECTED
+
+    @classmethod
+    def ensure_trusted_source(cls, request: Request) -> None:
+        # Skip IP verification in development/sandbox mode
+        if cls.MPESA_LNMO_ENVIRONMENT == "production" and not cls.verify_callback(request):
+            logger.error(f"Invalid callback source: {request.client.host}")
+            raise HTTPException(status_code=403, detail="Invalid callback source")
+
+    @classmethod
+    def verify_callback(cls, request: Request) -> bool:
         """Verify that the callback is coming from a valid M-Pesa IP"""
         client_ip = request.client.host
         # In production, you should implement proper IP range checking
         # For now, we'll allow any IP in sandbox mode
-        if self.MPESA_LNMO_ENVIRONMENT == "sandbox":
+        if cls.MPESA_LNMO_ENVIRONMENT == "sandbox":
             return True
         
         # Check if client IP is in allowed M-Pesa IP ranges
-        for allowed_ip in self.MPESA_IPS:
+        for allowed_ip in cls.MPESA_IPS:
             if client_ip.startswith(allowed_ip.split('/')[0]):
                 return True
         return False
 
-    def generate_access_token(self) -> str:
+    async def warm_up(self) -> None:
+        """Open the upstream connection and fetch a token before the first payment"""
+        started = time.monotonic()
+        try:
+            await self.generate_access_token()
+            logger.info(f"Daraja warm-up done in {(time.monotonic() - started) * 1000:.0f} ms")
+        except Exception as e:
+            # Not fatal: the first payment fetches the token instead
+            logger.warning(f"Daraja warm-up failed: {str(e)}")
+
+    async def generate_access_token(self) -> str:
+        return await self._token_cache.get(self._fetch_access_token)
+
+    # Timed here rather than on generate_access_token, whose cache hits would flood the histogram
+    @timed("token")
+    async def _fetch_access_token(self):
         try:
-            endpoint = f"https://{self.MPESA_LNMO_ENVIRONMENT}.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials"
+            endpoint = f"{self.MPESA_API_BASE_URL}/oauth/v1/generate?grant_type=client_credentials"
             credentials = f"{self.MPESA_LNMO_CONSUMER_KEY}:{self.MPESA_LNMO_CONSUMER_SECRET}"
             encoded_credentials = base64.b64encode(credentials.encode()).decode()
             headers = {"Authorization": f"Basic {encoded_credentials}"}
             
-            response = requests.get(endpoint, headers=headers, timeout=10)
+            response = await self._send(
+                "GET", endpoint, headers=headers, timeout=timeout(read=self.MPESA_TOKEN_TIMEOUT)
+            )
             logger.info(f"Access token response: status={response.status_code}")
             
             if response.status_code != 200:
@@ -209,12 +334,34 @@ class LNMORepository:
             if not access_token:
                 raise Exception("Access token not found in response")
                 
-            return access_token
+            return access_token, response_data.get("expires_in", 3599)
             
         except Exception as e:
             logger.error(f"Error generating access token: {str(e)}")
             raise
 
+    @classmethod
+    def token_stats(cls) -> Dict[str, Any]:
+        return cls._token_cache.stats()
+
+    @classmethod
+    def upstream_stats(cls) -> Dict[str, Any]:
+        return {"breaker": cls._breaker.stats(), "bulkhead": cls._bulkhead.stats()}
+
+    @classmethod
+    def ensure_available(cls) -> None:
+        """Fail fast, before any DB work, while the Daraja circuit is open"""
+        if cls._breaker.is_open():
+            cls._breaker.rejections += 1
+            raise DarajaUnavailable("daraja circuit is open", cls._breaker.retry_after())
+
+    async def _send(self, method: str, endpoint: str, **kwargs) -> httpx.Response:
+        client = get_http_client()
+        if self.profile is not None:
+            await self.profile.limiter.acquire()
+            client = self.profile.http_client()
+        return await guarded_request(client, self._breaker, self._bulkhead, method, endpoint, **kwargs)
+
     def generate_password(self, timestamp: str) -> str:
         try:
             password_string = f"{self.MPESA_LNMO_SHORT_CODE}{self.MPESA_LNMO_PASS_KEY}{timestamp}"
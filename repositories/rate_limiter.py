@@ -0,0 +1,132 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Tuple
+
+from sqlalchemy import text
+
+from database import engine
+
+
+class AsyncRateLimiter:
+    """Spaces calls evenly so no more than `rate` start per second"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class TokenBucketLimiter:
+    """Per-key token buckets, e.g. one per phone number
+
+    Buckets live in process memory, so a rejection costs a dict lookup. With `shared`
+    set, a key that passes locally must also take a token from its row in
+    rate_limit_buckets, which every worker updates with one atomic upsert.
+    """
+
+    def __init__(self, name: str, capacity: float, per_second: float, shared: bool = False, max_keys: int = 100000):
+        self.name = name
+        self.capacity = capacity
+        self.per_second = per_second
+        self.shared = shared
+        self.max_keys = max_keys
+        # key -> (tokens, monotonic time of the last update), least recently used first
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self.allowed = 0
+        self.rejected = 0
+        self.rejected_shared = 0
+        self.refunded = 0
+
+    async def acquire(self, key: str) -> float:
+        """Take a token for `key`; returns 0 on success, else seconds until one is available"""
+        wait = self.try_acquire(key)
+        if wait == 0 and self.shared:
+            wait = await self._acquire_shared(key)
+            if wait:
+                self.rejected_shared += 1
+        if wait:
+            self.rejected += 1
+        else:
+            self.allowed += 1
+        return wait
+
+    def try_acquire(self, key: str) -> float:
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (self.capacity, now))
+        tokens = min(self.capacity, tokens + (now - updated) * self.per_second)
+        allowed = tokens >= 1
+        self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+        if len(self._buckets) > self.max_keys:
+            # Forgetting a bucket only refills it
+            self._buckets.popitem(last=False)
+        return 0.0 if allowed else (1 - tokens) / self.per_second
+
+    async def refund(self, key: str) -> None:
+        """Give back the token acquire() took for a request that went no further"""
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            tokens, updated = bucket
+            self._buckets[key] = (min(self.capacity, tokens + 1), updated)
+        if self.shared and engine.dialect.name == "postgresql":
+            async with engine.begin() as conn:
+                await conn.execute(_REFUND_SHARED_SQL, {"key": f"{self.name}:{key}", "capacity": self.capacity})
+        self.refunded += 1
+
+    async def _acquire_shared(self, key: str) -> float:
+        if engine.dialect.name != "postgresql":
+            return 0.0
+        async with engine.begin() as conn:
+            result = await conn.execute(_SHARED_BUCKET_SQL, {
+                "key": f"{self.name}:{key}", "capacity": self.capacity, "per_second": self.per_second,
+            })
+            taken = result.first()
+        return 0.0 if taken is not None else 1 / self.per_second
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "capacity": self.capacity,
+            "per_minute": round(self.per_second * 60, 2),
+            "shared": self.shared,
+            "keys": len(self._buckets),
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+            "rejected_shared": self.rejected_shared,
+            "refunded": self.refunded,
+        }
+
+
+# Refill and take a token in one statement; the row lock serialises workers on the same key.
+# No row comes back when the bucket is empty, and an empty bucket is left untouched.
+_SHARED_BUCKET_SQL = text("""
+    INSERT INTO rate_limit_buckets AS b (key, tokens, updated_at)
+    VALUES (:key, CAST(:capacity AS double precision) - 1, clock_timestamp())
+    ON CONFLICT (key) DO UPDATE SET
+        tokens = LEAST(
+            CAST(:capacity AS double precision),
+            b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at) * CAST(:per_second AS double precision)
+        ) - 1,
+        updated_at = clock_timestamp()
+    WHERE LEAST(
+        CAST(:capacity AS double precision),
+        b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at) * CAST(:per_second AS double precision)
+    ) >= 1
+    RETURNING b.tokens
+""")
+
+# Tokens refilled since updated_at are added on the next acquire, so only the refunded one is put back here
+_REFUND_SHARED_SQL = text("""
+    UPDATE rate_limit_buckets
+    SET tokens = LEAST(CAST(:capacity AS double precision), tokens + 1)
+    WHERE key = :key
+""")
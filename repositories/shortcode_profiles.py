@@ -0,0 +1,163 @@
+import logging
+import os
+from typing import Any, Dict, Iterable, List, Optional
+
+import httpx
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import OrderDetails, Products
+from repositories.circuit_breaker import Bulkhead
+from repositories.http_client import DARAJA_MAX_CONNECTIONS, create_http_client
+from repositories.lnmo_repository import LNMORepository
+from repositories.rate_limiter import AsyncRateLimiter
+from repositories.token_cache import AccessTokenCache
+
+logger = logging.getLogger(__name__)
+
+# Names of the extra short codes, each configured with MPESA_PROFILE_<NAME>_* variables.
+# The MPESA_LNMO_* short code stays the default for everything no profile claims.
+MPESA_SHORTCODE_PROFILES = os.getenv("MPESA_SHORTCODE_PROFILES", "")
+
+
+class ShortcodeProfile:
+    """Credentials of one paybill/till plus its own token cache, connection pool and limits"""
+
+    def __init__(
+        self,
+        name: str,
+        short_code: str,
+        consumer_key: str,
+        consumer_secret: str,
+        pass_key: str,
+        callback_url: Optional[str] = None,
+        rate: float = 0,
+        max_connections: int = DARAJA_MAX_CONNECTIONS,
+        max_concurrent: int = LNMORepository.MPESA_BULKHEAD_MAX_CONCURRENT,
+        sellers: Iterable[int] = (),
+    ):
+        self.name = name
+        self.short_code = short_code
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.pass_key = pass_key
+        self.callback_url = callback_url or LNMORepository.MPESA_LNMO_CALLBACK_URL
+        self.rate = rate
+        self.max_connections = max_connections
+        self.sellers = set(sellers)
+        self.token_cache = AccessTokenCache(refresh_margin=LNMORepository.MPESA_TOKEN_REFRESH_MARGIN)
+        self.bulkhead = Bulkhead(f"daraja-{name}", max_concurrent, max_wait=LNMORepository.MPESA_BULKHEAD_MAX_WAIT)
+        self.limiter = AsyncRateLimiter(rate)
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @classmethod
+    def from_env(cls, name: str) -> "ShortcodeProfile":
+        prefix = f"MPESA_PROFILE_{name.upper()}_"
+        required = ["SHORT_CODE", "CONSUMER_KEY", "CONSUMER_SECRET", "PASS_KEY"]
+        missing = [prefix + key for key in required if not os.getenv(prefix + key)]
+        if missing:
+            raise ValueError(f"Missing required environment variables: {', '.join(missing)}")
+        sellers = os.getenv(prefix + "SELLERS", "")
+        return cls(
+            name,
+            short_code=os.getenv(prefix + "SHORT_CODE"),
+            consumer_key=os.getenv(prefix + "CONSUMER_KEY"),
+            consumer_secret=os.getenv(prefix + "CONSUMER_SECRET"),
+            pass_key=os.getenv(prefix + "PASS_KEY"),
+            callback_url=os.getenv(prefix + "CALLBACK_URL"),
+            rate=float(os.getenv(prefix + "RATE", "0")),
+            max_connections=int(os.getenv(prefix + "MAX_CONNECTIONS", str(DARAJA_MAX_CONNECTIONS))),
+            max_concurrent=int(
+                os.getenv(prefix + "MAX_CONCURRENT", str(LNMORepository.MPESA_BULKHEAD_MAX_CONCURRENT))
+            ),
+            sellers=[int(seller) for seller in sellers.split(",") if seller.strip()],
+        )
+
+    def http_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = create_http_client(max_connections=self.max_connections)
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "short_code": self.short_code,
+            "rate": self.rate,
+            "max_connections": self.max_connections,
+            "sellers": sorted(self.sellers),
+            "token": self.token_cache.stats(),
+            "bulkhead": self.bulkhead.stats(),
+        }
+
+
+class ShortcodeRegistry:
+    """Picks the short code an order is paid to and the repository that talks to it
+
+    Lookups return None when no profile applies, and the caller falls back to the
+    default MPESA_LNMO_* repository.
+    """
+
+    def __init__(self, profiles: Iterable[ShortcodeProfile] = ()):
+        self.profiles: Dict[str, ShortcodeProfile] = {}
+        self._by_short_code: Dict[str, ShortcodeProfile] = {}
+        self._by_seller: Dict[int, ShortcodeProfile] = {}
+        self._repositories: Dict[str, LNMORepository] = {}
+        for profile in profiles:
+            self.add(profile)
+
+    @classmethod
+    def from_env(cls) -> "ShortcodeRegistry":
+        names = [name.strip() for name in MPESA_SHORTCODE_PROFILES.split(",") if name.strip()]
+        return cls(ShortcodeProfile.from_env(name) for name in names)
+
+    def add(self, profile: ShortcodeProfile) -> None:
+        if profile.short_code in self._by_short_code or profile.short_code == LNMORepository.MPESA_LNMO_SHORT_CODE:
+            raise ValueError(f"Short code {profile.short_code} is configured twice")
+        self.profiles[profile.name] = profile
+        self._by_short_code[profile.short_code] = profile
+        for seller in profile.sellers:
+            self._by_seller[seller] = profile
+        self._repositories[profile.name] = LNMORepository(profile)
+
+    def repositories(self) -> List[LNMORepository]:
+        return list(self._repositories.values())
+
+    def for_short_code(self, short_code: Optional[str]) -> Optional[LNMORepository]:
+        """The repository for a stored transaction, e.g. to query it by its party_b"""
+        profile = self._by_short_code.get(short_code)
+        return self._repositories[profile.name] if profile else None
+
+    def for_seller(self, seller_id: Optional[int]) -> Optional[LNMORepository]:
+        profile = self._by_seller.get(seller_id)
+        return self._repositories[profile.name] if profile else None
+
+    async def for_order(self, db: AsyncSession, order_id: int) -> Optional[LNMORepository]:
+        """The profile of the seller whose products make up the order, if there is exactly one"""
+        if not self._by_seller:
+            return None
+        result = await db.execute(
+            select(Products.user_id)
+            .join(OrderDetails, OrderDetails.product_id == Products.id)
+            .where(OrderDetails.order_id == order_id)
+            .distinct()
+        )
+        profiles = {self._by_seller.get(seller_id) for seller_id in result.scalars().all()}
+        if len(profiles) != 1:
+            # Orders mixing sellers are paid to the default short code
+            return None
+        profile = profiles.pop()
+        return self._repositories[profile.name] if profile else None
+
+    async def close(self) -> None:
+        for profile in self.profiles.values():
+            await profile.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {name: profile.stats() for name, profile in self.profiles.items()}
+
+
+shortcode_registry = ShortcodeRegistry.from_env()
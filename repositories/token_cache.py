@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TokenFetcher = Callable[[], Awaitable[Tuple[str, int]]]
+
+
+class AccessTokenCache:
+    """Caches a Daraja OAuth token until shortly before it expires.
+
+    Concurrent callers share one in-flight refresh, and a token that is close to
+    expiry is still served while a replacement is fetched in the background.
+    """
+
+    def __init__(self, refresh_margin: float = 300):
+        self.refresh_margin = refresh_margin
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._refresh_at = 0.0
+        self._refresh_task: Optional[asyncio.Task] = None
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.background_refreshes = 0
+        self.refresh_failures = 0
+        self.refresh_seconds_total = 0.0
+
+    async def get(self, fetch: TokenFetcher) -> str:
+        now = time.monotonic()
+        if self._token and now < self._expires_at:
+            self.hits += 1
+            if now >= self._refresh_at and not self._refreshing():
+                self.background_refreshes += 1
+                self._start_refresh(fetch)
+            return self._token
+
+        self.misses += 1
+        if not self._refreshing():
+            self._start_refresh(fetch)
+        # Shield so a cancelled caller does not cancel the refresh other callers wait on
+        return await asyncio.shield(self._refresh_task)
+
+    def invalidate(self) -> None:
+        """Drop the cached token, e.g. after Daraja rejects it"""
+        self._token = None
+        self._expires_at = 0.0
+        self._refresh_at = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        avg_refresh_ms = (self.refresh_seconds_total / self.refreshes * 1000) if self.refreshes else 0.0
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "refreshes": self.refreshes,
+            "background_refreshes": self.background_refreshes,
+            "refresh_failures": self.refresh_failures,
+            "avg_refresh_ms": round(avg_refresh_ms, 2),
+            "estimated_saved_ms": round(self.hits * avg_refresh_ms, 2),
+            "expires_in": max(round(self._expires_at - time.monotonic()), 0) if self._token else 0,
+        }
+
+    def _refreshing(self) -> bool:
+        return self._refresh_task is not None and not self._refresh_task.done()
+
+    def _start_refresh(self, fetch: TokenFetcher) -> None:
+        self._refresh_task = asyncio.ensure_future(self._refresh(fetch))
+        self._refresh_task.add_done_callback(self._on_refresh_done)
+
+    async def _refresh(self, fetch: TokenFetcher) -> str:
+        started = time.monotonic()
+        token, expires_in = await fetch()
+        expires_in = max(int(expires_in), 0)
+        self.refreshes += 1
+        self.refresh_seconds_total += time.monotonic() - started
+        # Measure expiry from when the request was sent so we never serve a stale token
+        self._token = token
+        self._expires_at = started + expires_in
+        self._refresh_at = self._expires_at - min(self.refresh_margin, expires_in / 2)
+        logger.info(f"Access token refreshed, expires in {expires_in}s")
+        return token
+
+    def _on_refresh_done(self, task: asyncio.Task) -> None:
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            self.refresh_failures += 1
+            logger.error(f"Access token refresh failed: {str(error)}")
@@ -0,0 +1,141 @@
+from typing import Any, Dict, List, Sequence
+
+from sqlalchemy import JSON, String, column, func, select, update, values
+from sqlalchemy.engine import Row
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Orders, OrderStatus, Transaction, TransactionStatus
+from outbox import ORDER_STATUS_CHANGED, TRANSACTION_STATUS_CHANGED, OutboxRecord, add_outbox_events
+
+# Terminal states an in-flight transaction can move to, and the order status each implies
+PENDING_TRANSITIONS = {
+    TransactionStatus.ACCEPTED: OrderStatus.DELIVERED,
+    TransactionStatus.REJECTED: None,
+    TransactionStatus.CANCELED: None,
+    # Set by the expiry sweeper when nobody answered the prompt; a late callback still resolves it
+    TransactionStatus.EXPIRED: None,
+}
+# Columns a resolution may fill in besides the status and feedback
+RESOLUTION_COLUMNS = ("transaction_code", "transaction_id")
+
+
+async def resolve_pending(
+    db: AsyncSession,
+    resolutions: Sequence[Dict[str, Any]],
+    match_on: str = "transaction_id",
+    from_statuses: Sequence[TransactionStatus] = (TransactionStatus.PENDING,),
+) -> List[Row]:
+    """Compare-and-set in-flight transactions to their resolved status without committing
+
+    Each resolution has the `match_on` column value (the CheckoutRequestID by default),
+    status, feedback and optionally transaction_code/transaction_id to fill in. Only rows
+    still in `from_statuses` change, and only those are returned as (id, order_id,
+    transaction_id, _status), so a replayed or late result is a no-op. The orders of
+    accepted payments move in the same statement on Postgres. Outbox events for the
+    moved rows are staged in the same transaction.
+    """
+    if not resolutions:
+        return []
+    for resolution in resolutions:
+        if resolution["status"] not in PENDING_TRANSITIONS:
+            raise ValueError(f"Invalid transition to {resolution['status']}")
+    fill_columns = [name for name in RESOLUTION_COLUMNS if name != match_on]
+    if db.bind.dialect.name == "postgresql":
+        moved = await _resolve_pending_cte(db, resolutions, match_on, from_statuses, fill_columns)
+        await add_outbox_events(db, outbox_events(moved))
+        return moved
+
+    transactions = Transaction.__table__
+    moved = []
+    for resolution in resolutions:
+        changes = {"_status": resolution["status"], "_feedback": resolution["feedback"]}
+        for name in fill_columns:
+            if resolution.get(name):
+                changes[name] = resolution[name]
+        result = await db.execute(
+            update(transactions)
+            .where(
+                transactions.c[match_on] == resolution[match_on],
+                transactions.c._status.in_(from_statuses),
+            )
+            .values(**changes)
+            .returning(transactions.c.id, transactions.c.order_id, transactions.c.transaction_id, transactions.c._status)
+        )
+        moved.extend(result.all())
+
+    for status, order_status in PENDING_TRANSITIONS.items():
+        order_ids = [row.order_id for row in moved if row._status == status and row.order_id]
+        if order_status is not None and order_ids:
+            await db.execute(update(Orders).where(Orders.order_id.in_(order_ids)).values(status=order_status))
+    await add_outbox_events(db, outbox_events(moved))
+    return moved
+
+
+def outbox_events(moved: Sequence[Row]) -> List[OutboxRecord]:
+    events = []
+    for row in moved:
+        events.append((TRANSACTION_STATUS_CHANGED, row.id, {
+            "id": row.id,
+            "transaction_id": row.transaction_id,
+            "order_id": row.order_id,
+            "status": row._status.value,
+        }))
+        order_status = PENDING_TRANSITIONS[row._status]
+        if order_status is not None and row.order_id:
+            events.append((ORDER_STATUS_CHANGED, row.order_id, {
+                "order_id": row.order_id,
+                "status": order_status.value,
+            }))
+    return events
+
+
+async def _resolve_pending_cte(
+    db: AsyncSession,
+    resolutions: Sequence[Dict[str, Any]],
+    match_on: str,
+    from_statuses: Sequence[TransactionStatus],
+    fill_columns: List[str],
+) -> List[Row]:
+    """One UPDATE ... FROM (VALUES ...) RETURNING for the batch, with the order updates as CTEs"""
+    transactions = Transaction.__table__
+    resolved = values(
+        column(match_on, String),
+        column("status", transactions.c._status.type),
+        column("feedback", JSON),
+        *[column(name, String) for name in fill_columns],
+        name="resolved",
+    ).data([
+        (
+            resolution[match_on],
+            resolution["status"],
+            resolution["feedback"],
+            *[resolution.get(name) for name in fill_columns],
+        )
+        for resolution in resolutions
+    ])
+    moved = (
+        update(transactions)
+        .where(
+            transactions.c[match_on] == resolved.c[match_on],
+            transactions.c._status.in_(from_statuses),
+        )
+        .values(
+            _status=resolved.c.status,
+            _feedback=resolved.c.feedback,
+            **{name: func.coalesce(resolved.c[name], transactions.c[name]) for name in fill_columns},
+        )
+        .returning(transactions.c.id, transactions.c.order_id, transactions.c.transaction_id, transactions.c._status)
+        .cte("moved")
+    )
+    stmt = select(moved.c.id, moved.c.order_id, moved.c.transaction_id, moved.c._status)
+    for status, order_status in PENDING_TRANSITIONS.items():
+        if order_status is None:
+            continue
+        stmt = stmt.add_cte(
+            update(Orders)
+            .where(Orders.order_id.in_(select(moved.c.order_id).where(moved.c._status == status)))
+            .values(status=order_status)
+            .cte(f"orders_{status.value.lower()}")
+        )
+    result = await db.execute(stmt)
+    return result.all()
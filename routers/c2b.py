@@ -0,0 +1,65 @@
+import json
+import logging
+import os
+from decimal import Decimal, InvalidOperation
+
+from fastapi import APIRouter, Request, Response, status
+
+from repositories.lnmo_repository import LNMORepository
+from workers.c2b_ingest import c2b_writer, transaction_row
+
+logger = logging.getLogger(__name__)
+
+MPESA_C2B_SHORT_CODE = os.getenv("MPESA_C2B_SHORT_CODE", LNMORepository.MPESA_LNMO_SHORT_CODE)
+
+router = APIRouter(prefix="/ipn/daraja/c2b", tags=["C2B"])
+
+# Daraja only reads the result code, so the bodies are encoded once instead of per request
+ACCEPTED = b'{"ResultCode":0,"ResultDesc":"Accepted"}'
+INVALID_AMOUNT = b'{"ResultCode":"C2B00013","ResultDesc":"Rejected"}'
+INVALID_SHORT_CODE = b'{"ResultCode":"C2B00015","ResultDesc":"Rejected"}'
+OTHER_ERROR = b'{"ResultCode":"C2B00016","ResultDesc":"Rejected"}'
+
+
+def json_response(body: bytes, status_code: int = status.HTTP_200_OK) -> Response:
+    return Response(content=body, status_code=status_code, media_type="application/json")
+
+
+@router.post("/validation", status_code=status.HTTP_200_OK)
+async def c2b_validation(request: Request):
+    """Accept or reject a C2B payment before M-Pesa completes it"""
+    LNMORepository.ensure_trusted_source(request)
+    try:
+        data = json.loads(await request.body())
+    except ValueError:
+        return json_response(OTHER_ERROR)
+    if str(data.get("BusinessShortCode")) != MPESA_C2B_SHORT_CODE:
+        logger.warning(f"Rejected C2B payment {data.get('TransID')} to short code {data.get('BusinessShortCode')}")
+        return json_response(INVALID_SHORT_CODE)
+    try:
+        if Decimal(str(data.get("TransAmount"))) <= 0:
+            return json_response(INVALID_AMOUNT)
+    except InvalidOperation:
+        return json_response(INVALID_AMOUNT)
+    return json_response(ACCEPTED)
+
+
+@router.post("/confirmation", status_code=status.HTTP_200_OK)
+async def c2b_confirmation(request: Request):
+    """Store a completed C2B payment; redeliveries of a TransID are acknowledged without a write"""
+    LNMORepository.ensure_trusted_source(request)
+    try:
+        data = json.loads(await request.body())
+        trans_id = str(data["TransID"])
+        if c2b_writer.seen(trans_id):
+            return json_response(ACCEPTED)
+        row = transaction_row(data)
+    except (ValueError, KeyError, TypeError) as e:
+        logger.error(f"Invalid C2B confirmation: {str(e)}")
+        return json_response(OTHER_ERROR, status.HTTP_400_BAD_REQUEST)
+    try:
+        await c2b_writer.submit(row)
+    except Exception:
+        # Not acknowledged, so M-Pesa delivers the confirmation again
+        return json_response(b'{"detail":"Error storing confirmation"}', status.HTTP_500_INTERNAL_SERVER_ERROR)
+    return json_response(ACCEPTED)
@@ -0,0 +1,231 @@
+import csv
+import io
+import logging
+import os
+from datetime import datetime
+from decimal import Decimal
+from typing import Annotated, List
+
+from fastapi import APIRouter, Depends, File, HTTPException, Query, Request, UploadFile, status
+from pydantic import ValidationError
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from auth import get_active_user
+from database import db_dependency
+from models import PayoutBatch, Transaction, TransactionStatus
+from models.transaction import TransactionAggregator, TransactionCategory, TransactionChannel, TransactionType
+from pydantic_model import PayoutBatchCreate, PayoutBatchResponse, PayoutItem, PayoutResolution, PayoutReviewItem, Role
+from repositories.lnmo_repository import LNMORepository
+from repositories.transaction_state import resolve_pending
+from workers.callback_inbox import enqueue_callback
+from workers.payout_dispatcher import payout_dispatcher
+
+logger = logging.getLogger(__name__)
+
+MPESA_B2C_MAX_BATCH_SIZE = int(os.getenv("MPESA_B2C_MAX_BATCH_SIZE", "20000"))
+
+router = APIRouter(tags=["payouts"])
+
+
+def require_admin(user: Annotated[dict, Depends(get_active_user)]):
+    if user.get("role") != Role.ADMIN:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return user
+
+admin_dependency = Annotated[dict, Depends(require_admin)]
+
+
+@router.post("/admin/payouts", response_model=PayoutBatchResponse, status_code=status.HTTP_201_CREATED)
+async def create_payout_batch(payload: PayoutBatchCreate, request: Request, user: admin_dependency, db: db_dependency):
+    return await store_payout_batch(request, db, user, payload.reference, payload.items, "api")
+
+
+@router.post("/admin/payouts/upload", response_model=PayoutBatchResponse, status_code=status.HTTP_201_CREATED)
+async def upload_payout_batch(
+    request: Request,
+    user: admin_dependency,
+    db: db_dependency,
+    reference: str = Query(..., min_length=1, max_length=100),
+    file: UploadFile = File(...),
+):
+    """CSV with a header row: phone_number,amount and optionally remarks,user_id"""
+    items = []
+    try:
+        reader = csv.DictReader(io.StringIO((await file.read()).decode("utf-8-sig")))
+        for line, row in enumerate(reader, start=2):
+            try:
+                items.append(PayoutItem(**{key: value for key, value in row.items() if value not in (None, "")}))
+            except ValidationError as e:
+                errors = "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+                raise HTTPException(status_code=400, detail=f"Invalid payout on line {line}: {errors}")
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise HTTPException(status_code=400, detail=f"Unreadable payout file: {str(e)}")
+    return await store_payout_batch(request, db, user, reference, items, "file")
+
+
+@router.get("/admin/payouts/review", response_model=List[PayoutReviewItem], status_code=status.HTTP_200_OK)
+async def list_payouts_for_review(user: admin_dependency, db: db_dependency, limit: int = Query(100, ge=1, le=1000)):
+    """Payouts that may or may not have been paid, oldest first"""
+    result = await db.execute(
+        select(
+            Transaction._pid,
+            Transaction.payout_batch_id,
+            Transaction.party_b,
+            Transaction.transaction_amount,
+            Transaction.updated_at,
+        )
+        .where(Transaction.transaction_channel == TransactionChannel.B2C, Transaction._status == TransactionStatus.UNKNOWN)
+        .order_by(Transaction.updated_at, Transaction.id)
+        .limit(limit)
+    )
+    return [
+        {
+            "pid": row._pid,
+            "batch_id": row.payout_batch_id,
+            "phone_number": row.party_b,
+            "amount": float(row.transaction_amount),
+            "updated_at": row.updated_at,
+        }
+        for row in result.all()
+    ]
+
+
+@router.post("/admin/payouts/review/{pid}", status_code=status.HTTP_200_OK)
+async def resolve_payout(pid: str, resolution: PayoutResolution, user: admin_dependency, db: db_dependency):
+    """Settle an UNKNOWN payout from the M-Pesa statement; PENDING sends it again"""
+    if resolution.status.value not in ("ACCEPTED", "REJECTED", "PENDING"):
+        raise HTTPException(status_code=400, detail="A payout can only be resolved to ACCEPTED, REJECTED or PENDING")
+    status_value = TransactionStatus(resolution.status.value)
+    feedback = {"resolved_by": user.get("id"), "note": resolution.note, "resolved_at": datetime.utcnow().isoformat()}
+    try:
+        if status_value == TransactionStatus.PENDING:
+            result = await db.execute(
+                update(Transaction.__table__)
+                .where(Transaction._pid == pid, Transaction._status == TransactionStatus.UNKNOWN)
+                .values(_status=TransactionStatus.PENDING, _feedback=feedback)
+            )
+            moved = result.rowcount
+        else:
+            moved = len(await resolve_pending(db, [{
+                "_pid": pid,
+                "status": status_value,
+                "feedback": feedback,
+                "transaction_code": resolution.transaction_code,
+            }], match_on="_pid", from_statuses=(TransactionStatus.UNKNOWN,)))
+        await db.commit()
+    except SQLAlchemyError as e:
+        await db.rollback()
+        logger.error(f"Error resolving payout {pid}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error resolving payout")
+    if not moved:
+        raise HTTPException(status_code=409, detail=f"Payout {pid} is not awaiting review")
+    if status_value == TransactionStatus.PENDING:
+        payout_dispatcher.notify()
+    logger.info(f"Payout {pid} resolved to {status_value.value} by user {user.get('id')}")
+    return {"message": f"Payout {pid} resolved to {status_value.value}"}
+
+
+@router.get("/admin/payouts/{batch_id}", response_model=PayoutBatchResponse, status_code=status.HTTP_200_OK)
+async def get_payout_batch(batch_id: int, user: admin_dependency, db: db_dependency):
+    batch = await db.get(PayoutBatch, batch_id)
+    if not batch:
+        raise HTTPException(status_code=404, detail="Payout batch not found")
+    return await batch_response(db, batch)
+
+
+@router.post("/ipn/daraja/b2c/result", status_code=status.HTTP_200_OK)
+async def b2c_result(request: Request, db: db_dependency):
+    """Result and queue-timeout callbacks; stored raw and applied in batches by the inbox worker"""
+    LNMORepository.ensure_trusted_source(request)
+    try:
+        await enqueue_callback(db, await request.body(), source="b2c")
+        return {"ResultCode": 0, "ResultDesc": "Accepted"}
+    except Exception as e:
+        await db.rollback()
+        logger.error(f"Error storing B2C result: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error storing result")
+
+
+async def store_payout_batch(request: Request, db, user: dict, reference: str, items: List[PayoutItem], source: str):
+    b2c_repo = getattr(request.app.state, "b2c_repo", None)
+    if b2c_repo is None:
+        raise HTTPException(status_code=503, detail="B2C payouts are not enabled")
+    if not items:
+        raise HTTPException(status_code=400, detail="Payout batch is empty")
+    if len(items) > MPESA_B2C_MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"Payout batch exceeds {MPESA_B2C_MAX_BATCH_SIZE} items")
+    if any(item.amount != int(item.amount) for item in items):
+        raise HTTPException(status_code=400, detail="B2C amounts must be whole shillings")
+
+    now = datetime.utcnow()
+    try:
+        batch = PayoutBatch(
+            reference=reference,
+            source=source,
+            total_count=len(items),
+            total_amount=sum(Decimal(int(item.amount)) for item in items),
+            created_by=user.get("id"),
+            created_at=now,
+        )
+        db.add(batch)
+        await db.flush()
+        # One multi-row INSERT for the whole batch instead of an ORM object per payout
+        await db.execute(insert(Transaction), [
+            {
+                "_pid": f"PAYOUT-{batch.id}-{index}",
+                "party_a": b2c_repo.MPESA_B2C_SHORT_CODE,
+                "party_b": item.phone_number,
+                "account_reference": reference,
+                "transaction_category": TransactionCategory.PAYOUT,
+                "transaction_type": TransactionType.DEBIT,
+                "transaction_channel": TransactionChannel.B2C,
+                "transaction_aggregator": TransactionAggregator.MPESA_KE,
+                "transaction_amount": int(item.amount),
+                "transaction_timestamp": now,
+                "transaction_details": item.remarks or f"Payout {reference}",
+                "_feedback": {},
+                "_status": TransactionStatus.PENDING,
+                "created_at": now,
+                "user_id": item.user_id,
+                "payout_batch_id": batch.id,
+            }
+            for index, item in enumerate(items)
+        ])
+        await db.commit()
+    except IntegrityError as e:
+        await db.rollback()
+        # Only a taken reference is the client's conflict; any other violation is ours
+        if await reference_taken(db, reference):
+            raise HTTPException(status_code=409, detail=f"Payout batch {reference} already exists")
+        logger.error(f"Error storing payout batch {reference}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error storing payout batch")
+    except SQLAlchemyError as e:
+        await db.rollback()
+        logger.error(f"Error storing payout batch {reference}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error storing payout batch")
+
+    payout_dispatcher.notify()
+    logger.info(f"Payout batch {reference} stored with {len(items)} payouts by user {user.get('id')}")
+    return await batch_response(db, batch)
+
+
+async def reference_taken(db, reference: str) -> bool:
+    result = await db.execute(select(PayoutBatch.id).where(PayoutBatch.reference == reference))
+    return result.first() is not None
+
+
+async def batch_response(db, batch: PayoutBatch) -> dict:
+    result = await db.execute(
+        select(Transaction._status, func.count())
+        .where(Transaction.payout_batch_id == batch.id)
+        .group_by(Transaction._status)
+    )
+    return {
+        "batch_id": batch.id,
+        "reference": batch.reference,
+        "total_count": batch.total_count,
+        "total_amount": float(batch.total_amount),
+        "created_at": batch.created_at,
+        "status_counts": {row[0].value: row[1] for row in result.all()},
+    }
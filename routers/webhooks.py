@@ -0,0 +1,59 @@
+import logging
+from typing import List
+
+from fastapi import APIRouter, HTTPException, status
+from sqlalchemy import select
+
+from database import db_dependency
+from models import Webhook
+from pydantic_model import WebhookCreate, WebhookResponse
+from routers.payouts import admin_dependency
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/admin/webhooks", tags=["webhooks"])
+
+
+def webhook_response(webhook: Webhook) -> dict:
+    return {
+        "id": webhook.id,
+        "url": webhook.url,
+        "event_types": [name.strip() for name in webhook.event_types.split(",")],
+        "max_concurrency": webhook.max_concurrency,
+        "active": webhook.active,
+        "created_at": webhook.created_at,
+    }
+
+
+@router.post("", response_model=WebhookResponse, status_code=status.HTTP_201_CREATED)
+async def create_webhook(payload: WebhookCreate, user: admin_dependency, db: db_dependency):
+    """Register an endpoint for outbox events; only events created afterwards are delivered"""
+    webhook = Webhook(
+        url=payload.url,
+        secret=payload.secret,
+        event_types=",".join(payload.event_types) or "*",
+        max_concurrency=payload.max_concurrency,
+        created_by=user.get("id"),
+    )
+    db.add(webhook)
+    await db.commit()
+    await db.refresh(webhook)
+    logger.info(f"Webhook {webhook.id} registered for {webhook.event_types} by user {user.get('id')}")
+    return webhook_response(webhook)
+
+
+@router.get("", response_model=List[WebhookResponse], status_code=status.HTTP_200_OK)
+async def list_webhooks(user: admin_dependency, db: db_dependency):
+    result = await db.execute(select(Webhook).order_by(Webhook.id))
+    return [webhook_response(webhook) for webhook in result.scalars().all()]
+
+
+@router.delete("/{webhook_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def deactivate_webhook(webhook_id: int, user: admin_dependency, db: db_dependency):
+    """Stop deliveries to an endpoint; its delivery history is kept"""
+    webhook = await db.get(Webhook, webhook_id)
+    if not webhook:
+        raise HTTPException(status_code=404, detail="Webhook not found")
+    webhook.active = False
+    await db.commit()
+    logger.info(f"Webhook {webhook_id} deactivated by user {user.get('id')}")
@@ -0,0 +1,87 @@
+import logging
+import os
+import re
+from typing import List
+
+from sqlalchemy import func, literal_column, or_, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from database import engine
+from models import Products
+
+logger = logging.getLogger(__name__)
+
+# "fulltext" uses the tsvector and trigram indexes on Postgres; "ilike" scans like before
+PRODUCT_SEARCH_MODE = os.getenv("PRODUCT_SEARCH_MODE", "fulltext").lower()
+
+# Maintained by Postgres itself, so no model column: create_all also runs on SQLite.
+# The 'simple' configuration does no stemming, which suits names and brands and lets
+# prefixes of half-typed words match.
+PRODUCT_SEARCH_DDL = [
+    """
+    ALTER TABLE products ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', coalesce(name, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(brand, '')), 'B') ||
+        setweight(to_tsvector('simple', coalesce(description, '')), 'C')
+    ) STORED
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_products_search_vector ON products USING gin (search_vector)",
+]
+PRODUCT_TRIGRAM_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_products_name_trgm ON products USING gin (name gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_products_brand_trgm ON products USING gin (brand gin_trgm_ops)",
+]
+
+search_vector = literal_column("products.search_vector")
+_trigram_available = True
+
+
+async def create_search_indexes(conn: AsyncConnection) -> None:
+    """Add the search column and indexes; pg_trgm is optional and only adds substring matches"""
+    global _trigram_available
+    for statement in PRODUCT_SEARCH_DDL:
+        await conn.execute(text(statement))
+    try:
+        async with conn.begin_nested():
+            for statement in PRODUCT_TRIGRAM_DDL:
+                await conn.execute(text(statement))
+    except Exception as e:
+        _trigram_available = False
+        logger.warning(f"pg_trgm unavailable, product search falls back to full-text matches only: {str(e)}")
+
+
+def fulltext_enabled() -> bool:
+    return PRODUCT_SEARCH_MODE == "fulltext" and engine.dialect.name == "postgresql"
+
+
+def prefix_query(term: str) -> str:
+    """'red sho' -> 'red:* & sho:*'; only word characters reach to_tsquery"""
+    return " & ".join(f"{word}:*" for word in re.findall(r"\w+", term.lower()))
+
+
+def product_search_filter(term: str):
+    pattern = f"%{term}%"
+    terms = prefix_query(term)
+    if not fulltext_enabled() or not terms:
+        return or_(
+            Products.name.ilike(pattern),
+            Products.brand.ilike(pattern),
+            Products.description.ilike(pattern),
+        )
+    matches = search_vector.op("@@")(func.to_tsquery("simple", terms))
+    if not _trigram_available:
+        return matches
+    # Trigram indexes serve the ILIKEs, so matches inside a word need no scan either
+    return or_(matches, Products.name.ilike(pattern), Products.brand.ilike(pattern))
+
+
+def product_search_order(term: str) -> List:
+    """Most relevant first; empty where there is nothing to rank by"""
+    terms = prefix_query(term)
+    if not fulltext_enabled() or not terms:
+        return []
+    rank = func.ts_rank_cd(search_vector, func.to_tsquery("simple", terms))
+    if _trigram_available:
+        rank = rank + func.similarity(Products.name, term)
+    return [rank.desc(), Products.id]
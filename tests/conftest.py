@@ -0,0 +1,34 @@
+# Run with: pip install -r requirements-dev.txt && python -m pytest
+import os
+import tempfile
+
+# Point database.py at a throwaway SQLite file before anything imports it
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}"
+# The M-Pesa repositories refuse to start without credentials; Daraja itself is never called
+for name in (
+    "MPESA_LNMO_CONSUMER_KEY", "MPESA_LNMO_CONSUMER_SECRET", "MPESA_LNMO_PASS_KEY",
+    "MPESA_B2C_SHORT_CODE", "MPESA_B2C_INITIATOR_NAME", "MPESA_B2C_SECURITY_CREDENTIAL", "MPESA_B2C_RESULT_URL",
+):
+    os.environ.setdefault(name, "test")
+
+import pytest
+
+import models  # noqa: F401  registers every table on Base
+from database import Base, engine
+
+engine.echo = False
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def db():
+    """Fresh tables for one test; pooled connections are dropped with the test's event loop"""
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    yield
+    await engine.dispose()
@@ -0,0 +1,60 @@
+"""Rows for tests that need data in place; every helper commits in its own session"""
+import uuid
+from datetime import datetime
+
+from database import async_session
+from models import OrderDetails, Orders, Products, Transaction, TransactionStatus
+from models.transaction import TransactionAggregator, TransactionCategory, TransactionChannel, TransactionType
+
+
+async def add_order(**columns) -> Orders:
+    async with async_session() as session:
+        order = Orders(total=100, **columns)
+        session.add(order)
+        await session.commit()
+        return order
+
+
+async def add_product(**columns) -> Products:
+    values = {"name": f"product {uuid.uuid4().hex[:8]}", "cost": 50, "price": 100, "stock_quantity": 10, **columns}
+    async with async_session() as session:
+        product = Products(**values)
+        session.add(product)
+        await session.commit()
+        return product
+
+
+async def add_order_lines(order: Orders, *products: Products) -> None:
+    async with async_session() as session:
+        session.add_all([
+            OrderDetails(order_id=order.order_id, product_id=product.id, quantity=1, total_price=product.price)
+            for product in products
+        ])
+        await session.commit()
+
+
+async def add_transaction(**columns) -> Transaction:
+    """An STK purchase transaction, PENDING unless `columns` say otherwise"""
+    pid = uuid.uuid4().hex
+    values = {
+        "_pid": pid,
+        "party_a": "254708374149",
+        "party_b": "174379",
+        "account_reference": "order",
+        "transaction_category": TransactionCategory.PURCHASE_ORDER,
+        "transaction_type": TransactionType.CREDIT,
+        "transaction_channel": TransactionChannel.LNMO,
+        "transaction_aggregator": TransactionAggregator.MPESA_KE,
+        "transaction_id": f"ws_CO_{pid}",
+        "transaction_amount": 100,
+        "transaction_details": "Payment for order",
+        "_feedback": {},
+        "_status": TransactionStatus.PENDING,
+        "created_at": datetime.utcnow(),
+        **columns,
+    }
+    async with async_session() as session:
+        transaction = Transaction(**values)
+        session.add(transaction)
+        await session.commit()
+        return transaction
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+
+from database import async_session
+from models import Transaction
+from workers.c2b_ingest import C2BBatchWriter, transaction_row
+
+pytestmark = pytest.mark.anyio
+
+
+def confirmation(trans_id: str, **overrides) -> dict:
+    return transaction_row({
+        "TransID": trans_id,
+        "TransAmount": "100.00",
+        "TransTime": "20240101120000",
+        "MSISDN": "254708374149",
+        "BusinessShortCode": "600000",
+        "BillRefNumber": "order-1",
+        **overrides,
+    })
+
+
+async def stored_codes() -> list:
+    async with async_session() as db:
+        return sorted((await db.execute(select(Transaction.transaction_code))).scalars().all())
+
+
+async def test_a_batch_inserts_each_confirmation_once(db):
+    writer = C2BBatchWriter(batch_size=10, max_wait=0.01)
+    rows = [confirmation("A1"), confirmation("A2"), confirmation("A1"), confirmation("A3")]
+    assert await asyncio.gather(*[writer.submit(row) for row in rows]) == [True, True, False, True]
+    assert await stored_codes() == ["A1", "A2", "A3"]
+    stats = writer.stats()
+    assert (stats["batches"], stats["inserted"], stats["duplicates_batch"], stats["duplicates_db"]) == (1, 3, 1, 0)
+    assert writer.seen("A2")
+
+
+async def test_confirmations_already_stored_are_not_new(db):
+    writer = C2BBatchWriter(batch_size=2, max_wait=0.01)
+    await writer.submit(confirmation("B1"))
+    # A new writer, as in another worker, only learns from the unique index
+    writer = C2BBatchWriter(batch_size=2, max_wait=0.01)
+    assert await asyncio.gather(writer.submit(confirmation("B1")), writer.submit(confirmation("B2"))) == [False, True]
+    assert (writer.duplicates_db, writer.duplicates_batch) == (1, 0)
+    async with async_session() as session:
+        assert await session.scalar(select(func.count()).select_from(Transaction)) == 2
+
+
+async def test_a_bad_row_fails_only_its_own_caller(db):
+    writer = C2BBatchWriter(batch_size=3, max_wait=0.01)
+    poisoned = {**confirmation("C2"), "party_a": None}
+    results = await asyncio.gather(
+        writer.submit(confirmation("C1")), writer.submit(poisoned), writer.submit(confirmation("C3")),
+        return_exceptions=True,
+    )
+    assert results[0] is True and results[2] is True
+    assert isinstance(results[1], IntegrityError)
+    assert await stored_codes() == ["C1", "C3"]
+    stats = writer.stats()
+    assert (stats["row_fallbacks"], stats["failed_rows"], stats["inserted"], stats["duplicates_db"]) == (1, 1, 2, 0)
+    assert not writer.seen("C2")
+
+
+async def test_stop_flushes_the_pending_batch(db):
+    writer = C2BBatchWriter(batch_size=100, max_wait=60)
+    submitted = asyncio.create_task(writer.submit(confirmation("D1")))
+    await asyncio.sleep(0)
+    await writer.stop()
+    assert await submitted is True
@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+
+import cache
+from cache import BytesCache, SingleFlight, TTLCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_ttl_cache_expires_entries(clock):
+    ttl_cache = TTLCache(maxsize=10, ttl=5)
+    ttl_cache.set("a", 1)
+    ttl_cache.set("b", 2, ttl=60)
+    clock[0] += 10
+    assert ttl_cache.get("a") is None
+    assert ttl_cache.get("b") == 2
+    assert ttl_cache.stats()["hits"] == 1
+    assert ttl_cache.stats()["misses"] == 1
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    ttl_cache = TTLCache(maxsize=2, ttl=60)
+    ttl_cache.set("a", 1)
+    ttl_cache.set("b", 2)
+    ttl_cache.get("a")
+    ttl_cache.set("c", 3)
+    assert ttl_cache.get("b") is None
+    assert ttl_cache.get("a") == 1
+    assert ttl_cache.get("c") == 3
+
+
+def test_bytes_cache_is_bounded_by_size():
+    bytes_cache = BytesCache(max_bytes=10, maxsize=100, ttl=60)
+    bytes_cache.set("a", b"12345")
+    bytes_cache.set("b", b"12345")
+    bytes_cache.set("c", b"123")
+    assert bytes_cache.get("a") is None
+    assert bytes_cache.bytes == 8
+    assert bytes_cache.stats()["evictions"] == 1
+
+
+def test_bytes_cache_skips_bodies_larger_than_the_cache():
+    bytes_cache = BytesCache(max_bytes=4)
+    bytes_cache.set("a", b"12345")
+    assert len(bytes_cache) == 0
+    assert bytes_cache.bytes == 0
+
+
+def test_bytes_cache_replacing_a_key_keeps_the_byte_count(clock):
+    bytes_cache = BytesCache(max_bytes=100, ttl=5)
+    bytes_cache.set("a", b"12345")
+    bytes_cache.set("a", b"12")
+    assert bytes_cache.bytes == 2
+    clock[0] += 10
+    assert bytes_cache.get("a") is None
+    assert bytes_cache.bytes == 0
+
+
+@pytest.mark.anyio
+async def test_single_flight_shares_one_call():
+    flight = SingleFlight()
+    calls = 0
+    release = asyncio.Event()
+
+    async def load():
+        nonlocal calls
+        calls += 1
+        await release.wait()
+        return "value"
+
+    waiters = [asyncio.create_task(flight.do("key", load)) for _ in range(3)]
+    await asyncio.sleep(0)
+    assert flight.in_flight("key")
+    release.set()
+    assert await asyncio.gather(*waiters) == ["value"] * 3
+    assert calls == 1
+    assert flight.shared == 2
+    assert not flight.in_flight("key")
+
+
+@pytest.mark.anyio
+async def test_single_flight_survives_a_cancelled_caller():
+    flight = SingleFlight()
+    release = asyncio.Event()
+
+    async def load():
+        await release.wait()
+        return "value"
+
+    first = asyncio.create_task(flight.do("key", load))
+    second = asyncio.create_task(flight.do("key", load))
+    await asyncio.sleep(0)
+    first.cancel()
+    release.set()
+    assert await second == "value"
+
+
+@pytest.mark.anyio
+async def test_single_flight_passes_errors_to_every_caller():
+    flight = SingleFlight()
+
+    async def load():
+        await asyncio.sleep(0)
+        raise ValueError("boom")
+
+    results = await asyncio.gather(flight.do("key", load), flight.do("key", load), return_exceptions=True)
+    assert all(isinstance(result, ValueError) for result in results)
+    assert not flight.in_flight("key")
@@ -0,0 +1,70 @@
+import json
+
+import pytest
+from sqlalchemy import select
+
+import workers.callback_inbox as inbox
+from database import async_session
+from factories import add_transaction
+from models import CallbackInbox, Transaction, TransactionStatus
+from workers.callback_inbox import CallbackInboxWorker, enqueue_callback
+
+pytestmark = pytest.mark.anyio
+
+
+def stk_callback(checkout_request_id: str, result_code: int = 1032) -> bytes:
+    return json.dumps({"Body": {"stkCallback": {
+        "CheckoutRequestID": checkout_request_id, "ResultCode": result_code, "ResultDesc": "done",
+    }}}).encode()
+
+
+async def enqueue(body: bytes) -> None:
+    async with async_session() as db:
+        await enqueue_callback(db, body)
+
+
+async def inbox_rows() -> list:
+    async with async_session() as db:
+        return (await db.execute(select(CallbackInbox).order_by(CallbackInbox.id))).scalars().all()
+
+
+async def test_stored_callbacks_are_applied_in_one_batch(db):
+    transactions = [await add_transaction() for _ in range(3)]
+    inbox.callback_inbox_worker._wake.clear()
+    for transaction in transactions:
+        await enqueue(stk_callback(transaction.transaction_id))
+    assert inbox.callback_inbox_worker._wake.is_set()
+
+    worker = CallbackInboxWorker(batch_size=10)
+    assert await worker.drain_once() == 3
+    assert await worker.drain_once() == 0
+    async with async_session() as session:
+        statuses = (await session.execute(select(Transaction._status))).scalars().all()
+    assert statuses == [TransactionStatus.CANCELED] * 3
+    assert all(row.processed_at is not None for row in await inbox_rows())
+    assert (worker.batches, worker.processed, worker.last_batch_size) == (1, 3, 3)
+
+
+async def test_a_bad_callback_is_retried_without_holding_up_the_batch(db, monkeypatch):
+    transaction = await add_transaction()
+    await enqueue(b"not json")
+    await enqueue(stk_callback(transaction.transaction_id))
+    worker = CallbackInboxWorker(batch_size=10)
+    assert await worker.drain_once() == 2
+    bad, good = await inbox_rows()
+    assert (bad.processed_at, bad.attempts) == (None, 1) and bad.last_error
+    assert good.processed_at is not None
+    assert (worker.processed, worker.failed) == (1, 1)
+
+    monkeypatch.setattr(inbox, "CALLBACK_INBOX_MAX_ATTEMPTS", 2)
+    assert await worker.drain_once() == 1
+    # Out of attempts, it stays in the table for someone to look at
+    assert await worker.drain_once() == 0
+    assert (await inbox_rows())[0].attempts == 2
+
+
+async def test_a_batch_is_capped_at_its_size(db):
+    for _ in range(5):
+        await enqueue(stk_callback((await add_transaction()).transaction_id))
+    worker = CallbackInboxWorker(batch_size=2)
+    assert [await worker.drain_once() for _ in range(4)] == [2, 2, 1, 0]
@@ -0,0 +1,189 @@
+import asyncio
+import json
+
+import pytest
+from starlette.requests import Request
+
+from catalog_cache import CATEGORIES_KEY, CatalogCache, product_key
+from database import async_session
+
+pytestmark = pytest.mark.anyio
+
+
+class Loader:
+    def __init__(self, body: bytes = b"[]"):
+        self.body = body
+        self.calls = 0
+        self.release = None
+
+    async def __call__(self) -> bytes:
+        self.calls += 1
+        if self.release is not None:
+            await self.release.wait()
+        return self.body
+
+
+async def test_a_loaded_body_is_served_from_memory():
+    cache, load = CatalogCache(), Loader()
+    assert await cache.get_or_load(CATEGORIES_KEY, load) == b"[]"
+    assert await cache.get_or_load(CATEGORIES_KEY, load) == b"[]"
+    assert load.calls == 1
+
+
+async def test_keys_are_dropped_once_the_write_commits(db):
+    cache, load = CatalogCache(), Loader()
+    await cache.get_or_load(product_key(1), load)
+    await cache.get_or_load(product_key(2), load)
+    async with async_session() as session:
+        await cache.invalidate(session, product_key(1))
+        await cache.get_or_load(product_key(1), load)
+        assert load.calls == 2
+        await session.commit()
+    await cache.get_or_load(product_key(1), load)
+    await cache.get_or_load(product_key(2), load)
+    assert load.calls == 3
+
+
+async def test_a_rolled_back_write_drops_nothing(db):
+    cache, load = CatalogCache(), Loader()
+    await cache.get_or_load(product_key(1), load)
+    async with async_session() as session:
+        await cache.invalidate(session, product_key(1))
+        await session.rollback()
+    await cache.get_or_load(product_key(1), load)
+    assert load.calls == 1
+    assert cache.invalidations == 0
+
+
+async def test_savepoints_keep_only_their_own_invalidations(db):
+    cache, load = CatalogCache(), Loader()
+    for key in (product_key(1), product_key(2), product_key(3)):
+        await cache.get_or_load(key, load)
+    async with async_session() as session:
+        await cache.invalidate(session, product_key(1))
+        async with session.begin_nested():
+            await cache.invalidate(session, product_key(2))
+        savepoint = await session.begin_nested()
+        await cache.invalidate(session, product_key(3))
+        await savepoint.rollback()
+        await session.commit()
+    for key in (product_key(1), product_key(2), product_key(3)):
+        await cache.get_or_load(key, load)
+    assert load.calls == 5
+
+
+async def test_a_load_racing_an_invalidation_is_not_stored():
+    cache, load = CatalogCache(), Loader()
+    load.release = asyncio.Event()
+    loading = asyncio.create_task(cache.get_or_load(CATEGORIES_KEY, load))
+    while not load.calls:
+        await asyncio.sleep(0)
+    cache.drop([CATEGORIES_KEY])
+    load.release.set()
+    await loading
+    await cache.get_or_load(CATEGORIES_KEY, load)
+    assert load.calls == 2
+
+
+async def test_notifications_from_other_workers_drop_keys():
+    cache, load = CatalogCache(), Loader()
+    await cache.get_or_load(product_key(1), load)
+    cache.handle_notification(json.dumps({"version": 7, "keys": [product_key(1)]}))
+    await cache.get_or_load(product_key(1), load)
+    assert load.calls == 2
+    assert cache.version == 7
+    cache.handle_notification(json.dumps({"version": 5, "keys": []}))
+    assert cache.version == 7
+
+
+async def test_resync_clears_everything(db):
+    cache, load = CatalogCache(), Loader()
+    await cache.get_or_load(product_key(1), load)
+    await cache.get_or_load(CATEGORIES_KEY, load)
+    await cache.resync()
+    assert len(cache._cache) == 0
+    assert cache.stats()["resyncs"] == 1
+
+
+def conditional_request(if_none_match: str = None) -> Request:
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match else []
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": headers})
+
+
+async def test_responses_carry_a_content_etag():
+    cache = CatalogCache()
+    response = cache.respond(conditional_request(), b'{"id": 1}')
+    assert response.status_code == 200
+    assert response.body == b'{"id": 1}'
+    assert response.headers["etag"].startswith('"')
+    assert "max-age" in response.headers["cache-control"]
+    assert cache.respond(conditional_request(), b'{"id": 1}').headers["etag"] == response.headers["etag"]
+    assert cache.respond(conditional_request(), b'{"id": 2}').headers["etag"] != response.headers["etag"]
+
+
+@pytest.mark.parametrize("header", ['{etag}', 'W/{etag}', '"other", {etag}', "*"])
+async def test_a_matching_if_none_match_is_not_modified(header):
+    cache = CatalogCache()
+    etag = cache.respond(conditional_request(), b"[]").headers["etag"]
+    response = cache.respond(conditional_request(header.format(etag=etag)), b"[]")
+    assert response.status_code == 304
+    assert response.body == b""
+    assert response.headers["etag"] == etag
+    assert cache.not_modified == 1
+
+
+async def test_a_stale_if_none_match_gets_the_body():
+    cache = CatalogCache()
+    etag = cache.respond(conditional_request(), b"[]").headers["etag"]
+    response = cache.respond(conditional_request(etag), b"[1]")
+    assert response.status_code == 200
+    assert response.body == b"[1]"
+
+
+def listing_request(query: str = "page=1", if_none_match: str = None) -> Request:
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match else []
+    return Request({"type": "http", "method": "GET", "path": "/public/products", "query_string": query.encode(), "headers": headers})
+
+
+def notification(version: int, *keys: str) -> str:
+    return json.dumps({"version": version, "keys": list(keys)})
+
+
+async def test_listing_tags_are_checked_without_a_body():
+    cache = CatalogCache()
+    etag = cache.listing_etag(listing_request())
+    assert cache.check(listing_request(if_none_match=etag), etag).status_code == 304
+    assert cache.check(listing_request(), etag) is None
+    assert cache.listing_etag(listing_request("page=2")) != etag
+
+
+async def test_listing_tags_agree_across_workers_after_the_same_change():
+    first, second = CatalogCache(), CatalogCache()
+    assert first.listing_etag(listing_request()) != second.listing_etag(listing_request())
+    for cache in (first, second):
+        cache.handle_notification(notification(8))
+    assert first.listing_etag(listing_request()) == second.listing_etag(listing_request())
+
+
+async def test_a_local_commit_changes_the_listing_tag_until_its_notification_returns():
+    committer, other = CatalogCache(), CatalogCache()
+    for cache in (committer, other):
+        cache.handle_notification(notification(5))
+    before = other.listing_etag(listing_request())
+    committer._drop_committed([((product_key(1),), 7)])
+    assert committer.listing_etag(listing_request()) != before
+    # Change 6 committed first elsewhere; the other worker's "after 6" state lacks change 7
+    for cache in (committer, other):
+        cache.handle_notification(notification(6))
+    assert committer.listing_etag(listing_request()) != other.listing_etag(listing_request())
+    for cache in (committer, other):
+        cache.handle_notification(notification(7, product_key(1)))
+    assert committer.listing_etag(listing_request()) == other.listing_etag(listing_request())
+
+
+async def test_a_resync_gives_listings_a_new_tag(db):
+    cache = CatalogCache()
+    cache.handle_notification(notification(3))
+    etag = cache.listing_etag(listing_request())
+    await cache.resync()
+    assert cache.listing_etag(listing_request()) != etag
@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+from repositories import circuit_breaker
+from repositories.circuit_breaker import Bulkhead, CircuitBreaker, DarajaUnavailable
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(circuit_breaker.time, "monotonic", lambda: now[0])
+    return now
+
+
+def fail(breaker: CircuitBreaker, times: int) -> None:
+    for _ in range(times):
+        breaker.before_call()
+        breaker.on_failure()
+
+
+def test_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker("daraja", failure_threshold=3, reset_timeout=30)
+    fail(breaker, 2)
+    breaker.before_call()
+    breaker.on_success()
+    fail(breaker, 2)
+    assert breaker.state == CircuitBreaker.CLOSED
+    fail(breaker, 1)
+    assert breaker.is_open()
+    with pytest.raises(DarajaUnavailable) as error:
+        breaker.before_call()
+    assert error.value.retry_after == 30
+    assert breaker.stats() == {"state": "open", "failures": 5, "rejections": 1, "opened": 1}
+
+
+def test_half_open_lets_one_probe_through(clock):
+    breaker = CircuitBreaker("daraja", failure_threshold=1, reset_timeout=30)
+    fail(breaker, 1)
+    clock[0] += 31
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(DarajaUnavailable):
+        breaker.before_call()
+    breaker.on_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.before_call()
+
+
+def test_a_failed_probe_opens_it_again(clock):
+    breaker = CircuitBreaker("daraja", failure_threshold=5, reset_timeout=30)
+    fail(breaker, 5)
+    clock[0] += 31
+    fail(breaker, 1)
+    assert breaker.is_open()
+    assert breaker.opened == 2
+
+
+def test_a_lost_probe_does_not_wedge_the_breaker(clock):
+    breaker = CircuitBreaker("daraja", failure_threshold=1, reset_timeout=30)
+    fail(breaker, 1)
+    clock[0] += 31
+    breaker.before_call()
+    clock[0] += 31
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+@pytest.mark.anyio
+async def test_bulkhead_rejects_when_full():
+    bulkhead = Bulkhead("daraja", max_concurrent=1)
+    async with bulkhead:
+        assert bulkhead.in_flight == 1
+        with pytest.raises(DarajaUnavailable):
+            async with bulkhead:
+                pass
+    assert bulkhead.stats() == {"max_concurrent": 1, "in_flight": 0, "rejections": 1}
+
+
+@pytest.mark.anyio
+async def test_bulkhead_waits_up_to_max_wait():
+    bulkhead = Bulkhead("daraja", max_concurrent=1, max_wait=1)
+
+    async def hold():
+        async with bulkhead:
+            await asyncio.sleep(0.01)
+
+    holder = asyncio.create_task(hold())
+    await asyncio.sleep(0)
+    async with bulkhead:
+        assert bulkhead.in_flight == 1
+    await holder
+
+    bulkhead = Bulkhead("daraja", max_concurrent=1, max_wait=0.01)
+    async with bulkhead:
+        with pytest.raises(DarajaUnavailable):
+            async with bulkhead:
+                pass
@@ -0,0 +1,62 @@
+import pytest
+
+from commit_hooks import CommitHook
+from database import async_session
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def hook():
+    delivered = []
+    hook = CommitHook(delivered.append)
+    hook.delivered = delivered
+    return hook
+
+
+async def test_items_are_delivered_once_on_commit(db, hook):
+    async with async_session() as session:
+        hook.stage(session, "a", "b")
+        assert hook.delivered == []
+        await session.commit()
+        await session.commit()
+    assert hook.delivered == [["a", "b"]]
+
+
+async def test_a_rollback_discards_items(db, hook):
+    async with async_session() as session:
+        hook.stage(session, "a")
+        await session.rollback()
+        await session.commit()
+    assert hook.delivered == []
+
+
+async def test_a_released_savepoint_hands_items_to_its_parent(db, hook):
+    async with async_session() as session:
+        hook.stage(session, "outer")
+        async with session.begin_nested():
+            hook.stage(session, "inner")
+            assert hook.staged(session) == ["inner"]
+        assert hook.delivered == []
+        assert hook.staged(session) == ["outer", "inner"]
+        await session.commit()
+    assert hook.delivered == [["outer", "inner"]]
+
+
+async def test_a_rolled_back_savepoint_discards_only_its_own_items(db, hook):
+    async with async_session() as session:
+        hook.stage(session, "outer")
+        savepoint = await session.begin_nested()
+        hook.stage(session, "inner")
+        await savepoint.rollback()
+        await session.commit()
+    assert hook.delivered == [["outer"]]
+
+
+async def test_every_subscriber_gets_the_items(db, hook):
+    others = []
+    hook.subscribe(others.append)
+    async with async_session() as session:
+        hook.stage(session, "a")
+        await session.commit()
+    assert hook.delivered == others == [["a"]]
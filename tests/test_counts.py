@@ -0,0 +1,83 @@
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import func, select, update
+
+from counts import CountProvider, count_provider
+from database import async_session
+from factories import add_product
+from models import Products
+
+pytestmark = pytest.mark.anyio
+
+PRODUCT_COUNT = select(func.count()).select_from(Products)
+
+
+async def count(key="products") -> tuple:
+    async with async_session() as session:
+        return await count_provider.count(session, PRODUCT_COUNT, key, ["products"])
+
+
+async def test_a_total_is_counted_once_until_the_table_changes(db):
+    await add_product()
+    counted = count_provider.counted
+    assert await count() == (1, True)
+    assert await count() == (1, True)
+    assert count_provider.counted == counted + 1
+
+    await add_product()
+    assert await count() == (2, True)
+    assert count_provider.counted == counted + 2
+
+
+async def test_core_updates_invalidate_and_rollbacks_do_not(db):
+    product = await add_product()
+    await count()
+    version = count_provider._versions["products"]
+    async with async_session() as session:
+        await session.execute(update(Products).where(Products.id == product.id).values(price=5))
+        await session.rollback()
+    assert count_provider._versions["products"] == version
+
+    async with async_session() as session:
+        async with session.begin_nested():
+            await session.execute(update(Products).values(price=6))
+        await session.commit()
+    assert count_provider._versions["products"] == version + 1
+
+
+async def test_other_listings_keep_their_totals(db):
+    await count("products")
+    await count("orders only")
+    counted = count_provider.counted
+    count_provider.handle_notification("orders")
+    await count("products")
+    assert count_provider.counted == counted
+    await count_provider.resync()
+    await count("products")
+    assert count_provider.counted == counted + 1
+
+
+def postgres_session(reltuples: int, exact: int):
+    async def execute(statement, params=None):
+        executed.append(params)
+        return SimpleNamespace(scalar=lambda: reltuples if params else exact)
+
+    executed = []
+    session = SimpleNamespace(bind=SimpleNamespace(dialect=SimpleNamespace(name="postgresql")), execute=execute)
+    return session, executed
+
+
+async def test_large_unfiltered_listings_report_the_planner_estimate():
+    async def listing_total(provider, session):
+        return await provider.count(session, PRODUCT_COUNT, "all", ["products"], estimate_table="products")
+
+    provider = CountProvider(estimate_threshold=1000)
+    session, executed = postgres_session(reltuples=50000, exact=50123)
+    assert await listing_total(provider, session) == (50000, False)
+    assert await listing_total(provider, session) == (50000, False)
+    # The estimate itself is cached, so the second call ran nothing
+    assert executed == [{"table": "products"}]
+
+    small, _ = postgres_session(reltuples=10, exact=12)
+    assert await listing_total(CountProvider(estimate_threshold=1000), small) == (12, True)
@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+
+from database import async_session
+from factories import add_order, add_transaction
+from models import OrderStatus, Orders, OutboxEvent, Transaction, TransactionStatus
+from models.transaction import TransactionCategory, TransactionChannel
+from workers.expiry_sweeper import ExpirySweeper
+
+pytestmark = pytest.mark.anyio
+
+HOURS_AGO = datetime.utcnow() - timedelta(hours=3)
+DAYS_AGO = datetime.utcnow() - timedelta(days=3)
+
+
+async def status_of(transaction: Transaction) -> TransactionStatus:
+    async with async_session() as db:
+        return await db.scalar(select(Transaction._status).where(Transaction.id == transaction.id))
+
+
+async def order_status(order: Orders) -> OrderStatus:
+    async with async_session() as db:
+        return await db.scalar(select(Orders.status).where(Orders.order_id == order.order_id))
+
+
+def sweeper(**kwargs) -> ExpirySweeper:
+    return ExpirySweeper(payment_expire_after=3600, order_expire_after=86400, **kwargs)
+
+
+async def test_abandoned_stk_payments_expire_in_chunks(db):
+    abandoned = [await add_transaction(created_at=HOURS_AGO) for _ in range(5)]
+    fresh = await add_transaction()
+    run = await sweeper(chunk_size=2).sweep()
+    assert run["expired_transactions"] == 5
+    assert [await status_of(transaction) for transaction in abandoned] == [TransactionStatus.EXPIRED] * 5
+    assert await status_of(fresh) == TransactionStatus.PENDING
+    async with async_session() as session:
+        events = (await session.execute(select(OutboxEvent.event_type))).scalars().all()
+    assert events == ["transaction.status_changed"] * 5
+
+
+async def test_queued_payouts_and_settled_payments_never_expire(db):
+    payout = await add_transaction(
+        created_at=HOURS_AGO, transaction_channel=TransactionChannel.B2C, transaction_category=TransactionCategory.PAYOUT
+    )
+    accepted = await add_transaction(created_at=HOURS_AGO, _status=TransactionStatus.ACCEPTED)
+    assert (await sweeper().sweep())["expired_transactions"] == 0
+    assert await status_of(payout) == TransactionStatus.PENDING
+    assert await status_of(accepted) == TransactionStatus.ACCEPTED
+
+
+async def test_stale_unpaid_orders_are_cancelled(db):
+    unpaid = await add_order(datetime=DAYS_AGO)
+    recent = await add_order()
+    paid = await add_order(datetime=DAYS_AGO)
+    await add_transaction(order_id=paid.order_id, _status=TransactionStatus.ACCEPTED)
+    paying = await add_order(datetime=DAYS_AGO)
+    await add_transaction(order_id=paying.order_id)
+    # Its payment expires in the same run, which frees the order to be cancelled
+    abandoned = await add_order(datetime=DAYS_AGO)
+    await add_transaction(order_id=abandoned.order_id, created_at=HOURS_AGO)
+
+    run = await sweeper().sweep()
+    assert (run["expired_transactions"], run["cancelled_orders"]) == (1, 2)
+    assert await order_status(unpaid) == OrderStatus.CANCELLED
+    assert await order_status(abandoned) == OrderStatus.CANCELLED
+    for order in (recent, paid, paying):
+        assert await order_status(order) == OrderStatus.PENDING
+
+
+async def test_run_once_sweeps_without_a_lock_on_sqlite(db):
+    payments = sweeper()
+    await add_transaction(created_at=HOURS_AGO)
+    assert (await payments.run_once())["expired_transactions"] == 1
+    assert (await payments.run_once())["expired_transactions"] == 0
+    assert payments.stats()["runs"] == 2
@@ -0,0 +1,67 @@
+import httpx
+import pytest
+from prometheus_client import REGISTRY
+
+from repositories import http_client
+from repositories.circuit_breaker import Bulkhead, CircuitBreaker, DarajaUnavailable
+from repositories.http_client import close_http_client, get_http_client, guarded_request, start_http_client
+
+pytestmark = pytest.mark.anyio
+
+STK_QUERY = "https://daraja.test/mpesa/stkpushquery/v1/query"
+
+
+class Daraja:
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.requests = 0
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        status = self.statuses.pop(0)
+        if status is None:
+            raise httpx.ConnectTimeout("timed out", request=request)
+        return httpx.Response(status, json={})
+
+
+async def call(daraja: Daraja, breaker: CircuitBreaker, times: int = 1) -> list:
+    outcomes, bulkhead = [], Bulkhead("test", 2)
+    async with httpx.AsyncClient(transport=httpx.MockTransport(daraja)) as client:
+        for _ in range(times):
+            try:
+                response = await guarded_request(client, breaker, bulkhead, "POST", STK_QUERY)
+                outcomes.append(response.status_code)
+            except (httpx.TransportError, DarajaUnavailable) as e:
+                outcomes.append(type(e).__name__)
+    return outcomes
+
+
+async def test_only_gateway_errors_and_transport_failures_trip_the_breaker():
+    breaker = CircuitBreaker("test", failure_threshold=3)
+    daraja = Daraja(500, 503, None, 504, 200)
+    assert await call(daraja, breaker, times=5) == [500, 503, "ConnectTimeout", 504, "DarajaUnavailable"]
+    assert daraja.requests == 4
+    assert (breaker.state, breaker.failures, breaker.rejections) == (CircuitBreaker.OPEN, 3, 1)
+
+
+async def test_a_success_resets_the_failure_streak():
+    breaker = CircuitBreaker("test", failure_threshold=2)
+    assert await call(Daraja(503, 200, 503, 200), breaker, times=4) == [503, 200, 503, 200]
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+async def test_upstream_latency_is_recorded_per_endpoint_and_status():
+    labels = {"endpoint": "/mpesa/stkpushquery/v1/query", "status": "ConnectTimeout"}
+    before = REGISTRY.get_sample_value("daraja_http_request_duration_seconds_count", labels) or 0
+    await call(Daraja(None), CircuitBreaker("test"))
+    assert REGISTRY.get_sample_value("daraja_http_request_duration_seconds_count", labels) == before + 1
+
+
+async def test_one_shared_client_lives_between_startup_and_shutdown():
+    client = await start_http_client()
+    assert get_http_client() is client and await start_http_client() is client
+    await close_http_client()
+    assert http_client._client is None
+    # Used outside the lifespan, a client is created on demand
+    assert get_http_client() is not client
+    await close_http_client()
@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from idempotency import IDEMPOTENCY_KEY_MAX_LENGTH, IdempotencyStore
+
+pytestmark = pytest.mark.anyio
+
+
+class Handler:
+    def __init__(self, result=None, error=None):
+        self.calls = 0
+        self.result = result
+        self.error = error
+        self.release = None
+
+    async def __call__(self):
+        self.calls += 1
+        if self.release is not None:
+            await self.release.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result if self.result is not None else {"call": self.calls}
+
+
+async def test_without_a_key_every_request_runs(db):
+    store, handler = IdempotencyStore(), Handler()
+    await store.run(None, 1, "initiate_payment", {"amount": 10}, handler)
+    await store.run(None, 1, "initiate_payment", {"amount": 10}, handler)
+    assert handler.calls == 2
+
+
+async def test_a_repeated_key_replays_the_first_response(db):
+    store, handler = IdempotencyStore(), Handler()
+    first = await store.run("k", 1, "initiate_payment", {"amount": 10}, handler)
+    second = await store.run("k", 1, "initiate_payment", {"amount": 10}, handler)
+    assert first == second == {"call": 1}
+    assert handler.calls == 1
+    assert store.stats()["replayed"] == 1
+
+
+async def test_another_worker_replays_from_the_table(db):
+    handler = Handler()
+    await IdempotencyStore().run("k", 1, "initiate_payment", {"amount": 10}, handler)
+    replayed = await IdempotencyStore().run("k", 1, "initiate_payment", {"amount": 10}, handler)
+    assert replayed == {"call": 1}
+    assert handler.calls == 1
+
+
+async def test_keys_are_scoped_per_user_and_endpoint(db):
+    store, handler = IdempotencyStore(), Handler()
+    await store.run("k", 1, "initiate_payment", {"amount": 10}, handler)
+    await store.run("k", 2, "initiate_payment", {"amount": 10}, handler)
+    await store.run("k", 1, "create_order", {"amount": 10}, handler)
+    assert handler.calls == 3
+
+
+async def test_a_key_reused_with_another_request_is_rejected(db):
+    store = IdempotencyStore()
+    await store.run("k", 1, "initiate_payment", {"amount": 10}, Handler())
+    with pytest.raises(HTTPException) as error:
+        await store.run("k", 1, "initiate_payment", {"amount": 20}, Handler())
+    assert error.value.status_code == 422
+
+
+async def test_a_failed_request_can_be_retried(db):
+    store = IdempotencyStore()
+    with pytest.raises(HTTPException):
+        await store.run("k", 1, "initiate_payment", {"amount": 10}, Handler(error=HTTPException(status_code=429)))
+    handler = Handler()
+    assert await store.run("k", 1, "initiate_payment", {"amount": 10}, handler) == {"call": 1}
+    assert handler.calls == 1
+
+
+async def test_concurrent_duplicates_share_the_first_request(db):
+    store, handler = IdempotencyStore(), Handler()
+    handler.release = asyncio.Event()
+    first = asyncio.create_task(store.run("k", 1, "initiate_payment", {"amount": 10}, handler))
+    await asyncio.sleep(0)
+    duplicate = asyncio.create_task(store.run("k", 1, "initiate_payment", {"amount": 10}, handler))
+    changed = asyncio.create_task(store.run("k", 1, "initiate_payment", {"amount": 20}, handler))
+    await asyncio.sleep(0)
+    handler.release.set()
+    assert await first == await duplicate == {"call": 1}
+    with pytest.raises(HTTPException) as error:
+        await changed
+    assert error.value.status_code == 422
+    assert handler.calls == 1
+    assert store.stats()["shared_in_flight"] == 2
+
+
+async def test_an_overlong_key_is_rejected(db):
+    with pytest.raises(HTTPException) as error:
+        await IdempotencyStore().run("k" * (IDEMPOTENCY_KEY_MAX_LENGTH + 1), 1, "initiate_payment", {}, Handler())
+    assert error.value.status_code == 400
+
+
+async def test_cached_answers_completed_requests_from_memory_only(db):
+    store = IdempotencyStore()
+    assert store.cached("k", 1, "initiate_payment", {"amount": 10}) is None
+    await store.run("k", 1, "initiate_payment", {"amount": 10}, Handler())
+    assert store.cached("k", 1, "initiate_payment", {"amount": 10}) == {"call": 1}
+    assert store.cached(None, 1, "initiate_payment", {"amount": 10}) is None
+    assert IdempotencyStore().cached("k", 1, "initiate_payment", {"amount": 10}) is None
+    with pytest.raises(HTTPException) as error:
+        store.cached("k", 1, "initiate_payment", {"amount": 20})
+    assert error.value.status_code == 422
@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+import main
+from repositories import http_client
+from repositories.lnmo_repository import LNMORepository
+from repositories.token_cache import AccessTokenCache
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def daraja(monkeypatch):
+    """The shared Daraja client, answering OAuth requests from `daraja.status`"""
+    daraja = SimpleNamespace(status=200, calls=[])
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        daraja.calls.append(request.url.path)
+        if daraja.status != 200:
+            return httpx.Response(daraja.status, text="down")
+        return httpx.Response(200, json={"access_token": "warm", "expires_in": "3599"})
+
+    monkeypatch.setattr(http_client, "_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return daraja
+
+
+def repository() -> LNMORepository:
+    repo = LNMORepository()
+    repo._token_cache = AccessTokenCache()
+    return repo
+
+
+def test_missing_credentials_are_named(monkeypatch):
+    monkeypatch.setattr(LNMORepository, "MPESA_LNMO_PASS_KEY", None)
+    with pytest.raises(ValueError, match="MPESA_LNMO_PASS_KEY"):
+        LNMORepository()
+
+
+async def test_warm_up_fetches_the_token_before_the_first_payment(daraja):
+    repo = repository()
+    await repo.warm_up()
+    assert daraja.calls == ["/oauth/v1/generate"]
+    assert await repo.generate_access_token() == "warm"
+    assert len(daraja.calls) == 1
+
+
+async def test_a_failed_warm_up_does_not_stop_startup(daraja):
+    daraja.status = 503
+    repo = repository()
+    await repo.warm_up()
+    assert repo._token_cache.stats()["refresh_failures"] == 1
+    daraja.status = 200
+    assert await repo.generate_access_token() == "warm"
+
+
+async def test_payment_endpoints_answer_503_when_payments_are_disabled(db, monkeypatch):
+    monkeypatch.setattr(main.app.state, "lnmo_repo", None, raising=False)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://shop.test") as client:
+        response = await client.post("/ipn/daraja/lnmo/callback", json={"Body": {"stkCallback": {}}})
+    assert response.status_code == 503
+    assert response.json() == {"detail": "Payment service is not configured"}
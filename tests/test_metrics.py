@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+from prometheus_client import REGISTRY
+
+from database import async_session
+from factories import add_transaction
+from metrics import count_result, render, timed
+from repositories.lnmo_repository import LNMORepository
+
+pytestmark = pytest.mark.anyio
+
+
+def sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+async def test_timed_records_duration_in_flight_and_errors():
+    gate = asyncio.Event()
+
+    @timed("test_op")
+    async def operation(fail: bool = False):
+        await gate.wait()
+        if fail:
+            raise TimeoutError("slow")
+        return "done"
+
+    before = sample("mpesa_operation_duration_seconds_count", operation="test_op")
+    running = [asyncio.ensure_future(operation()), asyncio.ensure_future(operation(fail=True))]
+    await asyncio.sleep(0)
+    assert sample("mpesa_operation_in_flight", operation="test_op") == 2
+    gate.set()
+    results = await asyncio.gather(*running, return_exceptions=True)
+    assert results[0] == "done" and isinstance(results[1], TimeoutError)
+    assert sample("mpesa_operation_in_flight", operation="test_op") == 0
+    assert sample("mpesa_operation_duration_seconds_count", operation="test_op") == before + 2
+    assert sample("mpesa_operation_errors_total", operation="test_op", error="TimeoutError") == 1
+
+
+async def test_callbacks_are_timed_and_counted_where_they_are_applied(db):
+    transaction = await add_transaction()
+    before = sample("mpesa_operation_duration_seconds_count", operation="callback")
+    results = sample("mpesa_operation_results_total", operation="callback", result_code="1032")
+    callback = {"Body": {"stkCallback": {"CheckoutRequestID": transaction.transaction_id, "ResultCode": 1032}}}
+    async with async_session() as session:
+        await LNMORepository().apply_callback(callback, session)
+        await session.commit()
+    assert sample("mpesa_operation_duration_seconds_count", operation="callback") == before + 1
+    assert sample("mpesa_operation_results_total", operation="callback", result_code="1032") == results + 1
+
+
+def test_render_exposes_the_metrics():
+    count_result("test_render", 0)
+    body, content_type = render()
+    assert content_type.startswith("text/plain")
+    assert b'mpesa_operation_results_total{operation="test_render",result_code="0"} 1.0' in body
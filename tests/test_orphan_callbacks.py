@@ -0,0 +1,81 @@
+import json
+
+import pytest
+from sqlalchemy import select
+
+from database import async_session
+from factories import add_transaction
+from models import OrphanCallback, Transaction, TransactionStatus
+from repositories.lnmo_repository import LNMORepository
+from workers.orphan_callbacks import OrphanCallbackBuffer
+
+pytestmark = pytest.mark.anyio
+
+
+def stk_callback(checkout_request_id: str, result_code=0) -> dict:
+    callback = {"CheckoutRequestID": checkout_request_id, "ResultCode": result_code, "ResultDesc": "done"}
+    if result_code == 0:
+        callback["CallbackMetadata"] = {"Item": [{"Name": "MpesaReceiptNumber", "Value": "RKT1A2B3C4"}]}
+    return {"Body": {"stkCallback": callback}}
+
+
+def buffer() -> OrphanCallbackBuffer:
+    orphans = OrphanCallbackBuffer()
+    orphans._lnmo_repo = LNMORepository()
+    return orphans
+
+
+async def hold(orphans: OrphanCallbackBuffer, checkout_request_id: str, data: dict) -> None:
+    async with async_session() as db:
+        await orphans.hold(db, checkout_request_id, data)
+        await db.commit()
+
+
+async def orphan(checkout_request_id: str) -> OrphanCallback:
+    async with async_session() as db:
+        return (await db.execute(
+            select(OrphanCallback).where(OrphanCallback.checkout_request_id == checkout_request_id)
+        )).scalar_one()
+
+
+async def test_a_held_callback_is_replayed_once_its_transaction_is_stored(db):
+    orphans = buffer()
+    await hold(orphans, "ws_CO_early", stk_callback("ws_CO_early"))
+    assert await orphans.replay_once() == 0
+    assert orphans.waiting.get("ws_CO_early")
+
+    transaction = await add_transaction(transaction_id="ws_CO_early")
+    orphans.transaction_stored("ws_CO_early")
+    assert orphans._wake.is_set() and orphans.waiting.get("ws_CO_early") is None
+    assert await orphans.replay_once() == 1
+
+    async with async_session() as session:
+        stored = await session.get(Transaction, transaction.id)
+        assert (stored._status, stored.transaction_code) == (TransactionStatus.ACCEPTED, "RKT1A2B3C4")
+    assert (await orphan("ws_CO_early")).replayed_at is not None
+    assert await orphans.replay_once() == 0
+    assert (orphans.held, orphans.replayed, orphans.failed) == (1, 1, 0)
+
+
+async def test_holding_the_same_callback_twice_keeps_one_row(db):
+    orphans = buffer()
+    await hold(orphans, "ws_CO_twice", stk_callback("ws_CO_twice"))
+    await hold(orphans, "ws_CO_twice", stk_callback("ws_CO_twice", 1032))
+    assert json.loads((await orphan("ws_CO_twice")).payload) == stk_callback("ws_CO_twice")
+
+
+async def test_a_bad_callback_is_retried_without_blocking_the_rest(db):
+    orphans = buffer()
+    await hold(orphans, "ws_CO_bad", stk_callback("ws_CO_bad", "not-a-code"))
+    await hold(orphans, "ws_CO_good", stk_callback("ws_CO_good", 1032))
+    await add_transaction(transaction_id="ws_CO_bad")
+    good = await add_transaction(transaction_id="ws_CO_good")
+
+    assert await orphans.replay_once() == 2
+    bad = await orphan("ws_CO_bad")
+    assert (bad.replayed_at, bad.attempts) == (None, 1) and bad.last_error
+    async with async_session() as session:
+        assert (await session.get(Transaction, good.id))._status == TransactionStatus.CANCELED
+    # The failed one stays eligible until it runs out of attempts
+    assert await orphans.replay_once() == 1
+    assert (await orphan("ws_CO_bad")).attempts == 2
@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import select
+
+from database import async_session
+from models import Products
+from pagination import decode_cursor, encode_cursor, keyset_page, next_page
+
+START = datetime(2024, 1, 1, 12, 0, 0)
+
+
+def test_cursor_round_trips():
+    created_at = datetime(2024, 5, 6, 7, 8, 9, 123456)
+    assert decode_cursor(encode_cursor(created_at, 42)) == (created_at, 42)
+
+
+@pytest.mark.parametrize("cursor", ["not base64!", "bm90IGpzb24", encode_cursor(START, 1)[:-4]])
+def test_a_malformed_cursor_is_a_bad_request(cursor):
+    with pytest.raises(HTTPException) as error:
+        decode_cursor(cursor)
+    assert error.value.status_code == 400
+
+
+def test_next_page_trims_the_lookahead_row():
+    rows = [Products(id=i, created_at=START) for i in (3, 2, 1)]
+    page, cursor = next_page(rows, 2, "created_at", "id")
+    assert [row.id for row in page] == [3, 2]
+    assert decode_cursor(cursor) == (START, 2)
+    assert next_page(rows, 3, "created_at", "id") == (rows, None)
+
+
+async def seed_products(count: int) -> None:
+    async with async_session() as db:
+        for i in range(1, count + 1):
+            # Pairs of products share a timestamp, so the id has to break the tie
+            created_at = START + timedelta(minutes=i // 2)
+            db.add(Products(id=i, name=f"product {i}", cost=1, price=2, stock_quantity=3, created_at=created_at))
+        await db.commit()
+
+
+async def walk(limit: int):
+    pages, cursor = [], None
+    while True:
+        async with async_session() as db:
+            query = keyset_page(select(Products), Products.created_at, Products.id, cursor, limit)
+            rows = (await db.execute(query)).scalars().all()
+        rows, cursor = next_page(rows, limit, "created_at", "id")
+        pages.append([row.id for row in rows])
+        if cursor is None:
+            return pages
+
+
+@pytest.mark.anyio
+async def test_pages_are_newest_first_without_gaps_or_repeats(db):
+    await seed_products(7)
+    assert await walk(3) == [[7, 6, 5], [4, 3, 2], [1]]
+
+
+@pytest.mark.anyio
+async def test_rows_added_meanwhile_do_not_shift_later_pages(db):
+    await seed_products(6)
+    async with async_session() as db_session:
+        query = keyset_page(select(Products), Products.created_at, Products.id, None, 2)
+        rows, cursor = next_page((await db_session.execute(query)).scalars().all(), 2, "created_at", "id")
+        db_session.add(Products(id=100, name="newest", cost=1, price=2, stock_quantity=3, created_at=START + timedelta(days=1)))
+        await db_session.commit()
+        query = keyset_page(select(Products), Products.created_at, Products.id, cursor, 2)
+        rows, _ = next_page((await db_session.execute(query)).scalars().all(), 2, "created_at", "id")
+    assert [row.id for row in rows] == [4, 3]
+
+
+@pytest.mark.anyio
+async def test_rows_without_an_explicit_timestamp_get_one(db):
+    async with async_session() as db_session:
+        db_session.add_all([Products(name=f"default {i}", cost=1, price=2, stock_quantity=3) for i in range(3)])
+        await db_session.commit()
+    assert await walk(2) == [[3, 2], [1]]
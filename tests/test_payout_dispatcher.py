@@ -0,0 +1,158 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+from sqlalchemy import select, update
+
+from database import async_session
+from factories import add_transaction
+from models import PayoutBatch, Transaction, TransactionStatus
+from models.transaction import TransactionCategory, TransactionChannel, TransactionType
+from repositories.circuit_breaker import DarajaUnavailable
+from routers.payouts import batch_response
+from workers.callback_inbox import CallbackInboxWorker, enqueue_callback
+from workers.payout_dispatcher import PayoutDispatcher
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeB2C:
+    """Answers pay() from a list of outcomes: a response dict or an exception to raise"""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.paid = []
+
+    async def pay(self, pid, phone_number, amount, remarks):
+        self.paid.append(pid)
+        outcome = self.outcomes.pop(0) if len(self.outcomes) > 1 else self.outcomes[0]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return 200, {**outcome, "ConversationID": f"AG_{pid}"} if outcome.get("ResponseCode") == "0" else outcome
+
+
+ACCEPTED_REQUEST = {"ResponseCode": "0", "ResponseDescription": "Accept the service request successfully."}
+
+
+async def add_batch(count: int) -> PayoutBatch:
+    async with async_session() as db:
+        batch = PayoutBatch(reference=f"batch-{count}", total_count=count, total_amount=100 * count, created_by=1)
+        db.add(batch)
+        await db.commit()
+    for index in range(count):
+        await add_transaction(
+            _pid=f"PAYOUT-{batch.id}-{index}",
+            party_b=f"25470000000{index}",
+            transaction_category=TransactionCategory.PAYOUT,
+            transaction_type=TransactionType.DEBIT,
+            transaction_channel=TransactionChannel.B2C,
+            transaction_id=None,
+            payout_batch_id=batch.id,
+        )
+    return batch
+
+
+async def statuses() -> dict:
+    async with async_session() as db:
+        result = await db.execute(select(Transaction._pid, Transaction._status).order_by(Transaction._pid))
+        return dict(result.all())
+
+
+def dispatcher(b2c: FakeB2C, **kwargs) -> PayoutDispatcher:
+    payouts = PayoutDispatcher(rate=0, **kwargs)
+    payouts._b2c_repo = b2c
+    return payouts
+
+
+async def test_a_payout_is_claimed_by_one_dispatcher_only(db):
+    await add_batch(5)
+    first, second = dispatcher(FakeB2C(ACCEPTED_REQUEST), claim_size=3), dispatcher(FakeB2C(ACCEPTED_REQUEST), claim_size=3)
+    claims = await asyncio.gather(first._claim(), second._claim())
+    claimed = [row._pid for rows in claims for row in rows]
+    assert sorted(claimed) == sorted(set(claimed)) and len(claimed) == 5
+    assert set((await statuses()).values()) == {TransactionStatus.PROCESSING}
+    assert await first._claim() == []
+
+
+async def test_a_sent_payout_keeps_its_conversation_id(db):
+    await add_batch(2)
+    b2c = FakeB2C(ACCEPTED_REQUEST)
+    assert await dispatcher(b2c).dispatch_once() == 2
+    async with async_session() as session:
+        rows = (await session.execute(select(Transaction._status, Transaction.transaction_id))).all()
+    assert sorted(rows) == [(TransactionStatus.PROCESSING, f"AG_{pid}") for pid in sorted(b2c.paid)]
+
+
+async def test_an_ambiguous_failure_parks_the_payout_and_never_resends_it(db):
+    batch = await add_batch(1)
+    b2c = FakeB2C(httpx.ReadTimeout("read timed out"))
+    payouts = dispatcher(b2c)
+    await payouts.dispatch_once()
+    await payouts.dispatch_once()
+    assert b2c.paid == [f"PAYOUT-{batch.id}-0"]
+    assert await statuses() == {f"PAYOUT-{batch.id}-0": TransactionStatus.UNKNOWN}
+    async with async_session() as session:
+        feedback = await session.scalar(select(Transaction._feedback))
+    assert feedback["error"].startswith("ReadTimeout")
+    assert payouts.stats()["unknown"] == 1
+
+
+async def test_a_failure_before_daraja_puts_the_payout_back(db):
+    await add_batch(1)
+    b2c = FakeB2C(DarajaUnavailable("daraja circuit is open"), ACCEPTED_REQUEST)
+    payouts = dispatcher(b2c)
+    assert await payouts.dispatch_once() == 0
+    assert set((await statuses()).values()) == {TransactionStatus.PENDING}
+    assert await payouts.dispatch_once() == 1
+    assert len(b2c.paid) == 2
+
+
+async def test_a_rejected_request_is_final(db):
+    await add_batch(1)
+    await dispatcher(FakeB2C({"errorCode": "400.002.02", "errorMessage": "Bad Request"})).dispatch_once()
+    assert set((await statuses()).values()) == {TransactionStatus.REJECTED}
+
+
+async def test_claimed_payouts_without_an_answer_are_parked(db):
+    await add_batch(2)
+    payouts = dispatcher(FakeB2C(ACCEPTED_REQUEST), unconfirmed_after=60)
+    await payouts._claim()
+    async with async_session() as session:
+        await session.execute(
+            update(Transaction).where(Transaction._pid.like("%-0")).values(updated_at=datetime.utcnow() - timedelta(minutes=5))
+        )
+        await session.commit()
+    assert await payouts.park_unconfirmed() == 1
+    assert sorted((await statuses()).values(), key=lambda status: status.value) == [
+        TransactionStatus.PROCESSING, TransactionStatus.UNKNOWN,
+    ]
+
+
+def b2c_result(pid: str, result_code: int = 0) -> bytes:
+    result = {"ResultCode": result_code, "OriginatorConversationID": pid, "ConversationID": f"AG_{pid}"}
+    if result_code == 0:
+        result["TransactionID"] = f"RKT{pid[-1]}"
+    return json.dumps({"Result": result}).encode()
+
+
+async def test_results_settle_the_batch(db):
+    batch = await add_batch(3)
+    # The first payout timed out and was parked, yet Daraja did pay it
+    b2c = FakeB2C(httpx.ReadTimeout("read timed out"), ACCEPTED_REQUEST)
+    await dispatcher(b2c).dispatch_once()
+    async with async_session() as session:
+        for index, result_code in enumerate([0, 0, 2001]):
+            await enqueue_callback(session, b2c_result(f"PAYOUT-{batch.id}-{index}", result_code), source="b2c")
+    assert await CallbackInboxWorker().drain_once() == 3
+    async with async_session() as session:
+        settled = await batch_response(session, batch)
+        codes = (await session.execute(select(Transaction.transaction_code).order_by(Transaction._pid))).scalars().all()
+    assert settled["status_counts"] == {"ACCEPTED": 2, "REJECTED": 1}
+    assert codes == ["RKT0", "RKT1", None]
+    # A result delivered again changes nothing
+    async with async_session() as session:
+        await enqueue_callback(session, b2c_result(f"PAYOUT-{batch.id}-2", 0), source="b2c")
+    await CallbackInboxWorker().drain_once()
+    assert (await statuses())[f"PAYOUT-{batch.id}-2"] == TransactionStatus.REJECTED
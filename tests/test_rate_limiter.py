@@ -0,0 +1,70 @@
+import asyncio
+import time
+
+import pytest
+
+from repositories import rate_limiter
+from repositories.rate_limiter import AsyncRateLimiter, TokenBucketLimiter
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rate_limiter.time, "monotonic", lambda: now[0])
+    return now
+
+
+@pytest.mark.anyio
+async def test_async_rate_limiter_spaces_calls():
+    limiter = AsyncRateLimiter(rate=100)
+    started = time.monotonic()
+    await asyncio.gather(*[limiter.acquire() for _ in range(5)])
+    assert time.monotonic() - started >= 0.035
+
+
+@pytest.mark.anyio
+async def test_async_rate_limiter_without_a_rate_never_waits():
+    limiter = AsyncRateLimiter(rate=0)
+    await asyncio.gather(*[limiter.acquire() for _ in range(100)])
+    # No slot is ever reserved, so no caller has anything to wait for
+    assert limiter._next_slot == 0.0
+
+
+def test_token_bucket_allows_a_burst_then_refills(clock):
+    limiter = TokenBucketLimiter("phone", capacity=2, per_second=0.5)
+    assert limiter.try_acquire("254700000001") == 0
+    assert limiter.try_acquire("254700000001") == 0
+    assert limiter.try_acquire("254700000001") == pytest.approx(2)
+    assert limiter.try_acquire("254700000002") == 0
+    clock[0] += 2
+    assert limiter.try_acquire("254700000001") == 0
+
+
+def test_token_bucket_forgets_the_least_recent_key(clock):
+    limiter = TokenBucketLimiter("phone", capacity=1, per_second=0.1, max_keys=2)
+    for key in ("a", "b", "c"):
+        limiter.try_acquire(key)
+    assert list(limiter._buckets) == ["b", "c"]
+    assert limiter.try_acquire("a") == 0
+
+
+@pytest.mark.anyio
+async def test_token_bucket_counts_outcomes():
+    limiter = TokenBucketLimiter("user", capacity=1, per_second=0.01, shared=True)
+    assert await limiter.acquire("1") == 0
+    assert await limiter.acquire("1") > 0
+    stats = limiter.stats()
+    assert (stats["allowed"], stats["rejected"], stats["rejected_shared"]) == (1, 1, 0)
+
+
+@pytest.mark.anyio
+async def test_token_bucket_refund_gives_back_one_token():
+    limiter = TokenBucketLimiter("user", capacity=1, per_second=0.01)
+    await limiter.acquire("1")
+    await limiter.refund("1")
+    assert await limiter.acquire("1") == 0
+    await limiter.refund("1")
+    await limiter.refund("1")
+    assert await limiter.acquire("1") == 0
+    assert await limiter.acquire("1") > 0
+    assert limiter.stats()["refunded"] == 3
@@ -0,0 +1,93 @@
+import argparse
+import csv
+import io
+from datetime import datetime, timedelta
+
+import pytest
+
+from factories import add_transaction
+from models import TransactionStatus
+from tools.reconcile_statement import StatementReconciler, parse_amount, parse_time
+
+pytestmark = pytest.mark.anyio
+
+SETTLED_AT = datetime(2026, 10, 1, 10, 0)
+
+STATEMENT = """Organisation Name,Test Shop
+Statement Period,01-10-2026 - 01-10-2026
+
+Receipt No.,Completion Time,Details,Transaction Status,Paid In,Withdrawn
+RKA,2026-10-01 09:00:00,Pay Bill,Completed,100.00,
+RKB,2026-10-01 09:30:00,Pay Bill,Completed,"1,50.00",
+RKC,2026-10-01 10:00:00,Pay Bill,Completed,100.00,
+RKF,2026-10-01 10:15:00,Pay Bill,Failed,100.00,
+RKX,2026-10-01 10:30:00,Pay Bill,Completed,100.00,
+RKA,2026-10-01 11:00:00,Pay Bill,Completed,100.00,
+"""
+
+
+def options(**overrides) -> argparse.Namespace:
+    return argparse.Namespace(**{
+        "chunk_size": 2,
+        "since": None,
+        "until": None,
+        "slack_minutes": 5,
+        "receipt_column": "Receipt No.",
+        "time_column": "Completion Time",
+        "status_column": "Transaction Status",
+        "completed_status": "Completed",
+        "paid_in_column": "Paid In",
+        "withdrawn_column": "Withdrawn",
+        **overrides,
+    })
+
+
+async def reconcile(statement: str, **overrides):
+    output = io.StringIO()
+    summary = await StatementReconciler(options(**overrides), csv.writer(output)).run(io.StringIO(statement))
+    report = sorted((row[0], row[1]) for row in csv.reader(io.StringIO(output.getvalue())))
+    return summary, report
+
+
+async def accepted(code: str, at: datetime = SETTLED_AT, **columns):
+    return await add_transaction(transaction_code=code, transaction_timestamp=at, _status=TransactionStatus.ACCEPTED, **columns)
+
+
+def test_statement_cells_are_parsed_leniently():
+    assert parse_amount("-1,250.00") == parse_amount("1250") == 1250
+    assert parse_amount("") is None and parse_amount("n/a") is None
+    assert parse_time("01-10-2026 09:00:00") == parse_time("20261001090000") == datetime(2026, 10, 1, 9)
+    assert parse_time("yesterday") is None
+
+
+async def test_each_line_is_matched_or_reported(db):
+    await accepted("RKA")
+    await accepted("RKB")
+    await add_transaction(transaction_code="RKC", _status=TransactionStatus.REJECTED)
+    await accepted("RKD")
+    await accepted("RKE", SETTLED_AT - timedelta(days=1))
+
+    summary, report = await reconcile(STATEMENT)
+    assert report == [
+        ("amount_mismatch", "RKB"),
+        ("missing", "RKX"),
+        ("orphaned", "RKD"),
+        ("status_mismatch", "RKC"),
+    ]
+    # RKA appears twice, in different chunks, and matches the same row both times
+    assert (summary.statement_lines, summary.skipped_lines, summary.matched, summary.chunks) == (5, 1, 2, 3)
+    assert summary.window == ["2026-10-01T09:00:00", "2026-10-01T11:00:00"]
+
+
+async def test_a_checkout_request_id_is_accepted_as_the_receipt(db):
+    await accepted(None, transaction_id="ws_CO_RECEIPT")
+    summary, report = await reconcile(STATEMENT.replace("RKX", "ws_CO_RECEIPT"), chunk_size=100)
+    assert ("missing", "ws_CO_RECEIPT") not in report
+    assert (summary.matched, summary.missing, summary.orphaned) == (1, 4, 0)
+
+
+async def test_an_explicit_window_widens_the_orphan_scan(db):
+    await accepted("RKE", SETTLED_AT - timedelta(days=1))
+    summary, report = await reconcile(STATEMENT, since=SETTLED_AT - timedelta(days=2))
+    assert ("orphaned", "RKE") in report
+    assert summary.orphaned == 1
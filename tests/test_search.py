@@ -0,0 +1,53 @@
+import pytest
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+
+import search
+from database import async_session
+from factories import add_product
+from models import Products
+from search import prefix_query, product_search_filter, product_search_order
+
+pytestmark = pytest.mark.anyio
+
+
+def postgres_sql(clause) -> str:
+    return str(clause.compile(dialect=postgresql.dialect()))
+
+
+def test_search_terms_become_prefix_queries():
+    assert prefix_query("Red  SHO") == "red:* & sho:*"
+    # Operators typed by a shopper never reach to_tsquery
+    assert prefix_query("a|b & !c:*") == "a:* & b:* & c:*"
+    assert prefix_query("--") == ""
+
+
+async def test_sqlite_falls_back_to_substring_matches(db):
+    await add_product(name="Red Shoe", brand="Acme")
+    await add_product(name="Blue Hat", brand="Shoemakers")
+    await add_product(name="Green Sock", description="pairs well with shoes")
+    await add_product(name="Kettle")
+    async with async_session() as session:
+        names = (await session.execute(
+            select(Products.name).where(product_search_filter("shoe")).order_by(Products.id)
+        )).scalars().all()
+    assert names == ["Red Shoe", "Blue Hat", "Green Sock"]
+    assert product_search_order("shoe") == []
+
+
+def test_postgres_uses_the_search_vector_and_trigram_indexes(monkeypatch):
+    monkeypatch.setattr(search, "fulltext_enabled", lambda: True)
+    sql = postgres_sql(product_search_filter("red sho"))
+    assert "products.search_vector @@ to_tsquery" in sql
+    assert "products.name ILIKE" in sql and "products.description" not in sql
+    assert "similarity(products.name" in postgres_sql(product_search_order("red sho")[0])
+
+    monkeypatch.setattr(search, "_trigram_available", False)
+    assert "ILIKE" not in postgres_sql(product_search_filter("red sho"))
+    assert "similarity" not in postgres_sql(product_search_order("red sho")[0])
+
+
+def test_a_term_without_words_is_matched_literally(monkeypatch):
+    monkeypatch.setattr(search, "fulltext_enabled", lambda: True)
+    assert "to_tsquery" not in postgres_sql(product_search_filter("%%"))
+    assert product_search_order("%%") == []
@@ -0,0 +1,58 @@
+import pytest
+
+from database import async_session
+from factories import add_order, add_order_lines, add_product
+from repositories.lnmo_repository import LNMORepository
+from repositories.shortcode_profiles import ShortcodeProfile, ShortcodeRegistry
+
+pytestmark = pytest.mark.anyio
+
+
+def profile(name: str, short_code: str, sellers=()) -> ShortcodeProfile:
+    return ShortcodeProfile(name, short_code, f"{name}-key", f"{name}-secret", f"{name}-pass", sellers=sellers)
+
+
+def test_a_profile_is_read_from_its_own_variables(monkeypatch):
+    for key, value in {"SHORT_CODE": "600100", "CONSUMER_KEY": "k", "CONSUMER_SECRET": "s", "PASS_KEY": "p",
+                       "SELLERS": "3, 4,", "RATE": "2.5"}.items():
+        monkeypatch.setenv(f"MPESA_PROFILE_BRANCH_{key}", value)
+    branch = ShortcodeProfile.from_env("branch")
+    assert (branch.short_code, branch.sellers, branch.rate) == ("600100", {3, 4}, 2.5)
+    assert branch.callback_url == LNMORepository.MPESA_LNMO_CALLBACK_URL
+
+    monkeypatch.delenv("MPESA_PROFILE_BRANCH_PASS_KEY")
+    with pytest.raises(ValueError, match="MPESA_PROFILE_BRANCH_PASS_KEY"):
+        ShortcodeProfile.from_env("branch")
+
+
+def test_each_short_code_gets_its_own_credentials_token_and_limits():
+    registry = ShortcodeRegistry([profile("north", "600100"), profile("south", "600200")])
+    north, south = registry.for_short_code("600100"), registry.for_short_code("600200")
+    default = LNMORepository()
+    assert (north.MPESA_LNMO_SHORT_CODE, north.MPESA_LNMO_CONSUMER_KEY) == ("600100", "north-key")
+    assert len({id(repo._token_cache) for repo in (north, south, default)}) == 3
+    assert len({id(repo._bulkhead) for repo in (north, south, default)}) == 3
+    assert registry.for_short_code(default.MPESA_LNMO_SHORT_CODE) is None
+    assert set(registry.stats()) == {"north", "south"}
+
+
+def test_a_short_code_cannot_be_configured_twice():
+    registry = ShortcodeRegistry([profile("north", "600100")])
+    with pytest.raises(ValueError):
+        registry.add(profile("again", "600100"))
+    with pytest.raises(ValueError):
+        registry.add(profile("default", LNMORepository.MPESA_LNMO_SHORT_CODE))
+
+
+async def test_an_order_is_paid_to_its_only_sellers_short_code(db):
+    registry = ShortcodeRegistry([profile("north", "600100", sellers=[1]), profile("south", "600200", sellers=[2])])
+    north_goods, south_goods, other_goods = [await add_product(user_id=seller) for seller in (1, 2, 3)]
+    single, mixed, unclaimed = await add_order(), await add_order(), await add_order()
+    await add_order_lines(single, north_goods, north_goods)
+    await add_order_lines(mixed, north_goods, south_goods)
+    await add_order_lines(unclaimed, other_goods)
+    async with async_session() as session:
+        assert (await registry.for_order(session, single.order_id)).MPESA_LNMO_SHORT_CODE == "600100"
+        assert await registry.for_order(session, mixed.order_id) is None
+        assert await registry.for_order(session, unclaimed.order_id) is None
+    assert registry.for_seller(2).MPESA_LNMO_SHORT_CODE == "600200"
@@ -0,0 +1,106 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import repositories.token_cache as token_cache
+from repositories.token_cache import AccessTokenCache
+
+pytestmark = pytest.mark.anyio
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+class Daraja:
+    """Token endpoint that hands out token-1, token-2, ... and can be held open"""
+
+    def __init__(self, expires_in: int = 3600):
+        self.expires_in = expires_in
+        self.calls = 0
+        self.gate = asyncio.Event()
+        self.gate.set()
+        self.error = None
+
+    async def fetch(self):
+        self.calls += 1
+        await self.gate.wait()
+        if self.error:
+            raise self.error
+        return f"token-{self.calls}", self.expires_in
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(token_cache, "time", SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+async def test_concurrent_misses_share_one_fetch(clock):
+    cache, daraja = AccessTokenCache(), Daraja()
+    daraja.gate.clear()
+    waiters = [asyncio.ensure_future(cache.get(daraja.fetch)) for _ in range(20)]
+    await settle()
+    daraja.gate.set()
+    assert await asyncio.gather(*waiters) == ["token-1"] * 20
+    assert daraja.calls == 1
+    assert await cache.get(daraja.fetch) == "token-1"
+    stats = cache.stats()
+    assert (stats["misses"], stats["hits"], stats["refreshes"]) == (20, 1, 1)
+
+
+async def test_a_token_near_expiry_is_served_while_it_refreshes(clock):
+    cache, daraja = AccessTokenCache(refresh_margin=300), Daraja()
+    await cache.get(daraja.fetch)
+    clock.now += 3600 - 299
+    daraja.gate.clear()
+    assert [await cache.get(daraja.fetch) for _ in range(3)] == ["token-1"] * 3
+    await settle()
+    assert (daraja.calls, cache.background_refreshes) == (2, 1)
+    daraja.gate.set()
+    await settle()
+    assert await cache.get(daraja.fetch) == "token-2"
+    assert cache.stats()["expires_in"] == 3600
+
+
+async def test_an_expired_token_is_never_served(clock):
+    cache, daraja = AccessTokenCache(), Daraja(expires_in=60)
+    await cache.get(daraja.fetch)
+    clock.now += 60
+    assert await cache.get(daraja.fetch) == "token-2"
+    cache.invalidate()
+    assert await cache.get(daraja.fetch) == "token-3"
+    assert cache.misses == 3
+
+
+async def test_a_failed_refresh_reaches_every_waiter_and_the_next_call_retries(clock):
+    cache, daraja = AccessTokenCache(), Daraja()
+    daraja.error = RuntimeError("Daraja down")
+    results = await asyncio.gather(cache.get(daraja.fetch), cache.get(daraja.fetch), return_exceptions=True)
+    assert [str(result) for result in results] == ["Daraja down"] * 2
+    assert (daraja.calls, cache.refresh_failures) == (1, 1)
+    daraja.error = None
+    assert await cache.get(daraja.fetch) == "token-2"
+
+
+async def test_a_cancelled_caller_leaves_the_refresh_running(clock):
+    cache, daraja = AccessTokenCache(), Daraja()
+    daraja.gate.clear()
+    impatient = asyncio.ensure_future(cache.get(daraja.fetch))
+    await settle()
+    impatient.cancel()
+    await settle()
+    daraja.gate.set()
+    assert await cache.get(daraja.fetch) == "token-1"
+    assert daraja.calls == 1
@@ -0,0 +1,127 @@
+import pytest
+from sqlalchemy import select
+
+from database import async_session
+from factories import add_order, add_transaction
+from models import OrderStatus, Orders, OrphanCallback, OutboxEvent, Transaction, TransactionStatus
+from repositories.lnmo_repository import LNMORepository
+from repositories.transaction_state import resolve_pending
+
+pytestmark = pytest.mark.anyio
+
+
+async def load(transaction_id: str) -> Transaction:
+    async with async_session() as db:
+        return (await db.execute(select(Transaction).where(Transaction.transaction_id == transaction_id))).scalar_one()
+
+
+async def resolve(transaction_id: str, status: TransactionStatus, **kwargs):
+    async with async_session() as db:
+        resolution = {"transaction_id": transaction_id, "status": status, "feedback": {"status": status.value}}
+        moved = await resolve_pending(db, [resolution], **kwargs)
+        await db.commit()
+        return moved
+
+
+def stk_callback(checkout_request_id: str, result_code: int = 0, receipt: str = "RKT1A2B3C4") -> dict:
+    callback = {"CheckoutRequestID": checkout_request_id, "ResultCode": result_code, "ResultDesc": "done"}
+    if result_code == 0:
+        callback["CallbackMetadata"] = {"Item": [{"Name": "Amount", "Value": 100}, {"Name": "MpesaReceiptNumber", "Value": receipt}]}
+    return {"Body": {"stkCallback": callback}}
+
+
+async def test_an_accepted_payment_moves_the_transaction_and_its_order(db):
+    order = await add_order()
+    transaction = await add_transaction(order_id=order.order_id)
+    moved = await resolve(transaction.transaction_id, TransactionStatus.ACCEPTED)
+    assert [(row.id, row.order_id, row._status) for row in moved] == [
+        (transaction.id, order.order_id, TransactionStatus.ACCEPTED)
+    ]
+    assert (await load(transaction.transaction_id))._status == TransactionStatus.ACCEPTED
+    async with async_session() as session:
+        assert (await session.get(Orders, order.order_id)).status == OrderStatus.DELIVERED
+        events = (await session.execute(select(OutboxEvent.event_type))).scalars().all()
+    assert sorted(events) == ["order.status_changed", "transaction.status_changed"]
+
+
+async def test_a_replayed_result_is_a_no_op(db):
+    transaction = await add_transaction()
+    await resolve(transaction.transaction_id, TransactionStatus.CANCELED)
+    assert await resolve(transaction.transaction_id, TransactionStatus.CANCELED) == []
+    async with async_session() as session:
+        assert len((await session.execute(select(OutboxEvent))).all()) == 1
+
+
+async def test_the_losing_side_of_a_race_leaves_the_row_unchanged(db):
+    transaction = await add_transaction()
+    async with async_session() as first, async_session() as second:
+        resolution = {"transaction_id": transaction.transaction_id, "feedback": {"by": "callback"}}
+        assert await resolve_pending(first, [{**resolution, "status": TransactionStatus.ACCEPTED}])
+        await first.commit()
+        lost = await resolve_pending(second, [{**resolution, "status": TransactionStatus.REJECTED, "feedback": {"by": "query"}}])
+        await second.commit()
+    assert lost == []
+    stored = await load(transaction.transaction_id)
+    assert (stored._status, stored._feedback) == (TransactionStatus.ACCEPTED, {"by": "callback"})
+
+
+async def test_expired_rows_move_only_when_asked(db):
+    transaction = await add_transaction(_status=TransactionStatus.EXPIRED)
+    assert await resolve(transaction.transaction_id, TransactionStatus.ACCEPTED) == []
+    moved = await resolve(
+        transaction.transaction_id, TransactionStatus.ACCEPTED,
+        from_statuses=(TransactionStatus.PENDING, TransactionStatus.EXPIRED),
+    )
+    assert [row._status for row in moved] == [TransactionStatus.ACCEPTED]
+
+
+async def test_only_terminal_statuses_are_valid_targets(db):
+    transaction = await add_transaction()
+    with pytest.raises(ValueError):
+        await resolve(transaction.transaction_id, TransactionStatus.PROCESSING)
+    assert (await load(transaction.transaction_id))._status == TransactionStatus.PENDING
+
+
+async def test_a_callback_records_the_receipt(db):
+    transaction = await add_transaction()
+    async with async_session() as session:
+        status = await LNMORepository().apply_callback(stk_callback(transaction.transaction_id), session)
+        await session.commit()
+    assert status == TransactionStatus.ACCEPTED
+    stored = await load(transaction.transaction_id)
+    assert (stored._status, stored.transaction_code) == (TransactionStatus.ACCEPTED, "RKT1A2B3C4")
+
+
+@pytest.mark.parametrize("result_code, status", [(1032, TransactionStatus.CANCELED), (2001, TransactionStatus.REJECTED)])
+async def test_a_failed_callback_maps_its_result_code(db, result_code, status):
+    transaction = await add_transaction()
+    async with async_session() as session:
+        assert await LNMORepository().apply_callback(stk_callback(transaction.transaction_id, result_code), session) == status
+        await session.commit()
+    assert (await load(transaction.transaction_id)).transaction_code is None
+
+
+async def test_a_replayed_callback_returns_none(db):
+    transaction = await add_transaction()
+    repo = LNMORepository()
+    async with async_session() as session:
+        await repo.apply_callback(stk_callback(transaction.transaction_id), session)
+        await session.commit()
+        assert await repo.apply_callback(stk_callback(transaction.transaction_id, 1032), session) is None
+        await session.commit()
+    assert (await load(transaction.transaction_id))._status == TransactionStatus.ACCEPTED
+
+
+async def test_a_callback_late_for_an_expired_payment_still_counts(db):
+    transaction = await add_transaction(_status=TransactionStatus.EXPIRED)
+    async with async_session() as session:
+        assert await LNMORepository().apply_callback(stk_callback(transaction.transaction_id), session) == TransactionStatus.ACCEPTED
+        await session.commit()
+
+
+async def test_a_callback_without_its_transaction_is_held(db):
+    async with async_session() as session:
+        assert await LNMORepository().apply_callback(stk_callback("ws_CO_unknown"), session) is None
+        await session.commit()
+        held = (await session.execute(select(OrphanCallback.checkout_request_id))).scalars().all()
+    assert held == ["ws_CO_unknown"]
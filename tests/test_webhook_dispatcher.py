@@ -0,0 +1,146 @@
+import hashlib
+import hmac
+import json
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+from sqlalchemy import select, update
+
+import workers.webhook_dispatcher as dispatch
+from database import async_session
+from models import OutboxEvent, Webhook, WebhookDelivery
+from outbox import ORDER_STATUS_CHANGED, TRANSACTION_STATUS_CHANGED, add_outbox_events
+from workers.webhook_dispatcher import WebhookDispatcher, webhook_dispatcher
+
+pytestmark = pytest.mark.anyio
+
+
+class Receiver:
+    """Webhook endpoints behind an httpx MockTransport; `status` is what they answer"""
+
+    def __init__(self, status: int = 200):
+        self.status = status
+        self.requests = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        if self.status is None:
+            raise httpx.ConnectError("connection refused", request=request)
+        return httpx.Response(self.status, text="nope" if self.status >= 400 else "ok")
+
+    def events(self, url: str) -> list:
+        return [
+            event["id"]
+            for request in self.requests if str(request.url) == url
+            for event in json.loads(request.content)["events"]
+        ]
+
+
+def dispatcher(receiver: Receiver, **kwargs) -> WebhookDispatcher:
+    webhooks = WebhookDispatcher(**kwargs)
+    webhooks._client = httpx.AsyncClient(transport=httpx.MockTransport(receiver))
+    return webhooks
+
+
+async def add_webhook(url: str, **columns) -> Webhook:
+    async with async_session() as db:
+        webhook = Webhook(url=url, **columns)
+        db.add(webhook)
+        await db.commit()
+        return webhook
+
+
+async def publish(*event_types: str) -> None:
+    async with async_session() as db:
+        await add_outbox_events(db, [(event_type, index, {"n": index}) for index, event_type in enumerate(event_types)])
+        await db.commit()
+
+
+async def deliveries() -> list:
+    async with async_session() as db:
+        return (await db.execute(select(WebhookDelivery).order_by(WebhookDelivery.id))).scalars().all()
+
+
+async def test_events_are_staged_with_the_change_they_describe(db):
+    webhook_dispatcher._wake.clear()
+    async with async_session() as session:
+        await add_outbox_events(session, [(ORDER_STATUS_CHANGED, 1, {"status": "CANCELLED"})])
+        await session.rollback()
+    assert not webhook_dispatcher._wake.is_set()
+    await publish(ORDER_STATUS_CHANGED)
+    assert webhook_dispatcher._wake.is_set()
+    async with async_session() as session:
+        assert (await session.execute(select(OutboxEvent.aggregate_id))).scalars().all() == ["0"]
+
+
+async def test_events_fan_out_to_subscribers_and_are_delivered_in_signed_batches(db):
+    everything = await add_webhook("https://shop.test/all", secret="s3cret")
+    await add_webhook("https://shop.test/orders", event_types=f" {ORDER_STATUS_CHANGED} ")
+    await add_webhook("https://shop.test/off", active=False)
+    await publish(TRANSACTION_STATUS_CHANGED, ORDER_STATUS_CHANGED, TRANSACTION_STATUS_CHANGED)
+
+    receiver = Receiver()
+    webhooks = dispatcher(receiver, batch_size=2)
+    assert await webhooks.fan_out() == 3
+    assert await webhooks.fan_out() == 0
+    assert await webhooks.deliver_once() == 4
+    assert await webhooks.deliver_once() == 0
+
+    assert sorted(receiver.events("https://shop.test/all")) == [1, 2, 3]
+    assert receiver.events("https://shop.test/orders") == [2]
+    assert len(receiver.requests) == 3
+    signed = next(request for request in receiver.requests if str(request.url) == everything.url)
+    expected = hmac.new(b"s3cret", signed.content, hashlib.sha256).hexdigest()
+    assert signed.headers["X-Webhook-Signature"] == f"sha256={expected}"
+    assert all(delivery.delivered_at for delivery in await deliveries())
+    assert webhooks.stats()["delivered"] == 4
+
+
+async def test_a_failed_delivery_backs_off_and_is_retried(db):
+    await add_webhook("https://shop.test/flaky")
+    await publish(ORDER_STATUS_CHANGED)
+    receiver = Receiver(status=500)
+    webhooks = dispatcher(receiver)
+    await webhooks.fan_out()
+
+    assert await webhooks.deliver_once() == 1
+    (delivery,) = await deliveries()
+    assert (delivery.attempts, delivery.delivered_at, delivery.last_error) == (1, None, "HTTP 500: nope")
+    assert delivery.next_attempt_at > datetime.utcnow()
+    # Not due again until the backoff has passed
+    assert await webhooks.deliver_once() == 0
+
+    async with async_session() as session:
+        await session.execute(update(WebhookDelivery).values(next_attempt_at=datetime.utcnow() - timedelta(seconds=1)))
+        await session.commit()
+    receiver.status = None
+    assert await webhooks.deliver_once() == 1
+    assert (await deliveries())[0].last_error.startswith("ConnectError")
+
+    async with async_session() as session:
+        await session.execute(update(WebhookDelivery).values(next_attempt_at=datetime.utcnow() - timedelta(seconds=1)))
+        await session.commit()
+    receiver.status = 204
+    assert await webhooks.deliver_once() == 1
+    (delivery,) = await deliveries()
+    assert (delivery.attempts, delivery.delivered_at is not None) == (3, True)
+    assert (webhooks.failed_attempts, webhooks.delivered, webhooks.dead) == (2, 1, 0)
+
+
+async def test_a_delivery_is_given_up_after_the_last_attempt(db, monkeypatch):
+    monkeypatch.setattr(dispatch, "WEBHOOK_MAX_ATTEMPTS", 1)
+    await add_webhook("https://shop.test/gone")
+    await publish(ORDER_STATUS_CHANGED)
+    webhooks = dispatcher(Receiver(status=410))
+    await webhooks.fan_out()
+    await webhooks.deliver_once()
+    (delivery,) = await deliveries()
+    assert delivery.failed_at is not None and delivery.delivered_at is None
+    assert webhooks.dead == 1
+
+
+def test_retry_delay_grows_with_jitter_up_to_the_cap():
+    assert dispatch.WEBHOOK_RETRY_BASE / 2 <= dispatch.retry_delay(1) <= dispatch.WEBHOOK_RETRY_BASE
+    assert dispatch.retry_delay(4) <= dispatch.WEBHOOK_RETRY_BASE * 8
+    assert dispatch.retry_delay(100) <= dispatch.WEBHOOK_RETRY_MAX
@@ -0,0 +1,242 @@
+"""Local stand-in for the Daraja endpoints used by LNMORepository and B2CRepository.
+
+Run it next to the API and point the app at it:
+
+    python -m tools.daraja_simulator --port 9000
+    MPESA_API_BASE_URL=http://localhost:9000 \\
+    MPESA_CALLBACK_URL=http://localhost:8000/ipn/daraja/lnmo/callback uvicorn main:app
+
+Behaviour is tuned with environment variables:
+
+    SIM_LATENCY_MS        response latency for every endpoint (default 150)
+    SIM_CALLBACK_DELAY_MS delay before the STK callback is sent (default 2000)
+    SIM_FAILURE_RATE      share of STK pushes answered with HTTP 503 (default 0)
+    SIM_RESULT_CODES      weighted callback result codes (default "0:0.85,1032:0.1,2001:0.05")
+    SIM_CALLBACK_URL      overrides the CallBackURL sent in the STK push
+    SIM_B2C_RESULT_CODES  weighted B2C result codes (default "0:0.95,2001:0.05")
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Tuple
+
+import httpx
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse
+
+logger = logging.getLogger(__name__)
+
+SIM_LATENCY_MS = float(os.getenv("SIM_LATENCY_MS", "150"))
+SIM_CALLBACK_DELAY_MS = float(os.getenv("SIM_CALLBACK_DELAY_MS", "2000"))
+SIM_FAILURE_RATE = float(os.getenv("SIM_FAILURE_RATE", "0"))
+SIM_RESULT_CODES = os.getenv("SIM_RESULT_CODES", "0:0.85,1032:0.1,2001:0.05")
+SIM_CALLBACK_URL = os.getenv("SIM_CALLBACK_URL")
+SIM_B2C_RESULT_CODES = os.getenv("SIM_B2C_RESULT_CODES", "0:0.95,2001:0.05")
+
+RESULT_DESCRIPTIONS = {
+    0: "The service request is processed successfully.",
+    1: "The balance is insufficient for the transaction.",
+    1032: "Request cancelled by user",
+    1037: "DS timeout user cannot be reached",
+    2001: "The initiator information is invalid.",
+}
+
+
+def parse_result_codes(spec: str) -> Tuple[List[int], List[float]]:
+    codes, weights = [], []
+    for part in spec.split(","):
+        code, weight = part.split(":")
+        codes.append(int(code))
+        weights.append(float(weight))
+    return codes, weights
+
+
+RESULT_CODES, RESULT_WEIGHTS = parse_result_codes(SIM_RESULT_CODES)
+B2C_RESULT_CODES, B2C_RESULT_WEIGHTS = parse_result_codes(SIM_B2C_RESULT_CODES)
+
+app = FastAPI(title="Daraja simulator")
+tokens = set()
+# CheckoutRequestID -> STK push state
+pushes: Dict[str, Dict[str, Any]] = {}
+stats = {
+    "tokens": 0, "stk_pushes": 0, "b2c_payments": 0, "failures": 0, "queries": 0,
+    "callbacks_sent": 0, "callback_errors": 0,
+}
+callback_client = httpx.AsyncClient(timeout=httpx.Timeout(10))
+
+
+async def simulate_latency() -> None:
+    if SIM_LATENCY_MS > 0:
+        await asyncio.sleep(SIM_LATENCY_MS / 1000)
+
+
+def require_token(request: Request) -> None:
+    auth = request.headers.get("Authorization", "")
+    if not auth.startswith("Bearer ") or auth[len("Bearer "):] not in tokens:
+        raise HTTPException(status_code=401, detail={"errorCode": "404.001.03", "errorMessage": "Invalid Access Token"})
+
+
+def callback_body(checkout_request_id: str, push: Dict[str, Any]) -> Dict[str, Any]:
+    result_code = push["result_code"]
+    stk_callback = {
+        "MerchantRequestID": push["merchant_request_id"],
+        "CheckoutRequestID": checkout_request_id,
+        "ResultCode": result_code,
+        "ResultDesc": RESULT_DESCRIPTIONS.get(result_code, "Request failed"),
+    }
+    if result_code == 0:
+        stk_callback["CallbackMetadata"] = {
+            "Item": [
+                {"Name": "Amount", "Value": push["amount"]},
+                {"Name": "MpesaReceiptNumber", "Value": push["receipt"]},
+                {"Name": "TransactionDate", "Value": int(datetime.now().strftime("%Y%m%d%H%M%S"))},
+                {"Name": "PhoneNumber", "Value": push["phone_number"]},
+            ]
+        }
+    return {"Body": {"stkCallback": stk_callback}}
+
+
+async def post_callback(url: str, body: Dict[str, Any]) -> None:
+    try:
+        response = await callback_client.post(url, json=body)
+        stats["callbacks_sent"] += 1
+        if response.status_code != 200:
+            stats["callback_errors"] += 1
+    except httpx.HTTPError as e:
+        stats["callback_errors"] += 1
+        logger.error(f"Callback to {url} failed: {str(e)}")
+
+
+async def send_callback(checkout_request_id: str) -> None:
+    await asyncio.sleep(SIM_CALLBACK_DELAY_MS / 1000)
+    push = pushes[checkout_request_id]
+    push["completed"] = True
+    await post_callback(push["callback_url"], callback_body(checkout_request_id, push))
+
+
+async def send_b2c_result(payload: Dict[str, Any], conversation_id: str) -> None:
+    await asyncio.sleep(SIM_CALLBACK_DELAY_MS / 1000)
+    result_code = random.choices(B2C_RESULT_CODES, weights=B2C_RESULT_WEIGHTS)[0]
+    result = {
+        "ResultType": 0,
+        "ResultCode": result_code,
+        "ResultDesc": RESULT_DESCRIPTIONS.get(result_code, "Request failed"),
+        "OriginatorConversationID": payload.get("OriginatorConversationID"),
+        "ConversationID": conversation_id,
+        "TransactionID": uuid.uuid4().hex[:10].upper(),
+    }
+    if result_code == 0:
+        result["ResultParameters"] = {
+            "ResultParameter": [
+                {"Key": "TransactionAmount", "Value": payload.get("Amount")},
+                {"Key": "ReceiverPartyPublicName", "Value": f"{payload.get('PartyB')} - Simulated Payee"},
+            ]
+        }
+    await post_callback(payload.get("ResultURL"), {"Result": result})
+
+
+@app.get("/oauth/v1/generate")
+async def generate_token(request: Request, grant_type: str = "client_credentials"):
+    await simulate_latency()
+    if not request.headers.get("Authorization", "").startswith("Basic "):
+        raise HTTPException(status_code=400, detail="Invalid credentials")
+    token = uuid.uuid4().hex
+    tokens.add(token)
+    stats["tokens"] += 1
+    return {"access_token": token, "expires_in": "3599"}
+
+
+@app.post("/mpesa/stkpush/v1/processrequest")
+async def stk_push(request: Request):
+    await simulate_latency()
+    require_token(request)
+    payload = await request.json()
+    if random.random() < SIM_FAILURE_RATE:
+        stats["failures"] += 1
+        return JSONResponse(status_code=503, content={"errorCode": "503.001.01", "errorMessage": "Service unavailable"})
+
+    checkout_request_id = f"ws_CO_{datetime.now().strftime('%d%m%Y%H%M%S')}{uuid.uuid4().hex[:12]}"
+    merchant_request_id = f"{random.randint(10000, 99999)}-{random.randint(1000000, 9999999)}-1"
+    pushes[checkout_request_id] = {
+        "merchant_request_id": merchant_request_id,
+        "amount": payload.get("Amount"),
+        "phone_number": payload.get("PhoneNumber"),
+        "callback_url": SIM_CALLBACK_URL or payload.get("CallBackURL"),
+        "result_code": random.choices(RESULT_CODES, weights=RESULT_WEIGHTS)[0],
+        "receipt": uuid.uuid4().hex[:10].upper(),
+        "completed": False,
+    }
+    stats["stk_pushes"] += 1
+    asyncio.create_task(send_callback(checkout_request_id))
+    return {
+        "MerchantRequestID": merchant_request_id,
+        "CheckoutRequestID": checkout_request_id,
+        "ResponseCode": "0",
+        "ResponseDescription": "Success. Request accepted for processing",
+        "CustomerMessage": "Success. Request accepted for processing",
+    }
+
+
+@app.post("/mpesa/stkpushquery/v1/query")
+async def stk_query(request: Request):
+    await simulate_latency()
+    require_token(request)
+    payload = await request.json()
+    stats["queries"] += 1
+    checkout_request_id = payload.get("CheckoutRequestID")
+    push = pushes.get(checkout_request_id)
+    if push is None:
+        return JSONResponse(status_code=400, content={"errorCode": "400.002.02", "errorMessage": "Invalid CheckoutRequestID"})
+    if not push["completed"]:
+        return JSONResponse(
+            status_code=500,
+            content={"errorCode": "500.001.1001", "errorMessage": "The transaction is being processed"},
+        )
+    result_code = push["result_code"]
+    return {
+        "ResponseCode": "0",
+        "ResponseDescription": "The service request has been accepted successsfully",
+        "MerchantRequestID": push["merchant_request_id"],
+        "CheckoutRequestID": checkout_request_id,
+        "ResultCode": str(result_code),
+        "ResultDesc": RESULT_DESCRIPTIONS.get(result_code, "Request failed"),
+    }
+
+
+@app.post("/mpesa/b2c/v3/paymentrequest")
+async def b2c_payment(request: Request):
+    await simulate_latency()
+    require_token(request)
+    payload = await request.json()
+    if random.random() < SIM_FAILURE_RATE:
+        stats["failures"] += 1
+        return JSONResponse(status_code=503, content={"errorCode": "503.001.01", "errorMessage": "Service unavailable"})
+    conversation_id = f"AG_{datetime.now().strftime('%Y%m%d')}_{uuid.uuid4().hex[:20]}"
+    stats["b2c_payments"] += 1
+    asyncio.create_task(send_b2c_result(payload, conversation_id))
+    return {
+        "ConversationID": conversation_id,
+        "OriginatorConversationID": payload.get("OriginatorConversationID"),
+        "ResponseCode": "0",
+        "ResponseDescription": "Accept the service request successfully.",
+    }
+
+
+@app.get("/simulator/stats")
+async def simulator_stats():
+    return {**stats, "open_pushes": sum(1 for push in pushes.values() if not push["completed"])}
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run the local Daraja simulator")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=9000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    uvicorn.run(app, host=args.host, port=args.port)
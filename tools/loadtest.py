@@ -0,0 +1,176 @@
+"""End-to-end load test for the payment path.
+
+Each flow runs create_order -> initiate_payment -> callback -> status against a
+running API (normally wired to tools/daraja_simulator.py) and the driver prints
+throughput plus p50/p99 latency per stage:
+
+    python -m tools.loadtest --email load@example.com --password secret \\
+        --register --product-id 1 --flows 500 --concurrency 50 --users 100
+
+STK pushes are throttled per user and per phone (PAYMENT_USER_BURST and
+PAYMENT_PHONE_BURST, refilled at PAYMENT_*_PER_MINUTE), so the flows are spread
+over --users customers (load+0@example.com, load+1@example.com, ...) and every
+flow pays from its own phone number counting up from --phone. Each user starts
+about flows / users payments at once: keep that within PAYMENT_USER_BURST, or
+raise it on the API under test, or initiate_payment reports 429s.
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import httpx
+
+TERMINAL_STATUSES = {"ACCEPTED", "REJECTED", "CANCELED", "EXPIRED"}
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = max(int(round(pct / 100 * len(ordered))) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.outcomes: Dict[str, int] = defaultdict(int)
+        self.throttled = 0
+        self.user_headers: List[Dict[str, str]] = []
+
+    async def login(self, client: httpx.AsyncClient, index: int) -> Dict[str, str]:
+        local, domain = self.args.email.split("@")
+        credentials = {"email": f"{local}+{index}@{domain}", "password": self.args.password}
+        if self.args.register:
+            await client.post("/auth/register/customer", json={"username": f"{local}{index}", **credentials})
+        response = await client.post("/auth/login", json=credentials)
+        response.raise_for_status()
+        return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    async def timed(self, stage: str, request) -> Optional[httpx.Response]:
+        started = time.perf_counter()
+        try:
+            response = await request
+        except httpx.HTTPError:
+            self.errors[stage] += 1
+            return None
+        self.latencies[stage].append(time.perf_counter() - started)
+        if response.status_code >= 400:
+            self.errors[stage] += 1
+            self.throttled += response.status_code == 429
+            return None
+        return response
+
+    async def wait_for_status(self, client: httpx.AsyncClient, headers: Dict[str, str], order_id: int) -> Optional[str]:
+        if self.args.poll:
+            while True:
+                response = await client.get(f"/check_payment_status/{order_id}", headers=headers)
+                if response.status_code == 200 and response.json()["status"] in TERMINAL_STATUSES:
+                    return response.json()["status"]
+                await asyncio.sleep(self.args.poll_interval)
+
+        async with client.stream(
+            "GET", f"/payment_events/{order_id}", headers=headers, timeout=self.args.status_timeout
+        ) as response:
+            async for line in response.aiter_lines():
+                if line.startswith("data:"):
+                    payment_status = json.loads(line[len("data:"):]).get("status")
+                    if payment_status in TERMINAL_STATUSES:
+                        return payment_status
+        return None
+
+    async def flow(self, client: httpx.AsyncClient, index: int) -> None:
+        started = time.perf_counter()
+        headers = self.user_headers[index % len(self.user_headers)]
+        cart = {"cart": [{"id": self.args.product_id, "quantity": self.args.quantity}]}
+        response = await self.timed("create_order", client.post(
+            "/create_order", json=cart, headers={**headers, "Idempotency-Key": uuid.uuid4().hex}
+        ))
+        if response is None:
+            return
+        order_id = response.json()["order_id"]
+
+        response = await self.timed("fetch_order", client.get(f"/orders/{order_id}", headers=headers))
+        if response is None:
+            return
+        phone = str(int(self.args.phone) + index)
+        payment = {"order_id": order_id, "phone_number": phone, "amount": response.json()["total"]}
+
+        response = await self.timed("initiate_payment", client.post(
+            "/initiate_payment", json=payment, headers={**headers, "Idempotency-Key": uuid.uuid4().hex}
+        ))
+        if response is None:
+            return
+
+        status_started = time.perf_counter()
+        try:
+            payment_status = await asyncio.wait_for(
+                self.wait_for_status(client, headers, order_id), timeout=self.args.status_timeout
+            )
+        except (httpx.HTTPError, asyncio.TimeoutError):
+            payment_status = None
+        if payment_status is None:
+            self.errors["callback_to_status"] += 1
+            return
+        self.latencies["callback_to_status"].append(time.perf_counter() - status_started)
+        self.latencies["end_to_end"].append(time.perf_counter() - started)
+        self.outcomes[payment_status] += 1
+
+    async def run(self) -> None:
+        limits = httpx.Limits(max_connections=self.args.concurrency * 2)
+        async with httpx.AsyncClient(base_url=self.args.base_url, limits=limits, timeout=30) as client:
+            users = self.args.users or self.args.concurrency
+            self.user_headers = await asyncio.gather(*[self.login(client, index) for index in range(users)])
+            semaphore = asyncio.Semaphore(self.args.concurrency)
+
+            async def bounded_flow(index: int):
+                async with semaphore:
+                    await self.flow(client, index)
+
+            started = time.perf_counter()
+            await asyncio.gather(*[bounded_flow(index) for index in range(self.args.flows)])
+            self.report(time.perf_counter() - started)
+
+    def report(self, elapsed: float) -> None:
+        completed = len(self.latencies["end_to_end"])
+        print(f"\n{completed}/{self.args.flows} flows completed in {elapsed:.2f}s "
+              f"({completed / elapsed:.1f} flows/s)")
+        print(f"Outcomes: {dict(self.outcomes)}")
+        if self.throttled:
+            print(f"Throttled (429): {self.throttled}; use more --users or raise PAYMENT_USER_BURST on the API")
+        print(f"{'stage':<20}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for stage in ["create_order", "fetch_order", "initiate_payment", "callback_to_status", "end_to_end"]:
+            samples = self.latencies[stage]
+            print(
+                f"{stage:<20}{len(samples):>8}{self.errors[stage]:>8}"
+                f"{percentile(samples, 50) * 1000:>10.1f}{percentile(samples, 99) * 1000:>10.1f}"
+                f"{(max(samples) if samples else 0) * 1000:>10.1f}"
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test create_order -> initiate_payment -> callback -> status")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--email", required=True, help="base address; user N logs in as local+N@domain")
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--register", action="store_true", help="register the customer before logging in")
+    parser.add_argument("--product-id", type=int, required=True)
+    parser.add_argument("--quantity", type=float, default=1)
+    parser.add_argument("--phone", default="254708374149", help="first payer number; flow N pays from phone + N")
+    parser.add_argument("--users", type=int, help="customers to spread the flows over (default: --concurrency)")
+    parser.add_argument("--flows", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--status-timeout", type=float, default=60)
+    parser.add_argument("--poll", action="store_true", help="poll /check_payment_status instead of streaming events")
+    parser.add_argument("--poll-interval", type=float, default=1)
+    asyncio.run(LoadTest(parser.parse_args()).run())
+
+
+if __name__ == "__main__":
+    main()
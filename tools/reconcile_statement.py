@@ -0,0 +1,280 @@
+"""Reconcile an M-Pesa organisation statement export against the transactions table.
+
+The statement is streamed in chunks; for each chunk the matching transactions are
+bulk-loaded by receipt (transaction_code or transaction_id) in one indexed query and
+joined in memory, so memory stays bounded by the chunk size no matter how long the
+statement is. The ids of matched transactions go to a temporary table, and accepted
+transactions inside the statement's time window that never matched a statement line
+are found with an anti-join against it and reported as orphaned:
+
+    python -m tools.reconcile_statement statement.csv --output discrepancies.csv
+
+Every discrepancy is written to the output CSV as it is found and a JSON summary is
+printed at the end.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import sys
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+from typing import Dict, Iterator, List, Optional, TextIO
+
+from sqlalchemy import Column, Integer, MetaData, Table, exists, or_, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from database import async_session, engine
+from models import Transaction, TransactionStatus
+
+TIME_FORMATS = ("%d-%m-%Y %H:%M:%S", "%d/%m/%Y %H:%M:%S", "%d.%m.%Y %H:%M:%S", "%Y%m%d%H%M%S")
+REPORT_HEADER = ["kind", "receipt", "transaction_id", "statement_amount", "db_amount", "db_status", "completion_time"]
+
+# Lives in the reconciler's own transaction, which is never committed
+matched_transactions = Table(
+    "statement_matched_transactions",
+    MetaData(),
+    Column("id", Integer, primary_key=True),
+    prefixes=["TEMPORARY"],
+)
+
+
+@dataclass
+class StatementLine:
+    receipt: str
+    amount: Decimal
+    completed_at: Optional[datetime]
+
+
+@dataclass
+class Summary:
+    statement_lines: int = 0
+    skipped_lines: int = 0
+    matched: int = 0
+    missing: int = 0
+    amount_mismatch: int = 0
+    status_mismatch: int = 0
+    orphaned: int = 0
+    chunks: int = 0
+    window: List[Optional[str]] = field(default_factory=lambda: [None, None])
+    elapsed_seconds: float = 0.0
+
+
+def parse_amount(value: str) -> Optional[Decimal]:
+    value = (value or "").replace(",", "").strip()
+    if not value:
+        return None
+    try:
+        return abs(Decimal(value))
+    except InvalidOperation:
+        return None
+
+
+def parse_time(value: str) -> Optional[datetime]:
+    value = (value or "").strip()
+    try:
+        # The usual export format, parsed in C rather than through strptime
+        return datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.strptime(value, time_format)
+        except ValueError:
+            continue
+    return None
+
+
+def find_header(handle: TextIO, receipt_column: str) -> List[str]:
+    """Skip the account preamble that statement exports put above the column header"""
+    for line in handle:
+        row = next(csv.reader([line]))
+        if receipt_column in (cell.strip() for cell in row):
+            return [cell.strip() for cell in row]
+    raise ValueError(f"No header row with a {receipt_column!r} column found")
+
+
+def read_statement(handle: TextIO, args: argparse.Namespace, summary: Summary) -> Iterator[StatementLine]:
+    header = find_header(handle, args.receipt_column)
+
+    def index(name: str) -> Optional[int]:
+        return header.index(name) if name in header else None
+
+    receipt_at, status_at, time_at, paid_in_at, withdrawn_at = (
+        index(args.receipt_column),
+        index(args.status_column),
+        index(args.time_column),
+        index(args.paid_in_column),
+        index(args.withdrawn_column),
+    )
+    completed = args.completed_status.lower()
+
+    def cell(row: List[str], at: Optional[int]) -> str:
+        return row[at] if at is not None and at < len(row) else ""
+
+    for row in csv.reader(handle):
+        receipt = cell(row, receipt_at).strip()
+        amount = parse_amount(cell(row, paid_in_at)) or parse_amount(cell(row, withdrawn_at))
+        status = cell(row, status_at).strip().lower() if status_at is not None else completed
+        if not receipt or amount is None or status != completed:
+            summary.skipped_lines += 1
+            continue
+        summary.statement_lines += 1
+        yield StatementLine(receipt, amount, parse_time(cell(row, time_at)))
+
+
+def chunked(lines: Iterator[StatementLine], size: int) -> Iterator[List[StatementLine]]:
+    while True:
+        chunk = list(islice(lines, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class StatementReconciler:
+    def __init__(self, args: argparse.Namespace, report: csv.writer):
+        self.args = args
+        self.report = report
+        self.summary = Summary()
+        self.earliest: Optional[datetime] = None
+        self.latest: Optional[datetime] = None
+
+    async def run(self, handle: TextIO) -> Summary:
+        started = time.perf_counter()
+        async with async_session() as db:
+            connection = await db.connection()
+            await connection.run_sync(matched_transactions.create)
+            for chunk in chunked(read_statement(handle, self.args, self.summary), self.args.chunk_size):
+                await self.reconcile_chunk(db, chunk)
+            await self.find_orphans(db)
+        self.summary.elapsed_seconds = round(time.perf_counter() - started, 3)
+        return self.summary
+
+    async def reconcile_chunk(self, db, chunk: List[StatementLine]) -> None:
+        receipts = [line.receipt for line in chunk]
+        result = await db.execute(
+            select(
+                Transaction.id,
+                Transaction.transaction_code,
+                Transaction.transaction_id,
+                Transaction.transaction_amount,
+                Transaction._status,
+            ).where(or_(Transaction.transaction_code.in_(receipts), Transaction.transaction_id.in_(receipts)))
+        )
+        by_receipt: Dict[str, object] = {}
+        for row in result.all():
+            for key in (row.transaction_code, row.transaction_id):
+                if key:
+                    by_receipt[key] = row
+
+        matched_ids = set()
+        for line in chunk:
+            self.extend_window(line.completed_at)
+            row = by_receipt.get(line.receipt)
+            if row is None:
+                self.record("missing", line)
+                continue
+            matched_ids.add(row.id)
+            if row._status != TransactionStatus.ACCEPTED:
+                self.record("status_mismatch", line, row)
+            elif Decimal(row.transaction_amount) != line.amount:
+                self.record("amount_mismatch", line, row)
+            else:
+                self.summary.matched += 1
+        if matched_ids:
+            insert = postgresql.insert if engine.dialect.name == "postgresql" else sqlite.insert
+            # A receipt repeated in another chunk matches the same row again
+            await db.execute(
+                insert(matched_transactions).on_conflict_do_nothing(),
+                [{"id": transaction_id} for transaction_id in matched_ids],
+            )
+        self.summary.chunks += 1
+
+    async def find_orphans(self, db) -> None:
+        """Stream accepted transactions in the statement window that no statement line matched"""
+        since = self.args.since or self.earliest
+        until = self.args.until or self.latest
+        if since is None or until is None:
+            return
+        self.summary.window = [since.isoformat(), until.isoformat()]
+        slack = timedelta(minutes=self.args.slack_minutes)
+        rows = await db.stream(
+            select(
+                Transaction.id,
+                Transaction.transaction_code,
+                Transaction.transaction_id,
+                Transaction.transaction_amount,
+                Transaction._status,
+                Transaction.transaction_timestamp,
+            )
+            .where(
+                Transaction._status == TransactionStatus.ACCEPTED,
+                Transaction.transaction_code.is_not(None),
+                Transaction.transaction_timestamp.between(since - slack, until + slack),
+                ~exists().where(matched_transactions.c.id == Transaction.id),
+            )
+            .execution_options(yield_per=self.args.chunk_size)
+        )
+        async for row in rows:
+            self.record("orphaned", None, row)
+
+    def extend_window(self, completed_at: Optional[datetime]) -> None:
+        if completed_at is None:
+            return
+        if self.earliest is None or completed_at < self.earliest:
+            self.earliest = completed_at
+        if self.latest is None or completed_at > self.latest:
+            self.latest = completed_at
+
+    def record(self, kind: str, line: Optional[StatementLine], row=None) -> None:
+        setattr(self.summary, kind, getattr(self.summary, kind) + 1)
+        completed_at = line.completed_at if line else getattr(row, "transaction_timestamp", None)
+        self.report.writerow([
+            kind,
+            line.receipt if line else row.transaction_code,
+            row.transaction_id if row is not None else "",
+            line.amount if line else "",
+            row.transaction_amount if row is not None else "",
+            row._status.value if row is not None else "",
+            completed_at.isoformat() if completed_at else "",
+        ])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Reconcile an M-Pesa statement CSV against the transactions table")
+    parser.add_argument("statement", help="Statement CSV export")
+    parser.add_argument("--output", default="-", help="Discrepancy CSV (default: stdout)")
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--since", type=datetime.fromisoformat, help="Start of the orphan scan window")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="End of the orphan scan window")
+    parser.add_argument("--slack-minutes", type=int, default=5, help="Widen the orphan window for clock skew")
+    parser.add_argument("--receipt-column", default="Receipt No.")
+    parser.add_argument("--time-column", default="Completion Time")
+    parser.add_argument("--status-column", default="Transaction Status")
+    parser.add_argument("--completed-status", default="Completed")
+    parser.add_argument("--paid-in-column", default="Paid In")
+    parser.add_argument("--withdrawn-column", default="Withdrawn")
+    args = parser.parse_args()
+    engine.echo = False
+
+    async def run() -> Summary:
+        output = sys.stdout if args.output == "-" else open(args.output, "w", newline="")
+        try:
+            with open(args.statement, newline="", encoding="utf-8-sig") as handle:
+                report = csv.writer(output)
+                report.writerow(REPORT_HEADER)
+                return await StatementReconciler(args, report).run(handle)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+            await engine.dispose()
+
+    summary = asyncio.run(run())
+    print(json.dumps(summary.__dict__, indent=2), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
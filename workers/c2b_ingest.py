@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+from cache import TTLCache
+from database import async_session, engine
+from models import Transaction, TransactionStatus
+from models.transaction import TransactionAggregator, TransactionCategory, TransactionChannel, TransactionType
+
+logger = logging.getLogger(__name__)
+
+C2B_BATCH_SIZE = int(os.getenv("C2B_BATCH_SIZE", "500"))
+# How long the first confirmation in a batch waits for others to join it
+C2B_BATCH_MAX_WAIT = float(os.getenv("C2B_BATCH_MAX_WAIT", "0.02"))
+C2B_WRITERS = int(os.getenv("C2B_WRITERS", "2"))
+C2B_RECENT_IDS = int(os.getenv("C2B_RECENT_IDS", "100000"))
+C2B_RECENT_TTL = float(os.getenv("C2B_RECENT_TTL", "86400"))
+
+
+def transaction_row(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Map a C2B confirmation body straight to Transaction column values"""
+    trans_id = str(payload["TransID"])
+    try:
+        amount = Decimal(str(payload["TransAmount"]))
+    except InvalidOperation:
+        raise ValueError(f"Invalid TransAmount {payload['TransAmount']!r}")
+    try:
+        timestamp = datetime.strptime(str(payload.get("TransTime")), "%Y%m%d%H%M%S")
+    except ValueError:
+        timestamp = datetime.now()
+    return {
+        "_pid": f"C2B-{trans_id}",
+        "party_a": str(payload.get("MSISDN", "")),
+        "party_b": str(payload.get("BusinessShortCode", "")),
+        "account_reference": str(payload.get("BillRefNumber") or "")[:150],
+        "transaction_category": TransactionCategory.PURCHASE_ORDER,
+        "transaction_type": TransactionType.CREDIT,
+        "transaction_channel": TransactionChannel.C2B,
+        "transaction_aggregator": TransactionAggregator.MPESA_KE,
+        "transaction_amount": amount,
+        "transaction_code": trans_id,
+        "transaction_timestamp": timestamp,
+        "transaction_details": str(payload.get("TransactionType") or "C2B payment"),
+        "_feedback": payload,
+        "_status": TransactionStatus.ACCEPTED,
+        "created_at": datetime.utcnow(),
+    }
+
+
+class C2BBatchWriter:
+    """Group-commits C2B confirmations into multi-row INSERT ... ON CONFLICT DO NOTHING
+
+    Each caller waits until its batch is committed, so a confirmation is only acked
+    once it is durable. TransIDs seen recently are answered from memory; the unique
+    transaction_code index catches the rest. When a batch fails its rows are written
+    again one by one, each in a savepoint, so one bad confirmation fails only its own
+    caller.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = C2B_BATCH_SIZE,
+        max_wait: float = C2B_BATCH_MAX_WAIT,
+        writers: int = C2B_WRITERS,
+    ):
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self._writers = asyncio.Semaphore(writers)
+        self._pending: List[Tuple[Dict[str, Any], asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+        self.recent_ids = TTLCache(maxsize=C2B_RECENT_IDS, ttl=C2B_RECENT_TTL)
+        self.received = 0
+        self.inserted = 0
+        self.duplicates_memory = 0
+        self.duplicates_db = 0
+        self.duplicates_batch = 0
+        self.batches = 0
+        self.batched_rows = 0
+        self.failed_batches = 0
+        self.row_fallbacks = 0
+        self.failed_rows = 0
+        self.last_batch_size = 0
+        self.last_flush_ms = 0.0
+
+    def seen(self, trans_id: str) -> bool:
+        if self.recent_ids.get(trans_id) is None:
+            return False
+        self.duplicates_memory += 1
+        return True
+
+    async def submit(self, row: Dict[str, Any]) -> bool:
+        """Queue a row for the next batch; True if it was new, False if already stored"""
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self.received += 1
+        self._pending.append((row, waiter))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await waiter
+
+    async def stop(self) -> None:
+        self._flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "received": self.received,
+            "inserted": self.inserted,
+            "duplicates_memory": self.duplicates_memory,
+            "duplicates_db": self.duplicates_db,
+            "duplicates_batch": self.duplicates_batch,
+            "batches": self.batches,
+            "failed_batches": self.failed_batches,
+            "row_fallbacks": self.row_fallbacks,
+            "failed_rows": self.failed_rows,
+            "avg_batch_size": round(self.batched_rows / self.batches, 1) if self.batches else 0.0,
+            "last_batch_size": self.last_batch_size,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "recent_ids": len(self.recent_ids),
+        }
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        task = asyncio.create_task(self._write(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _write(self, batch: List[Tuple[Dict[str, Any], asyncio.Future]]) -> None:
+        # A retry that lands in the same batch as the original is inserted once
+        rows = list({row["transaction_code"]: row for row, _ in batch}.values())
+        failed: Dict[str, Exception] = {}
+        async with self._writers:
+            started = time.perf_counter()
+            try:
+                inserted = await self._insert_batch(rows)
+            except Exception as e:
+                logger.warning(f"C2B batch of {len(rows)} failed, writing its rows one by one: {str(e)}")
+                self.row_fallbacks += 1
+                try:
+                    inserted, failed = await self._insert_rows(rows)
+                except Exception as e:
+                    self.failed_batches += 1
+                    logger.error(f"Error writing {len(batch)} C2B confirmations: {str(e)}")
+                    for _, waiter in batch:
+                        if not waiter.done():
+                            waiter.set_exception(e)
+                    return
+            self.last_flush_ms = (time.perf_counter() - started) * 1000
+
+        self.batches += 1
+        self.batched_rows += len(rows)
+        self.last_batch_size = len(rows)
+        self.inserted += len(inserted)
+        self.failed_rows += len(failed)
+        self.duplicates_batch += len(batch) - len(rows)
+        self.duplicates_db += len(rows) - len(inserted) - len(failed)
+        claimed = set()
+        for row, waiter in batch:
+            trans_id = row["transaction_code"]
+            if trans_id in failed:
+                if not waiter.done():
+                    waiter.set_exception(failed[trans_id])
+                continue
+            self.recent_ids.set(trans_id, True)
+            if not waiter.done():
+                waiter.set_result(trans_id in inserted and trans_id not in claimed)
+            claimed.add(trans_id)
+
+    @staticmethod
+    def _insert(rows: List[Dict[str, Any]]):
+        insert = postgresql.insert if engine.dialect.name == "postgresql" else sqlite.insert
+        return insert(Transaction).values(rows).on_conflict_do_nothing().returning(Transaction.transaction_code)
+
+    async def _insert_batch(self, rows: List[Dict[str, Any]]) -> Set[str]:
+        async with async_session() as db:
+            result = await db.execute(self._insert(rows))
+            inserted = {row[0] for row in result.all()}
+            await db.commit()
+        return inserted
+
+    async def _insert_rows(self, rows: List[Dict[str, Any]]) -> Tuple[Set[str], Dict[str, Exception]]:
+        """Insert rows one by one in savepoints; returns the inserted codes and each failed row's error"""
+        inserted: Set[str] = set()
+        failed: Dict[str, Exception] = {}
+        async with async_session() as db:
+            for row in rows:
+                try:
+                    async with db.begin_nested():
+                        result = await db.execute(self._insert([row]))
+                        inserted.update(code for code, in result.all())
+                except Exception as e:
+                    logger.error(f"Error writing C2B confirmation {row['transaction_code']}: {str(e)}")
+                    failed[row["transaction_code"]] = e
+            await db.commit()
+        return inserted, failed
+
+
+c2b_writer = C2BBatchWriter()
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Dict, Optional
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import async_session
+from models import CallbackInbox
+from repositories.b2c_repository import B2CRepository
+from repositories.lnmo_repository import LNMORepository
+from workers.payout_dispatcher import payout_dispatcher
+
+logger = logging.getLogger(__name__)
+
+# "inline" applies callbacks inside the request, "inbox" stores them and acks at once
+MPESA_CALLBACK_MODE = os.getenv("MPESA_CALLBACK_MODE", "inline")
+CALLBACK_INBOX_BATCH_SIZE = int(os.getenv("CALLBACK_INBOX_BATCH_SIZE", "100"))
+CALLBACK_INBOX_POLL_INTERVAL = float(os.getenv("CALLBACK_INBOX_POLL_INTERVAL", "1"))
+CALLBACK_INBOX_MAX_ATTEMPTS = int(os.getenv("CALLBACK_INBOX_MAX_ATTEMPTS", "10"))
+
+
+async def enqueue_callback(db: AsyncSession, body: bytes, source: str = "lnmo") -> None:
+    """Durably store a raw callback body so it can be acknowledged immediately"""
+    await db.execute(insert(CallbackInbox).values(source=source, payload=body.decode("utf-8")))
+    await db.commit()
+    callback_inbox_worker.notify()
+
+
+class CallbackInboxWorker:
+    """Drains the callback inbox in batches, committing each batch once"""
+
+    def __init__(self, batch_size: int = CALLBACK_INBOX_BATCH_SIZE, poll_interval: float = CALLBACK_INBOX_POLL_INTERVAL):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._lnmo_repo: Optional[LNMORepository] = None
+        self._b2c_repo: Optional[B2CRepository] = None
+        self.processed = 0
+        self.failed = 0
+        self.batches = 0
+        self.last_batch_size = 0
+
+    def start(self, lnmo_repo: Optional[LNMORepository] = None, b2c_repo: Optional[B2CRepository] = None) -> None:
+        self._lnmo_repo = lnmo_repo
+        self._b2c_repo = b2c_repo
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info("Callback inbox worker started")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            logger.info("Callback inbox worker stopped")
+
+    def notify(self) -> None:
+        self._wake.set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": MPESA_CALLBACK_MODE,
+            "running": self._task is not None,
+            "processed": self.processed,
+            "failed": self.failed,
+            "batches": self.batches,
+            "last_batch_size": self.last_batch_size,
+        }
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                drained = await self.drain_once()
+            except Exception as e:
+                logger.error(f"Error draining callback inbox: {str(e)}")
+                drained = 0
+            if drained >= self.batch_size:
+                continue
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def drain_once(self) -> int:
+        async with async_session() as db:
+            result = await db.execute(
+                select(CallbackInbox)
+                .where(
+                    CallbackInbox.processed_at.is_(None),
+                    CallbackInbox.attempts < CALLBACK_INBOX_MAX_ATTEMPTS,
+                )
+                .order_by(CallbackInbox.id)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            rows = result.scalars().all()
+            if not rows:
+                return 0
+
+            remaining = rows
+            b2c_rows = [row for row in rows if row.source == "b2c"]
+            if len(b2c_rows) > 1 and await self._apply_b2c_batch(b2c_rows, db):
+                remaining = [row for row in rows if row.source != "b2c"]
+            for row in remaining:
+                try:
+                    # A savepoint per row keeps one bad callback from failing the batch
+                    async with db.begin_nested():
+                        await self._apply(row, db)
+                    row.processed_at = func.now()
+                    self.processed += 1
+                except Exception as e:
+                    row.attempts += 1
+                    row.last_error = str(e)
+                    self.failed += 1
+                    logger.error(f"Error applying inbox callback {row.id}: {str(e)}")
+            await db.commit()
+
+            self.batches += 1
+            self.last_batch_size = len(rows)
+            logger.info(f"Applied {len(rows)} inbox callbacks")
+            return len(rows)
+
+    async def _apply(self, row: CallbackInbox, db: AsyncSession) -> None:
+        payload = json.loads(row.payload)
+        if row.source == "b2c":
+            moved = await (self._b2c_repo or B2CRepository()).apply_results([payload], db)
+            payout_dispatcher.record_results(moved)
+        else:
+            await (self._lnmo_repo or LNMORepository()).apply_callback(payload, db)
+
+    async def _apply_b2c_batch(self, rows, db: AsyncSession) -> bool:
+        """Apply B2C results in one statement; False sends the rows down the row-by-row path"""
+        try:
+            async with db.begin_nested():
+                moved = await (self._b2c_repo or B2CRepository()).apply_results(
+                    [json.loads(row.payload) for row in rows], db
+                )
+        except Exception as e:
+            logger.warning(f"B2C result batch failed, applying one by one: {str(e)}")
+            return False
+        for row in rows:
+            row.processed_at = func.now()
+        self.processed += len(rows)
+        payout_dispatcher.record_results(moved)
+        return True
+
+
+callback_inbox_worker = CallbackInboxWorker()
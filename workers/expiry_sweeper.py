@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from sqlalchemy import exists, func, select, update
+
+from database import async_session, engine
+from models import Orders, OrderStatus, Transaction, TransactionStatus
+from models.transaction import TransactionChannel
+from outbox import ORDER_STATUS_CHANGED, add_outbox_events
+from payment_events import payment_events, event_keys
+from repositories.transaction_state import outbox_events
+
+logger = logging.getLogger(__name__)
+
+EXPIRY_SWEEPER_ENABLED = os.getenv("EXPIRY_SWEEPER_ENABLED", "true").lower() == "true"
+EXPIRY_SWEEP_INTERVAL = float(os.getenv("EXPIRY_SWEEP_INTERVAL", "300"))
+EXPIRY_CHUNK_SIZE = int(os.getenv("EXPIRY_CHUNK_SIZE", "1000"))
+# Well past the STK prompt timeout and the reconciler's last query
+PAYMENT_EXPIRE_AFTER = int(os.getenv("PAYMENT_EXPIRE_AFTER", "3600"))
+ORDER_EXPIRE_AFTER = int(os.getenv("ORDER_EXPIRE_AFTER", "86400"))
+# Arbitrary application-wide key for pg_try_advisory_lock
+EXPIRY_SWEEPER_LOCK_KEY = int(os.getenv("EXPIRY_SWEEPER_LOCK_KEY", "730317"))
+
+
+class ExpirySweeper:
+    """Expires abandoned PENDING STK payments and cancels stale unpaid orders
+
+    Work is done in chunks of set-based UPDATEs, each committed on its own so locks
+    stay short. On Postgres a session advisory lock makes sure only one worker sweeps.
+    """
+
+    def __init__(
+        self,
+        interval: float = EXPIRY_SWEEP_INTERVAL,
+        chunk_size: int = EXPIRY_CHUNK_SIZE,
+        payment_expire_after: int = PAYMENT_EXPIRE_AFTER,
+        order_expire_after: int = ORDER_EXPIRE_AFTER,
+    ):
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.payment_expire_after = payment_expire_after
+        self.order_expire_after = order_expire_after
+        self._task: Optional[asyncio.Task] = None
+        self.runs = 0
+        self.skipped_runs = 0
+        self.expired_transactions = 0
+        self.cancelled_orders = 0
+        self.last_run: Dict[str, Any] = {}
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info("Expiry sweeper started")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            logger.info("Expiry sweeper stopped")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self._task is not None,
+            "runs": self.runs,
+            "skipped_runs": self.skipped_runs,
+            "expired_transactions": self.expired_transactions,
+            "cancelled_orders": self.cancelled_orders,
+            "last_run": self.last_run,
+        }
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Error sweeping expired payments: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self) -> Optional[Dict[str, Any]]:
+        """Sweep unless another worker holds the lock; returns the counts of this run"""
+        if engine.dialect.name != "postgresql":
+            return await self.sweep()
+        async with engine.connect() as conn:
+            locked = await conn.scalar(select(func.pg_try_advisory_lock(EXPIRY_SWEEPER_LOCK_KEY)))
+            # The lock belongs to the connection, so do not sit idle in a transaction while sweeping
+            await conn.commit()
+            if not locked:
+                self.skipped_runs += 1
+                return None
+            try:
+                return await self.sweep()
+            finally:
+                await conn.execute(select(func.pg_advisory_unlock(EXPIRY_SWEEPER_LOCK_KEY)))
+                await conn.commit()
+
+    async def sweep(self) -> Dict[str, Any]:
+        started = time.monotonic()
+        expired = 0
+        while True:
+            moved = await self._expire_transactions()
+            expired += moved
+            if moved < self.chunk_size:
+                break
+        cancelled = 0
+        while True:
+            moved = await self._cancel_orders()
+            cancelled += moved
+            if moved < self.chunk_size:
+                break
+
+        self.runs += 1
+        self.expired_transactions += expired
+        self.cancelled_orders += cancelled
+        self.last_run = {
+            "at": datetime.utcnow().isoformat(),
+            "expired_transactions": expired,
+            "cancelled_orders": cancelled,
+            "seconds": round(time.monotonic() - started, 3),
+        }
+        if expired or cancelled:
+            logger.info(f"Expired {expired} pending payments and cancelled {cancelled} unpaid orders")
+        return self.last_run
+
+    async def _expire_transactions(self) -> int:
+        transactions = Transaction.__table__
+        cutoff = datetime.utcnow() - timedelta(seconds=self.payment_expire_after)
+        stale = (
+            select(transactions.c.id)
+            .where(
+                transactions.c._status == TransactionStatus.PENDING,
+                transactions.c.created_at < cutoff,
+                # Queued B2C payouts are PENDING too and must never expire
+                transactions.c.transaction_channel == TransactionChannel.LNMO,
+            )
+            .limit(self.chunk_size)
+            .with_for_update(skip_locked=True)
+        )
+        async with async_session() as db:
+            result = await db.execute(
+                update(transactions)
+                .where(transactions.c.id.in_(stale), transactions.c._status == TransactionStatus.PENDING)
+                .values(_status=TransactionStatus.EXPIRED)
+                .returning(transactions.c.id, transactions.c.order_id, transactions.c.transaction_id, transactions.c._status)
+            )
+            moved = result.all()
+            if moved:
+                await add_outbox_events(db, outbox_events(moved))
+                await payment_events.notify(
+                    db,
+                    [key for row in moved for key in event_keys(row.order_id, row.transaction_id)],
+                    TransactionStatus.EXPIRED.value,
+                )
+            await db.commit()
+        return len(moved)
+
+    async def _cancel_orders(self) -> int:
+        cutoff = datetime.utcnow() - timedelta(seconds=self.order_expire_after)
+        # An order with a payment still in flight or already made is left alone
+        paying = exists().where(
+            Transaction.order_id == Orders.order_id,
+            Transaction._status.in_([TransactionStatus.PENDING, TransactionStatus.ACCEPTED]),
+        )
+        orders = Orders.__table__
+        stale = (
+            select(orders.c.order_id)
+            .where(orders.c.status == OrderStatus.PENDING, orders.c.datetime < cutoff, ~paying)
+            .limit(self.chunk_size)
+            .with_for_update(skip_locked=True)
+        )
+        async with async_session() as db:
+            result = await db.execute(
+                update(orders)
+                .where(orders.c.order_id.in_(stale), orders.c.status == OrderStatus.PENDING)
+                .values(status=OrderStatus.CANCELLED)
+                .returning(orders.c.order_id)
+            )
+            order_ids = result.scalars().all()
+            await add_outbox_events(db, [
+                (ORDER_STATUS_CHANGED, order_id, {"order_id": order_id, "status": OrderStatus.CANCELLED.value})
+                for order_id in order_ids
+            ])
+            await db.commit()
+        return len(order_ids)
+
+
+expiry_sweeper = ExpirySweeper()
@@ -0,0 +1,154 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from cache import TTLCache
+from database import async_session
+from models import OrphanCallback, Transaction
+from notifications import notify
+
+logger = logging.getLogger(__name__)
+
+ORPHAN_CALLBACK_CHANNEL = "orphan_callbacks"
+ORPHAN_CALLBACK_REPLAY_ENABLED = os.getenv("ORPHAN_CALLBACK_REPLAY_ENABLED", "true").lower() == "true"
+ORPHAN_CALLBACK_SCAN_INTERVAL = float(os.getenv("ORPHAN_CALLBACK_SCAN_INTERVAL", "5"))
+ORPHAN_CALLBACK_BATCH_SIZE = int(os.getenv("ORPHAN_CALLBACK_BATCH_SIZE", "100"))
+ORPHAN_CALLBACK_MAX_ATTEMPTS = int(os.getenv("ORPHAN_CALLBACK_MAX_ATTEMPTS", "10"))
+# Orphans still unmatched after this long are left in the table for manual repair
+ORPHAN_CALLBACK_MAX_AGE = int(os.getenv("ORPHAN_CALLBACK_MAX_AGE", "86400"))
+ORPHAN_CALLBACK_MEMORY = int(os.getenv("ORPHAN_CALLBACK_MEMORY", "10000"))
+
+
+class OrphanCallbackBuffer:
+    """Holds STK callbacks that beat their transaction row and replays them once it exists
+
+    An orphan is stored in orphan_callbacks within the callback's own transaction, and
+    its CheckoutRequestID is remembered by every worker (over NOTIFY on Postgres). The
+    worker that then stores the transaction wakes the replay loop at once; a short
+    periodic scan joining orphans to transactions catches anything else.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = ORPHAN_CALLBACK_BATCH_SIZE,
+        scan_interval: float = ORPHAN_CALLBACK_SCAN_INTERVAL,
+    ):
+        self.batch_size = batch_size
+        self.scan_interval = scan_interval
+        self.waiting = TTLCache(maxsize=ORPHAN_CALLBACK_MEMORY, ttl=ORPHAN_CALLBACK_MAX_AGE)
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._lnmo_repo = None
+        self.held = 0
+        self.replayed = 0
+        self.failed = 0
+        self.scans = 0
+
+    def start(self, lnmo_repo) -> None:
+        self._lnmo_repo = lnmo_repo
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info("Orphan callback replay started")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            logger.info("Orphan callback replay stopped")
+
+    def handle_notification(self, payload: str) -> None:
+        self.waiting.set(payload, True)
+
+    def transaction_stored(self, checkout_request_id: str) -> None:
+        """Called once a transaction row is committed; replays its callback if one is waiting"""
+        if self.waiting.pop(checkout_request_id) is not None:
+            self._wake.set()
+
+    async def hold(self, db: AsyncSession, checkout_request_id: str, data: Dict[str, Any]) -> None:
+        """Stage an unmatched callback in the session's transaction"""
+        insert = postgresql.insert if db.bind.dialect.name == "postgresql" else sqlite.insert
+        await db.execute(
+            insert(OrphanCallback)
+            .values(checkout_request_id=checkout_request_id, payload=json.dumps(data))
+            .on_conflict_do_nothing(index_elements=["checkout_request_id"])
+        )
+        await notify(db, ORPHAN_CALLBACK_CHANNEL, checkout_request_id)
+        self.waiting.set(checkout_request_id, True)
+        self.held += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self._task is not None,
+            "held": self.held,
+            "replayed": self.replayed,
+            "failed": self.failed,
+            "scans": self.scans,
+            "waiting": len(self.waiting),
+        }
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                replayed = await self.replay_once()
+            except Exception as e:
+                logger.error(f"Error replaying orphan callbacks: {str(e)}")
+                replayed = 0
+            if replayed >= self.batch_size:
+                continue
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.scan_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def replay_once(self) -> int:
+        """Apply orphans whose transaction now exists; returns how many were tried"""
+        cutoff = datetime.utcnow() - timedelta(seconds=ORPHAN_CALLBACK_MAX_AGE)
+        async with async_session() as db:
+            result = await db.execute(
+                select(OrphanCallback)
+                .join(Transaction, Transaction.transaction_id == OrphanCallback.checkout_request_id)
+                .where(
+                    OrphanCallback.replayed_at.is_(None),
+                    OrphanCallback.received_at >= cutoff,
+                    OrphanCallback.attempts < ORPHAN_CALLBACK_MAX_ATTEMPTS,
+                )
+                .order_by(OrphanCallback.id)
+                .limit(self.batch_size)
+                .with_for_update(of=OrphanCallback, skip_locked=True)
+            )
+            rows = result.scalars().all()
+            self.scans += 1
+            if not rows:
+                return 0
+
+            for row in rows:
+                try:
+                    # A savepoint per row keeps one bad callback from failing the batch
+                    async with db.begin_nested():
+                        await self._lnmo_repo.apply_callback(json.loads(row.payload), db)
+                    row.replayed_at = func.now()
+                    self.replayed += 1
+                except Exception as e:
+                    row.attempts += 1
+                    row.last_error = str(e)
+                    self.failed += 1
+                    logger.error(f"Error replaying orphan callback {row.checkout_request_id}: {str(e)}")
+            await db.commit()
+
+        logger.info(f"Replayed {len(rows)} orphan callbacks")
+        return len(rows)
+
+
+orphan_callbacks = OrphanCallbackBuffer()
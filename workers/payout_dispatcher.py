@@ -0,0 +1,282 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from sqlalchemy import bindparam, select, update
+
+from database import async_session
+from models import Transaction, TransactionStatus
+from models.transaction import TransactionChannel
+from repositories.b2c_repository import B2CRepository
+from repositories.rate_limiter import AsyncRateLimiter
+from repositories.transaction_state import resolve_pending
+
+logger = logging.getLogger(__name__)
+
+MPESA_B2C_ENABLED = os.getenv("MPESA_B2C_ENABLED", "false").lower() == "true"
+PAYOUT_CLAIM_SIZE = int(os.getenv("PAYOUT_CLAIM_SIZE", "100"))
+PAYOUT_CONCURRENCY = int(os.getenv("PAYOUT_CONCURRENCY", "10"))
+PAYOUT_RATE = float(os.getenv("PAYOUT_RATE", "10"))
+PAYOUT_POLL_INTERVAL = float(os.getenv("PAYOUT_POLL_INTERVAL", "5"))
+# A claimed payout without a ConversationID nor a result after this long is parked for review
+PAYOUT_UNCONFIRMED_AFTER = int(os.getenv("PAYOUT_UNCONFIRMED_AFTER", "900"))
+
+# Statuses after which Daraja did not take the request and it can be sent again
+RETRY_STATUSES = {401, 429, 502, 503, 504}
+# The request may have reached Daraja, so the payout must never be sent again automatically
+AMBIGUOUS_ERRORS = (httpx.ReadTimeout, httpx.WriteTimeout, httpx.ReadError, httpx.WriteError, httpx.RemoteProtocolError)
+
+
+class ThroughputMeter:
+    """Counts events over a sliding window"""
+
+    def __init__(self, window: float = 60):
+        self.window = window
+        self._events: deque = deque()
+
+    def record(self, count: int = 1) -> None:
+        now = time.monotonic()
+        self._events.append((now, count))
+        self._trim(now)
+
+    def rate(self) -> int:
+        self._trim(time.monotonic())
+        return sum(count for _, count in self._events)
+
+    def _trim(self, now: float) -> None:
+        while self._events and self._events[0][0] < now - self.window:
+            self._events.popleft()
+
+
+class PayoutDispatcher:
+    """Sends PENDING B2C payouts to Daraja with bounded concurrency and rate
+
+    A payout is claimed (PENDING -> PROCESSING) and committed before it is sent, and its
+    ConversationID is stored afterwards. Unclaimed rows simply wait for the next round
+    after a crash. A payout that may have reached Daraja is never sent again: one whose
+    request timed out or broke mid-way, or that was claimed and got neither a
+    ConversationID nor a result within PAYOUT_UNCONFIRMED_AFTER, is parked as UNKNOWN.
+    Its result callback still resolves it if Daraja took it; otherwise an operator
+    resolves it after checking the M-Pesa statement.
+    """
+
+    def __init__(
+        self,
+        claim_size: int = PAYOUT_CLAIM_SIZE,
+        concurrency: int = PAYOUT_CONCURRENCY,
+        rate: float = PAYOUT_RATE,
+        poll_interval: float = PAYOUT_POLL_INTERVAL,
+        unconfirmed_after: int = PAYOUT_UNCONFIRMED_AFTER,
+    ):
+        self.claim_size = claim_size
+        self.poll_interval = poll_interval
+        self.unconfirmed_after = unconfirmed_after
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._limiter = AsyncRateLimiter(rate)
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._b2c_repo: Optional[B2CRepository] = None
+        self.sent = 0
+        self.rejected = 0
+        self.retried = 0
+        self.unknown = 0
+        self.results = 0
+        self._sent_meter = ThroughputMeter()
+        self._results_meter = ThroughputMeter()
+
+    def start(self, b2c_repo: Optional[B2CRepository] = None) -> None:
+        self._b2c_repo = b2c_repo
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info("Payout dispatcher started")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            logger.info("Payout dispatcher stopped")
+
+    def notify(self) -> None:
+        self._wake.set()
+
+    def record_results(self, count: int) -> None:
+        self.results += count
+        self._results_meter.record(count)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self._task is not None,
+            "sent": self.sent,
+            "rejected": self.rejected,
+            "retried": self.retried,
+            "unknown": self.unknown,
+            "results": self.results,
+            "payouts_per_minute": self._sent_meter.rate(),
+            "results_per_minute": self._results_meter.rate(),
+            "token": B2CRepository.token_stats(),
+        }
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                dispatched = await self.dispatch_once()
+                if dispatched < self.claim_size:
+                    await self.park_unconfirmed()
+            except Exception as e:
+                logger.error(f"Error dispatching payouts: {str(e)}")
+                dispatched = 0
+            if dispatched < self.claim_size:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.clear()
+
+    async def dispatch_once(self) -> int:
+        rows = await self._claim()
+        if not rows:
+            return 0
+        b2c_repo = self._b2c_repo or B2CRepository()
+        outcomes = await asyncio.gather(*[self._send(b2c_repo, row) for row in rows])
+        await self._write_back(outcomes)
+        retried = sum(1 for outcome, _, _ in outcomes if outcome == "retry")
+        logger.info(f"Dispatched {len(rows) - retried} of {len(rows)} claimed payouts")
+        # Retried rows do not count, so an unavailable Daraja is not hammered in a loop
+        return len(rows) - retried
+
+    async def park_unconfirmed(self) -> int:
+        """Park claimed payouts that never got a ConversationID nor a result as UNKNOWN
+
+        The worker that claimed them may have crashed after sending, so they are not sent again.
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=self.unconfirmed_after)
+        async with async_session() as db:
+            result = await db.execute(
+                update(Transaction.__table__)
+                .where(
+                    Transaction.transaction_channel == TransactionChannel.B2C,
+                    Transaction._status == TransactionStatus.PROCESSING,
+                    Transaction.transaction_id.is_(None),
+                    Transaction.updated_at < cutoff,
+                )
+                .values(_status=TransactionStatus.UNKNOWN)
+            )
+            await db.commit()
+        if result.rowcount:
+            self.unknown += result.rowcount
+            logger.warning(f"Parked {result.rowcount} unconfirmed payouts for review")
+        return result.rowcount
+
+    async def _claim(self) -> List[Any]:
+        transactions = Transaction.__table__
+        claimable = (
+            select(transactions.c.id)
+            .where(
+                transactions.c._status == TransactionStatus.PENDING,
+                transactions.c.transaction_channel == TransactionChannel.B2C,
+            )
+            .order_by(transactions.c.created_at, transactions.c.id)
+            .limit(self.claim_size)
+            .with_for_update(skip_locked=True)
+        )
+        async with async_session() as db:
+            result = await db.execute(
+                update(transactions)
+                .where(transactions.c.id.in_(claimable), transactions.c._status == TransactionStatus.PENDING)
+                .values(_status=TransactionStatus.PROCESSING, updated_at=datetime.utcnow())
+                .returning(
+                    transactions.c.id,
+                    transactions.c._pid,
+                    transactions.c.party_b,
+                    transactions.c.transaction_amount,
+                    transactions.c.transaction_details,
+                )
+            )
+            rows = result.all()
+            # The claim is durable before anything is sent
+            await db.commit()
+        return rows
+
+    async def _send(self, b2c_repo: B2CRepository, row) -> Tuple[str, Any, Dict[str, Any]]:
+        async with self._semaphore:
+            await self._limiter.acquire()
+            try:
+                status_code, response_data = await b2c_repo.pay(
+                    row._pid, row.party_b, int(row.transaction_amount), row.transaction_details
+                )
+            except AMBIGUOUS_ERRORS as e:
+                logger.warning(f"Payout {row._pid} may have been sent, parking it for review: {str(e)}")
+                return "unknown", row, {"error": f"{type(e).__name__}: {str(e)}"}
+            except Exception as e:
+                # Breaker open, bulkhead full, no token or no connection: nothing reached Daraja
+                logger.error(f"Payout {row._pid} not sent: {str(e)}")
+                return "retry", row, {}
+        if status_code == 200 and str(response_data.get("ResponseCode")) == "0":
+            return "sent", row, response_data
+        if status_code in RETRY_STATUSES:
+            return "retry", row, response_data
+        return "rejected", row, response_data
+
+    async def _write_back(self, outcomes: List[Tuple[str, Any, Dict[str, Any]]]) -> None:
+        transactions = Transaction.__table__
+        sent = [
+            {"b_id": row.id, "b_conversation_id": data.get("ConversationID"), "b_feedback": data}
+            for outcome, row, data in outcomes if outcome == "sent"
+        ]
+        rejected = [
+            {"_pid": row._pid, "status": TransactionStatus.REJECTED, "feedback": data}
+            for outcome, row, data in outcomes if outcome == "rejected"
+        ]
+        retry_ids = [row.id for outcome, row, _ in outcomes if outcome == "retry"]
+        unknown = [
+            {"b_id": row.id, "b_feedback": data}
+            for outcome, row, data in outcomes if outcome == "unknown"
+        ]
+        async with async_session() as db:
+            if sent:
+                # A result callback that won the race has already filled these in
+                await db.execute(
+                    update(transactions)
+                    .where(
+                        transactions.c.id == bindparam("b_id"),
+                        transactions.c._status == TransactionStatus.PROCESSING,
+                    )
+                    .values(transaction_id=bindparam("b_conversation_id"), _feedback=bindparam("b_feedback")),
+                    sent,
+                )
+            if rejected:
+                await resolve_pending(db, rejected, match_on="_pid", from_statuses=(TransactionStatus.PROCESSING,))
+            if retry_ids:
+                await db.execute(
+                    update(transactions)
+                    .where(transactions.c.id.in_(retry_ids), transactions.c._status == TransactionStatus.PROCESSING)
+                    .values(_status=TransactionStatus.PENDING)
+                )
+            if unknown:
+                await db.execute(
+                    update(transactions)
+                    .where(
+                        transactions.c.id == bindparam("b_id"),
+                        transactions.c._status == TransactionStatus.PROCESSING,
+                    )
+                    .values(_status=TransactionStatus.UNKNOWN, _feedback=bindparam("b_feedback")),
+                    unknown,
+                )
+            await db.commit()
+        self.sent += len(sent)
+        self.rejected += len(rejected)
+        self.retried += len(retry_ids)
+        self.unknown += len(unknown)
+        self._sent_meter.record(len(sent))
+
+
+payout_dispatcher = PayoutDispatcher()
@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import select
+
+from database import async_session
+from models import Transaction, TransactionStatus
+from models.transaction import TransactionChannel
+from payment_events import payment_events, event_keys
+from repositories.lnmo_repository import LNMORepository
+from repositories.rate_limiter import AsyncRateLimiter
+from repositories.shortcode_profiles import shortcode_registry
+from repositories.transaction_state import resolve_pending
+
+logger = logging.getLogger(__name__)
+
+MPESA_RECONCILE_ENABLED = os.getenv("MPESA_RECONCILE_ENABLED", "true").lower() == "true"
+MPESA_RECONCILE_INTERVAL = float(os.getenv("MPESA_RECONCILE_INTERVAL", "60"))
+MPESA_RECONCILE_MIN_AGE = int(os.getenv("MPESA_RECONCILE_MIN_AGE", "120"))
+MPESA_RECONCILE_BATCH_SIZE = int(os.getenv("MPESA_RECONCILE_BATCH_SIZE", "200"))
+MPESA_RECONCILE_CONCURRENCY = int(os.getenv("MPESA_RECONCILE_CONCURRENCY", "5"))
+MPESA_RECONCILE_RATE = float(os.getenv("MPESA_RECONCILE_RATE", "5"))
+
+
+class PendingReconciler:
+    """Resolves stale PENDING STK transactions by querying Daraja for them"""
+
+    def __init__(
+        self,
+        interval: float = MPESA_RECONCILE_INTERVAL,
+        min_age: int = MPESA_RECONCILE_MIN_AGE,
+        batch_size: int = MPESA_RECONCILE_BATCH_SIZE,
+        concurrency: int = MPESA_RECONCILE_CONCURRENCY,
+        rate: float = MPESA_RECONCILE_RATE,
+    ):
+        self.interval = interval
+        self.min_age = min_age
+        self.batch_size = batch_size
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._limiter = AsyncRateLimiter(rate)
+        self._task: Optional[asyncio.Task] = None
+        self._lnmo_repo: Optional[LNMORepository] = None
+        self.runs = 0
+        self.scanned = 0
+        self.resolved: Dict[str, int] = defaultdict(int)
+        self.still_pending = 0
+        self.errors = 0
+        self.lag_seconds = 0.0
+        self.last_run_at: Optional[datetime] = None
+        self.last_run_seconds = 0.0
+
+    def start(self, lnmo_repo: Optional[LNMORepository] = None) -> None:
+        self._lnmo_repo = lnmo_repo
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info("Pending transaction reconciler started")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            logger.info("Pending transaction reconciler stopped")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self._task is not None,
+            "runs": self.runs,
+            "scanned": self.scanned,
+            "resolved": dict(self.resolved),
+            "still_pending": self.still_pending,
+            "errors": self.errors,
+            "lag_seconds": round(self.lag_seconds, 1),
+            "last_run_at": self.last_run_at.isoformat() if self.last_run_at else None,
+            "last_run_seconds": round(self.last_run_seconds, 3),
+        }
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                resolved = await self.run_once()
+            except Exception as e:
+                logger.error(f"Error reconciling pending transactions: {str(e)}")
+                resolved = 0
+            # Keep going without sleeping while a full batch was resolved
+            if resolved < self.batch_size:
+                await asyncio.sleep(self.interval)
+
+    async def run_once(self) -> int:
+        started = time.monotonic()
+        cutoff = datetime.utcnow() - timedelta(seconds=self.min_age)
+        async with async_session() as db:
+            result = await db.execute(
+                select(Transaction.transaction_id, Transaction.created_at, Transaction.party_b)
+                .where(
+                    Transaction._status == TransactionStatus.PENDING,
+                    Transaction.created_at < cutoff,
+                    Transaction.transaction_channel == TransactionChannel.LNMO,
+                    Transaction.transaction_id.isnot(None),
+                )
+                .order_by(Transaction.created_at)
+                .limit(self.batch_size)
+            )
+            rows = result.all()
+
+        self.runs += 1
+        self.last_run_at = datetime.utcnow()
+        self.lag_seconds = (datetime.utcnow() - rows[0].created_at).total_seconds() if rows else 0.0
+        if not rows:
+            self.last_run_seconds = time.monotonic() - started
+            return 0
+
+        # The DB session is closed while Daraja is queried
+        lnmo_repo = self._lnmo_repo or LNMORepository()
+        outcomes = await asyncio.gather(*[
+            self._query(shortcode_registry.for_short_code(row.party_b) or lnmo_repo, row) for row in rows
+        ])
+        updates = [outcome for outcome in outcomes if outcome is not None]
+        self.scanned += len(rows)
+        self.still_pending += len(rows) - len(updates)
+
+        # Rows a callback resolved in the meantime are left alone
+        moved = await self._write_back(updates) if updates else []
+        for row in moved:
+            self.resolved[row._status.value] += 1
+
+        self.last_run_seconds = time.monotonic() - started
+        logger.info(f"Reconciled {len(moved)} of {len(rows)} stale pending transactions")
+        return len(updates)
+
+    async def _query(self, lnmo_repo: LNMORepository, row) -> Optional[Dict[str, Any]]:
+        async with self._semaphore:
+            await self._limiter.acquire()
+            try:
+                response_data = await lnmo_repo.query(row.transaction_id, None)
+            except Exception:
+                self.errors += 1
+                return None
+        # Daraja answers with an errorCode while the prompt is still open
+        if "ResultCode" not in response_data:
+            return None
+        return {
+            "transaction_id": row.transaction_id,
+            "status": LNMORepository.status_for_result_code(response_data["ResultCode"]),
+            "feedback": response_data,
+        }
+
+    async def _write_back(self, updates) -> List[Any]:
+        """Apply the batch as one compare-and-set; returns the rows that actually left PENDING"""
+        async with async_session() as db:
+            moved = await resolve_pending(db, updates)
+            # One notification per resulting status covers the whole batch
+            keys_by_status = defaultdict(list)
+            for row in moved:
+                keys_by_status[row._status.value] += event_keys(row.order_id, row.transaction_id)
+            for status, keys in keys_by_status.items():
+                await payment_events.notify(db, keys, status)
+            await db.commit()
+        return moved
+
+
+pending_reconciler = PendingReconciler()
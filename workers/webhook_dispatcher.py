@@ -0,0 +1,280 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from sqlalchemy import bindparam, insert, select, update
+
+from database import async_session
+from models import OutboxEvent, Webhook, WebhookDelivery
+from outbox import outbox_committed
+
+logger = logging.getLogger(__name__)
+
+WEBHOOKS_ENABLED = os.getenv("WEBHOOKS_ENABLED", "true").lower() == "true"
+WEBHOOK_CLAIM_SIZE = int(os.getenv("WEBHOOK_CLAIM_SIZE", "500"))
+# Events per POST; receivers get {"events": [...]}
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "50"))
+WEBHOOK_POLL_INTERVAL = float(os.getenv("WEBHOOK_POLL_INTERVAL", "5"))
+WEBHOOK_TIMEOUT = float(os.getenv("WEBHOOK_TIMEOUT", "10"))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "12"))
+WEBHOOK_RETRY_BASE = float(os.getenv("WEBHOOK_RETRY_BASE", "5"))
+WEBHOOK_RETRY_MAX = float(os.getenv("WEBHOOK_RETRY_MAX", "3600"))
+# A claimed delivery whose worker died is attempted again after this long
+WEBHOOK_LEASE = int(os.getenv("WEBHOOK_LEASE", "120"))
+
+
+def subscribed(webhook, event_type: str) -> bool:
+    event_types = [name.strip() for name in webhook.event_types.split(",")]
+    return "*" in event_types or event_type in event_types
+
+
+def retry_delay(attempts: int) -> float:
+    """Exponential backoff with jitter, so a recovering endpoint is not hit by every retry at once"""
+    delay = min(WEBHOOK_RETRY_BASE * 2 ** max(attempts - 1, 0), WEBHOOK_RETRY_MAX)
+    return delay * random.uniform(0.5, 1)
+
+
+def sign(secret: Optional[str], body: bytes) -> Dict[str, str]:
+    if not secret:
+        return {}
+    signature = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return {"X-Webhook-Signature": f"sha256={signature}"}
+
+
+class WebhookDispatcher:
+    """Fans outbox events out to webhooks and delivers them in batches
+
+    Each event gets one delivery row per subscribed webhook. Due deliveries are leased
+    (next_attempt_at is pushed past WEBHOOK_LEASE) and committed before anything is
+    sent, so delivery is at least once; receivers dedupe on the event id.
+    """
+
+    def __init__(
+        self,
+        claim_size: int = WEBHOOK_CLAIM_SIZE,
+        batch_size: int = WEBHOOK_BATCH_SIZE,
+        poll_interval: float = WEBHOOK_POLL_INTERVAL,
+    ):
+        self.claim_size = claim_size
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        # Per-endpoint concurrency, sized from Webhook.max_concurrency
+        self._limits: Dict[int, Tuple[int, asyncio.Semaphore]] = {}
+        self.fanned_out = 0
+        self.delivered = 0
+        self.failed_attempts = 0
+        self.dead = 0
+        self.requests = 0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._client = httpx.AsyncClient(timeout=httpx.Timeout(WEBHOOK_TIMEOUT))
+            self._task = asyncio.create_task(self._run())
+            logger.info("Webhook dispatcher started")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            await self._client.aclose()
+            self._client = None
+            logger.info("Webhook dispatcher stopped")
+
+    def notify(self, *args) -> None:
+        self._wake.set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self._task is not None,
+            "fanned_out": self.fanned_out,
+            "delivered": self.delivered,
+            "failed_attempts": self.failed_attempts,
+            "dead": self.dead,
+            "requests": self.requests,
+        }
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                fanned = await self.fan_out()
+                delivered = await self.deliver_once()
+            except Exception as e:
+                logger.error(f"Error dispatching webhooks: {str(e)}")
+                fanned = delivered = 0
+            if fanned >= self.claim_size or delivered >= self.claim_size:
+                continue
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def fan_out(self) -> int:
+        """Create the delivery rows for undispatched events; returns how many events were taken"""
+        async with async_session() as db:
+            result = await db.execute(
+                select(OutboxEvent.id, OutboxEvent.event_type)
+                .where(OutboxEvent.dispatched_at.is_(None))
+                .order_by(OutboxEvent.id)
+                .limit(self.claim_size)
+                .with_for_update(skip_locked=True)
+            )
+            events = result.all()
+            if not events:
+                return 0
+            result = await db.execute(select(Webhook.id, Webhook.event_types).where(Webhook.active.is_(True)))
+            webhooks = result.all()
+            now = datetime.utcnow()
+            deliveries = [
+                {"webhook_id": webhook.id, "event_id": outbox_event.id, "next_attempt_at": now}
+                for outbox_event in events
+                for webhook in webhooks
+                if subscribed(webhook, outbox_event.event_type)
+            ]
+            if deliveries:
+                await db.execute(insert(WebhookDelivery), deliveries)
+            await db.execute(
+                update(OutboxEvent)
+                .where(OutboxEvent.id.in_([outbox_event.id for outbox_event in events]))
+                .values(dispatched_at=now)
+            )
+            await db.commit()
+        self.fanned_out += len(deliveries)
+        return len(events)
+
+    async def deliver_once(self) -> int:
+        deliveries = await self._claim()
+        if not deliveries:
+            return 0
+        async with async_session() as db:
+            result = await db.execute(
+                select(OutboxEvent).where(OutboxEvent.id.in_({delivery.event_id for delivery in deliveries}))
+            )
+            events = {outbox_event.id: outbox_event for outbox_event in result.scalars().all()}
+            result = await db.execute(
+                select(Webhook).where(Webhook.id.in_({delivery.webhook_id for delivery in deliveries}))
+            )
+            webhooks = {webhook.id: webhook for webhook in result.scalars().all()}
+
+        by_webhook = defaultdict(list)
+        for delivery in deliveries:
+            by_webhook[delivery.webhook_id].append(delivery)
+        batches = [
+            (webhooks[webhook_id], group[start:start + self.batch_size])
+            for webhook_id, group in by_webhook.items()
+            for start in range(0, len(group), self.batch_size)
+        ]
+        outcomes = await asyncio.gather(*[self._post(webhook, batch, events) for webhook, batch in batches])
+        await self._write_back([
+            (delivery, error) for (_, batch), error in zip(batches, outcomes) for delivery in batch
+        ])
+        return len(deliveries)
+
+    async def _claim(self) -> List[Any]:
+        deliveries = WebhookDelivery.__table__
+        now = datetime.utcnow()
+        due = (
+            select(deliveries.c.id)
+            .where(
+                deliveries.c.delivered_at.is_(None),
+                deliveries.c.failed_at.is_(None),
+                deliveries.c.next_attempt_at <= now,
+                deliveries.c.webhook_id.in_(select(Webhook.id).where(Webhook.active.is_(True))),
+            )
+            .order_by(deliveries.c.next_attempt_at)
+            .limit(self.claim_size)
+            .with_for_update(skip_locked=True)
+        )
+        async with async_session() as db:
+            result = await db.execute(
+                update(deliveries)
+                .where(deliveries.c.id.in_(due))
+                .values(next_attempt_at=now + timedelta(seconds=WEBHOOK_LEASE), attempts=deliveries.c.attempts + 1)
+                .returning(deliveries.c.id, deliveries.c.webhook_id, deliveries.c.event_id, deliveries.c.attempts)
+            )
+            rows = result.all()
+            await db.commit()
+        return rows
+
+    async def _post(self, webhook: Webhook, batch: List[Any], events: Dict[int, OutboxEvent]) -> Optional[str]:
+        """Send one batch to one endpoint; returns the error, or None once it was accepted"""
+        body = json.dumps({"events": [
+            {
+                "id": events[delivery.event_id].id,
+                "type": events[delivery.event_id].event_type,
+                "created_at": events[delivery.event_id].created_at.isoformat(),
+                "data": json.loads(events[delivery.event_id].payload),
+            }
+            for delivery in batch
+        ]}).encode()
+        headers = {"Content-Type": "application/json", **sign(webhook.secret, body)}
+        async with self._limit(webhook):
+            self.requests += 1
+            try:
+                response = await self._client.post(webhook.url, content=body, headers=headers)
+            except httpx.HTTPError as e:
+                return f"{type(e).__name__}: {str(e)}"
+        if response.is_success:
+            return None
+        return f"HTTP {response.status_code}: {response.text[:500]}"
+
+    def _limit(self, webhook: Webhook) -> asyncio.Semaphore:
+        size, semaphore = self._limits.get(webhook.id, (None, None))
+        if size != webhook.max_concurrency:
+            semaphore = asyncio.Semaphore(webhook.max_concurrency)
+            self._limits[webhook.id] = (webhook.max_concurrency, semaphore)
+        return semaphore
+
+    async def _write_back(self, outcomes: List[Tuple[Any, Optional[str]]]) -> None:
+        deliveries = WebhookDelivery.__table__
+        now = datetime.utcnow()
+        delivered = [delivery.id for delivery, error in outcomes if error is None]
+        retries = [
+            {
+                "b_id": delivery.id,
+                "b_next_attempt_at": now + timedelta(seconds=retry_delay(delivery.attempts)),
+                "b_failed_at": now if delivery.attempts >= WEBHOOK_MAX_ATTEMPTS else None,
+                "b_last_error": error,
+            }
+            for delivery, error in outcomes if error is not None
+        ]
+        async with async_session() as db:
+            if delivered:
+                await db.execute(update(deliveries).where(deliveries.c.id.in_(delivered)).values(delivered_at=now))
+            if retries:
+                await db.execute(
+                    update(deliveries)
+                    .where(deliveries.c.id == bindparam("b_id"))
+                    .values(
+                        next_attempt_at=bindparam("b_next_attempt_at"),
+                        failed_at=bindparam("b_failed_at"),
+                        last_error=bindparam("b_last_error"),
+                    ),
+                    retries,
+                )
+            await db.commit()
+        dead = sum(1 for retry in retries if retry["b_failed_at"] is not None)
+        self.delivered += len(delivered)
+        self.failed_attempts += len(retries)
+        self.dead += dead
+        if retries:
+            logger.warning(f"{len(retries)} webhook deliveries failed, {dead} gave up after {WEBHOOK_MAX_ATTEMPTS} attempts")
+
+
+webhook_dispatcher = WebhookDispatcher()
+outbox_committed.subscribe(webhook_dispatcher.notify)